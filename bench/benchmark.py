@@ -0,0 +1,301 @@
+"""Offline benchmark of EmporiaCollector.process against local stand-ins for Emporia, Cognito and the local API
+
+    python bench/benchmark.py --devices 8 --channels 16 --chart-scale 1MIN --runs 3 --output bench/results.json
+
+The stand-ins run in a child process so the peak RSS reported is the collector's own.
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import requests
+import yaml
+from datetime import datetime, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+SRC_DIR = os.path.join(REPO_DIR, "src")
+sys.path.insert(0, SRC_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from fake_servers import run_servers
+
+# Span source_components of the collector, grouped into the phases that are reported
+PHASES = {
+    "Emporia": "fetch",
+    "Emporia Chart": "fetch",
+    "emporia: Local Search": "search",
+    "emporia: Local Delete": "delete",
+    "emporia: Local Insert": "insert",
+    "emporia: Local Update": "update",
+    "emporia: Local Merge": "merge",
+    "emporia: Rollup": "rollup",
+    "emporia: Spool Drain": "drain",
+}
+
+
+class SpanRecorder(object):
+    """Wraps the collector's Logger.transaction_event to keep the SPAN_END durations and the run totals"""
+
+    def __init__(self, logger):
+        self._transaction_event = logger.transaction_event
+        self.spans = []
+        self.totals = {}
+        logger.transaction_event = self
+
+    def __call__(self, event_type, *args, **kwargs):
+        event = self._transaction_event(event_type, *args, **kwargs)
+        if event_type.value == "span_end":
+            self.spans.append((event.get("source_component"), event.get("duration") or 0.0, event.get("payload")))
+        elif event_type.value == "transaction_end":
+            self.totals = dict(kwargs.get("payload") or {})
+        return event
+
+    def reset(self):
+        self.spans = []
+        self.totals = {}
+
+
+def load_collector_module():
+    spec = importlib.util.spec_from_file_location("emporia_collector", os.path.join(SRC_DIR, "emporia-collector.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_config(path: str, work_dir: str, urls: dict, args, replica: int = 0) -> str:
+    """The repo's config.yaml pointed at the stand-ins, with every cache in the scratch directory
+
+    Each replica keeps its own tokens, topology, state and spool, the sink, rollup and leases are shared.
+    """
+    cache_dir = os.path.join(work_dir, f"replica{replica + 1}") if replica else work_dir
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(SRC_DIR, "configuration", "config.yaml"), "r") as f:
+        config = yaml.safe_load(f)
+    config["local_api"].update({"sync_mode": args.sync_mode, "concurrency": args.concurrency,
+                                "batch_size": args.batch_size})
+    config["emporia"].update({
+        "api_root": urls["emporia"],
+        "cognito_endpoint_url": urls["cognito"],
+        "token_cache_path": os.path.join(cache_dir, "tokens.json"),
+        "topology_cache_path": os.path.join(cache_dir, "topology.json"),
+        "requests_per_second": args.requests_per_second,
+        "cognito_backend": args.cognito_backend,
+    })
+    config["chart_usage"]["plan"] = [{"scale": args.chart_scale, "unit": "KilowattHours", "channels": []}] \
+        if args.chart_scale else []
+    config["rollup"].update({"source": args.chart_scale if args.rollup else "",
+                             "scales": [scale for scale in args.rollup.split(",") if scale],
+                             "path": os.path.join(work_dir, "rollup.db")})
+    config["state"]["path"] = os.path.join(cache_dir, "state.db") if args.state else ""
+    config["spool"]["path"] = os.path.join(cache_dir, "spool.db") if args.spool else ""
+    config["backfill"]["state_path"] = os.path.join(cache_dir, "backfill.json")
+    if args.accounts > 1:
+        config["accounts"]["list"] = [{f"acct{index + 1}": {}} for index in range(args.accounts)]
+    config["sink"]["type"] = args.sink
+    config["sink"]["sqlite"]["path"] = os.path.join(work_dir, "sink.db")
+    config["sink"]["postgres"].update({"dsn": args.postgres_dsn, "create_schema": True})
+    config["leases"].update({"backend": args.leases, "owner": f"replica{replica + 1}", "ttl": args.lease_ttl})
+    config["leases"]["sqlite"]["path"] = os.path.join(work_dir, "leases.db")
+    config["leases"]["postgres"]["dsn"] = args.postgres_dsn
+    with open(path, "w") as f:
+        yaml.safe_dump(config, f)
+    return path
+
+
+def create_collector(module, config):
+    accounts = module.load_accounts(config)
+    return module.MultiAccountCollector(config, accounts) if len(accounts) > 1 else module.EmporiaCollector(config)
+
+
+def run_replicas(collectors: list, use_async: bool):
+    """One process() run of every replica at once, each in its own thread"""
+    def run(collector):
+        if use_async:
+            asyncio.run(collector.process_async())
+        else:
+            collector.process()
+    threads = [threading.Thread(target=run, args=(collector,)) for collector in collectors]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def summarize_spans(spans: list) -> dict:
+    phases = {}
+    for component, duration, _ in spans:
+        phases.setdefault(PHASES.get(component, component), []).append(duration)
+    summary = {}
+    for phase, durations in phases.items():
+        durations.sort()
+        summary[phase] = {
+            "count": len(durations),
+            "total_seconds": round(sum(durations), 6),
+            "mean_seconds": round(statistics.fmean(durations), 6),
+            "p50_seconds": round(durations[len(durations) // 2], 6),
+            "p95_seconds": round(durations[min(len(durations) - 1, int(len(durations) * 0.95))], 6),
+            "max_seconds": round(durations[-1], 6),
+        }
+    return summary
+
+
+def fetched_records(spans: list) -> int:
+    return sum((payload or {}).get("usage_records", 0) for component, _, payload in spans
+               if component in ("Emporia", "Emporia Chart"))
+
+
+def server_stats(urls: dict, reset: bool = False) -> dict:
+    stats = {}
+    for name, url in urls.items():
+        root = url.split("/api/")[0]
+        stats[name] = requests.get(f"{root}/__stats", timeout=10).json()
+        if reset:
+            requests.get(f"{root}/__reset", timeout=10)
+    return stats
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 2)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the collector against local stand-in services")
+    parser.add_argument("--devices", type=int, default=4, help="panels in the synthetic account")
+    parser.add_argument("--accounts", type=int, default=1, help="Emporia accounts collected in one process")
+    parser.add_argument("--channels", type=int, default=16, help="channels per panel, besides Main")
+    parser.add_argument("--nested", type=int, default=0, help="depth of nested sub-panels under every panel")
+    parser.add_argument("--chart-scale", default="", help="collect a getChartUsage series at this scale, e.g. 1MIN")
+    parser.add_argument("--rollup", default="", help="roll the --chart-scale series up to these scales, e.g. 1H,1D")
+    parser.add_argument("--runs", type=int, default=3, help="process() runs against the same local data")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="benchmark process_async")
+    parser.add_argument("--sink", default="http", choices=("http", "sqlite", "postgres"),
+                        help="sink.type, sqlite writes to the scratch directory")
+    parser.add_argument("--postgres-dsn", default="", help="throwaway database for --sink postgres")
+    parser.add_argument("--sync-mode", default="diff", choices=("diff", "replace"))
+    parser.add_argument("--concurrency", type=int, default=8, help="local_api.concurrency")
+    parser.add_argument("--batch-size", type=int, default=500, help="local_api.batch_size")
+    parser.add_argument("--no-bulk", dest="bulk", action="store_false", help="the local API has no bulk routes")
+    parser.add_argument("--spool", action="store_true", help="enable the spool")
+    parser.add_argument("--state", action="store_true", help="enable the watermark state store")
+    parser.add_argument("--requests-per-second", type=float, default=0, help="emporia.requests_per_second")
+    parser.add_argument("--leases", default="", choices=("", "sqlite", "postgres"),
+                        help="leases.backend, postgres uses --postgres-dsn")
+    parser.add_argument("--replicas", type=int, default=1, help="collectors sharing the work through --leases")
+    parser.add_argument("--lease-ttl", type=float, default=300, help="leases.ttl")
+    parser.add_argument("--cognito-backend", default="boto3", choices=("boto3", "https"),
+                        help="emporia.cognito_backend")
+    parser.add_argument("--emporia-latency-ms", type=float, default=0.0)
+    parser.add_argument("--emporia-jitter-ms", type=float, default=0.0)
+    parser.add_argument("--emporia-error-rate", type=float, default=0.0)
+    parser.add_argument("--local-latency-ms", type=float, default=0.0)
+    parser.add_argument("--local-jitter-ms", type=float, default=0.0)
+    parser.add_argument("--local-error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--label", default="", help="free text stored with the results")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    options = {
+        "devices": args.devices, "channels": args.channels, "nested": args.nested, "seed": args.seed,
+        "bulk": args.bulk,
+        "emporia_latency": args.emporia_latency_ms / 1000, "emporia_jitter": args.emporia_jitter_ms / 1000,
+        "emporia_error_rate": args.emporia_error_rate, "accounts": args.accounts,
+        "local_latency": args.local_latency_ms / 1000, "local_jitter": args.local_jitter_ms / 1000,
+        "local_error_rate": args.local_error_rate,
+    }
+    context = multiprocessing.get_context("spawn")
+    ready = context.Queue()
+    stop = context.Event()
+    servers = context.Process(target=run_servers, args=(options, ready, stop), daemon=True)
+    servers.start()
+    urls = ready.get(timeout=30)
+
+    with tempfile.TemporaryDirectory(prefix="emporia-bench-") as work_dir:
+        os.environ.update({
+            "USERNAME": "bench1", "PASSWORD": "bench", "CLIENT_ID": "bench", "API_URL": urls["local_api"],
+            # Nothing may reach AWS: no credential or region lookups beyond the stand-in
+            "AWS_ACCESS_KEY_ID": "bench", "AWS_SECRET_ACCESS_KEY": "bench", "AWS_EC2_METADATA_DISABLED": "true",
+            "LOG_LEVEL": os.environ.get("LOG_LEVEL", "WARNING"),
+        })
+        for index in range(args.accounts):
+            os.environ.update({f"ACCT{index + 1}_USERNAME": f"bench{index + 1}", f"ACCT{index + 1}_PASSWORD": "bench",
+                               f"ACCT{index + 1}_CLIENT_ID": "bench"})
+        module = load_collector_module()
+        configs = [module.Config(write_config(os.path.join(work_dir, f"config{replica}.yaml"), work_dir, urls, args,
+                                              replica)) for replica in range(max(1, args.replicas))]
+        server_stats(urls, reset=True)
+        started = time.perf_counter()
+        collectors = [create_collector(module, config) for config in configs]
+        recorders = [SpanRecorder(collector._logger) for collector in collectors]
+        runs = []
+        try:
+            for run in range(args.runs):
+                for recorder in recorders:
+                    recorder.reset()
+                run_started = time.perf_counter()
+                run_replicas(collectors, args.use_async)
+                wall = time.perf_counter() - run_started
+                if run == 0:
+                    # The first run also pays for the login and the topology download
+                    wall_with_setup = time.perf_counter() - started
+                spans = [span for recorder in recorders for span in recorder.spans]
+                records = fetched_records(spans)
+                runs.append({
+                    "run": run + 1,
+                    "wall_seconds": round(wall, 6),
+                    "records_fetched": records,
+                    "records_per_second": round(records / wall, 2) if wall else None,
+                    "written": {key: sum(recorder.totals.get(key, 0) for recorder in recorders)
+                                for key in ("records", "updated", "deleted", "errors")},
+                    "phases": summarize_spans(spans),
+                    "servers": server_stats(urls, reset=True),
+                })
+                print(f"run {run + 1}: {wall:.3f}s, {records} records, "
+                      f"{runs[-1]['records_per_second']} records/s", file=sys.stderr)
+        finally:
+            for collector in collectors:
+                collector.close()
+            stop.set()
+            servers.join(timeout=10)
+
+    results = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "label": args.label,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "options": vars(args),
+        "first_run_with_setup_seconds": round(wall_with_setup, 6) if runs else None,
+        "peak_rss_mb": peak_rss_mb(),
+        "runs": runs,
+    }
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+import itertools
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+# Interval between the points of a getChartUsage series, as in emporia.emporia.CHART_STEPS
+CHART_STEPS = {
+    "1S": timedelta(seconds=1),
+    "1MIN": timedelta(minutes=1),
+    "15MIN": timedelta(minutes=15),
+    "1H": timedelta(hours=1),
+    "1D": timedelta(days=1),
+}
+
+
+class Faults(object):
+    """Latency and error injection shared by the handlers of one server"""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def apply(self) -> bool:
+        """Sleep for the configured latency, returning True when this request should fail with a 500"""
+        with self._lock:
+            delay = self.latency + self._random.uniform(0, self.jitter) if self.jitter else self.latency
+            fail = self.error_rate > 0 and self._random.random() < self.error_rate
+        if delay:
+            time.sleep(delay)
+        return fail
+
+
+class Stats(object):
+    """Request counts and server side time per route"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = {}
+            self.errors = {}
+            self.seconds = {}
+
+    def record(self, route: str, seconds: float, error: bool):
+        with self._lock:
+            self.requests[route] = self.requests.get(route, 0) + 1
+            self.seconds[route] = self.seconds.get(route, 0.0) + seconds
+            if error:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"requests": dict(self.requests), "errors": dict(self.errors),
+                    "seconds": {route: round(value, 6) for route, value in self.seconds.items()}}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Common plumbing: JSON bodies, fault injection and the /__stats and /__reset routes"""
+
+    protocol_version = "HTTP/1.1"
+    faults = None
+    stats = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_PUT(self):
+        self._dispatch("PUT")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+    def route(self, method: str, path: str, query: dict, body) -> tuple:
+        """(route name for the stats, status code, JSON serializable response)"""
+        raise NotImplementedError
+
+    def _dispatch(self, method: str):
+        started = time.perf_counter()
+        url = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        if url.path == "/__stats":
+            return self._send(200, self.stats.snapshot())
+        if url.path == "/__reset":
+            self.stats.reset()
+            return self._send(200, {})
+        body = json.loads(raw) if raw else None
+        failed = self.faults.apply()
+        if failed:
+            route, status_code, response = self.route_name(method, url.path, parse_qs(url.query)), 500, {}
+        else:
+            route, status_code, response = self.route(method, url.path, parse_qs(url.query), body)
+        self._send(status_code, response)
+        self.stats.record(route, time.perf_counter() - started, status_code >= 400)
+
+    def route_name(self, method: str, path: str, query: dict) -> str:
+        return f"{method} {path}"
+
+    def _send(self, status_code: int, response, content_type: str = "application/json"):
+        data = json.dumps(response, separators=(",", ":")).encode("utf-8") if response is not None else b""
+        self.send_response(status_code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class SyntheticAccount(object):
+    """Deterministic N device x M channel topology and usage values"""
+
+    def __init__(self, devices: int = 4, channels: int = 16, nested: int = 0, seed: int = 0, first_gid: int = 1000):
+        self.seed = seed
+        self.devices = {}
+        self.nested = {}
+        gids = itertools.count(first_gid)
+        for index in range(devices):
+            gid = next(gids)
+            self.devices[gid] = f"Panel {index + 1}"
+            # A chain of nested sub-panels under the main channel of every panel
+            parent = gid
+            for depth in range(nested):
+                child = next(gids)
+                self.nested[parent] = child
+                self.devices[child] = f"Panel {index + 1} Sub {depth + 1}"
+                parent = child
+        self.channels = {gid: ["1,2,3"] + [str(number) for number in range(1, channels + 1)]
+                         for gid in self.devices}
+
+    def channel_name(self, gid: int, channel_num: str) -> str:
+        return "Main" if channel_num == "1,2,3" else f"{self.devices[gid]} Channel {channel_num}"
+
+    def value(self, gid: int, channel_num: str, key: str) -> float:
+        return round(random.Random(f"{self.seed}:{gid}:{channel_num}:{key}").random() * 10, 6)
+
+    def topology(self) -> dict:
+        return {"devices": [
+            {"deviceGid": gid, "locationProperties": {"displayName": name},
+             "devices": [{"channels": [{"deviceGid": gid, "channelNum": channel_num,
+                                        "name": self.channel_name(gid, channel_num)}
+                                       for channel_num in self.channels[gid]]}]}
+            for gid, name in self.devices.items()]}
+
+    def device_list_usages(self, gids: list, instant: str, scale: str, unit: str) -> dict:
+        top_level = [gid for gid in gids if gid not in self.nested.values()]
+        return {"deviceListUsages": {"instant": instant, "scale": scale, "energyUnit": unit, "devices": [
+            {"deviceGid": gid, "channelUsages": self._channel_usages(gid, instant)} for gid in top_level]}}
+
+    def _channel_usages(self, gid: int, instant: str) -> list:
+        usages = []
+        for channel_num in self.channels[gid]:
+            usage = {"deviceGid": gid, "channelNum": channel_num, "name": self.channel_name(gid, channel_num),
+                     "usage": self.value(gid, channel_num, instant[:10]), "percentage": 0}
+            if channel_num == "1,2,3" and gid in self.nested:
+                usage["nestedDevices"] = [{"deviceGid": self.nested[gid],
+                                           "channelUsages": self._channel_usages(self.nested[gid], instant)}]
+            usages.append(usage)
+        return usages
+
+    def chart_usage(self, gid: int, channel_num: str, start: str, end: str, scale: str) -> dict:
+        step = CHART_STEPS[scale]
+        first = _parse_time(start)
+        last = min(_parse_time(end), datetime.now(timezone.utc))
+        points = max(0, int((last - first) / step))
+        return {"firstUsageInstant": _format_time(first),
+                "usageList": [self.value(gid, channel_num, _format_time(first + step * index))
+                              for index in range(points)]}
+
+
+def emporia_handler(accounts: dict, faults: Faults, stats: Stats):
+    """Stand-in for API_ROOT: customers/devices, getDeviceListUsages and getChartUsage
+
+    accounts maps usernames to their SyntheticAccount, the user is read from the stand-in Cognito's id token and
+    unknown users get the first account.
+    """
+    default = next(iter(accounts.values()))
+
+    class EmporiaHandler(_Handler):
+
+        def route_name(self, method, path, query):
+            return query.get("apiMethod", [path.strip("/")])[0]
+
+        def route(self, method, path, query, body):
+            name = self.route_name(method, path, query)
+            account = accounts.get(_token_user(self.headers.get("authtoken", "")), default)
+            if name == "customers/devices":
+                return name, 200, account.topology()
+            if name == "getDeviceListUsages":
+                gids = [int(gid) for gid in query["deviceGids"][0].replace(" ", "+").split("+") if gid]
+                return name, 200, account.device_list_usages(gids, query["instant"][0], query["scale"][0],
+                                                              query["energyUnit"][0])
+            if name == "getChartUsage":
+                return name, 200, account.chart_usage(int(query["deviceGid"][0]), query["channel"][0],
+                                                      query["start"][0], query["end"][0], query["scale"][0])
+            return name, 404, {}
+
+    EmporiaHandler.faults = faults
+    EmporiaHandler.stats = stats
+    return EmporiaHandler
+
+
+def cognito_handler(faults: Faults, stats: Stats):
+    """Stand-in for the cognito-idp endpoint, answering InitiateAuth for any user"""
+
+    class CognitoHandler(_Handler):
+
+        def route_name(self, method, path, query):
+            return self.headers.get("X-Amz-Target", "").rsplit(".", 1)[-1] or path
+
+        def route(self, method, path, query, body):
+            name = self.route_name(method, path, query)
+            if name != "InitiateAuth":
+                return name, 400, {"__type": "InvalidParameterException"}
+            issued = int(time.time())
+            parameters = (body or {}).get("AuthParameters") or {}
+            # Tokens carry the user, so the Emporia stand-in can tell the accounts apart
+            user = parameters.get("USERNAME") or _token_user(parameters.get("REFRESH_TOKEN", ""))
+            result = {"AccessToken": f"access-{user}-{issued}", "IdToken": f"id-{user}-{issued}", "ExpiresIn": 3600,
+                      "TokenType": "Bearer"}
+            if (body or {}).get("AuthFlow") == "USER_PASSWORD_AUTH":
+                result["RefreshToken"] = f"refresh-{user}-{issued}"
+            return name, 200, {"AuthenticationResult": result, "ChallengeParameters": {}}
+
+        def _send(self, status_code, response, content_type="application/x-amz-json-1.1"):
+            super()._send(status_code, response, content_type)
+
+    CognitoHandler.faults = faults
+    CognitoHandler.stats = stats
+    return CognitoHandler
+
+
+def local_api_handler(faults: Faults, stats: Stats, prefix: str = "/api/v1/emporia/", bulk: bool = True):
+    """Stand-in for the local CRUD API (API_URL), with its search and bulk routes"""
+    rows = {}
+    ids = itertools.count(1)
+    lock = threading.Lock()
+
+    class LocalApiHandler(_Handler):
+
+        def route_name(self, method, path, query):
+            relative = path[len(prefix):].strip("/") if path.startswith(prefix) else path
+            if relative and relative not in ("search", "bulk", "bulk/delete"):
+                relative = "{id}"
+            return f"{method} {relative or '/'}"
+
+        def route(self, method, path, query, body):
+            name = self.route_name(method, path, query)
+            with lock:
+                if name == "POST search":
+                    day = (body or {}).get("start_date", "")[:10]
+                    return name, 200, [row for row in rows.values() if row.get("instant", "")[:10] == day]
+                if name.endswith("bulk") or name.endswith("bulk/delete"):
+                    if not bulk:
+                        return name, 404, {}
+                    if name == "POST bulk":
+                        for payload in body:
+                            row_id = next(ids)
+                            rows[row_id] = dict(payload, id=row_id)
+                        return name, 200, {"inserted": len(body)}
+                    if name == "PUT bulk":
+                        for payload in body:
+                            rows[int(payload["id"])] = dict(payload)
+                        return name, 200, {"updated": len(body)}
+                    for row_id in body["ids"]:
+                        rows.pop(int(row_id), None)
+                    return name, 200, {"deleted": len(body["ids"])}
+                if name == "POST /":
+                    row_id = next(ids)
+                    rows[row_id] = dict(body, id=row_id)
+                    return name, 200, rows[row_id]
+                if name == "PUT {id}":
+                    row_id = int(path.rstrip("/").rsplit("/", 1)[1])
+                    rows[row_id] = dict(body, id=row_id)
+                    return name, 200, rows[row_id]
+                if name == "DELETE {id}":
+                    rows.pop(int(path.rstrip("/").rsplit("/", 1)[1]), None)
+                    return name, 200, {}
+            return name, 404, {}
+
+    LocalApiHandler.faults = faults
+    LocalApiHandler.stats = stats
+    return LocalApiHandler
+
+
+def serve(handler, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name=handler.__name__, daemon=True).start()
+    return server
+
+
+def run_servers(options: dict, ready, stop):
+    """Child process entry point: start the three stand-ins, report their URLs and wait for stop"""
+    seed = options.get("seed", 0)
+    # One synthetic account per user, bench1 to benchN, with device gids that do not overlap
+    accounts = {f"bench{index + 1}": SyntheticAccount(options.get("devices", 4), options.get("channels", 16),
+                                                      options.get("nested", 0), seed + index, 1000 + 100000 * index)
+                for index in range(max(1, options.get("accounts", 1)))}
+    emporia = serve(emporia_handler(accounts, Faults(options.get("emporia_latency", 0.0),
+                                                    options.get("emporia_jitter", 0.0),
+                                                    options.get("emporia_error_rate", 0.0), seed), Stats()))
+    cognito = serve(cognito_handler(Faults(options.get("cognito_latency", 0.0), seed=seed), Stats()))
+    local_api = serve(local_api_handler(Faults(options.get("local_latency", 0.0), options.get("local_jitter", 0.0),
+                                               options.get("local_error_rate", 0.0), seed), Stats(),
+                                        bulk=options.get("bulk", True)))
+    ready.put({
+        "emporia": f"http://127.0.0.1:{emporia.server_address[1]}",
+        "cognito": f"http://127.0.0.1:{cognito.server_address[1]}",
+        "local_api": f"http://127.0.0.1:{local_api.server_address[1]}/api/v1/emporia/",
+    })
+    stop.wait()
+    for server in (emporia, cognito, local_api):
+        server.shutdown()
+
+
+def _token_user(token: str) -> str:
+    """The user of an id-<user>-<issued> or refresh-<user>-<issued> token"""
+    return token.split("-", 1)[-1].rsplit("-", 1)[0] if token.count("-") >= 2 else ""
+
+
+def _parse_time(value: str) -> datetime:
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def _format_time(value: datetime) -> str:
+    return value.astimezone(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
@@ -1,92 +1,871 @@
+import time
+
+# --profile-startup times the imports below from here
+_IMPORTS_STARTED = time.perf_counter()
+
+import argparse
+import asyncio
 import requests
+import math
 import os
+import signal
+import threading
 import traceback
-from datetime import datetime, timezone, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timezone, timedelta
 from dotenv import load_dotenv
-from emporia.emporia import Emporia
+from emporia.accounts import Account, load_accounts
+from emporia.checkpoint import Checkpoint
+from emporia.emporia import CHART_STEPS, Emporia
+from emporia.enums import Scale, Unit
+from emporia.leases import PostgresLeaseStore, SqliteLeaseStore
+from emporia import metrics, startup
+from emporia.rate_limit import TokenBucket
+from emporia.records import UsageRecord, parse_instant
+from emporia.rollup import Rollup
+from emporia.scheduler import Scheduler
+from emporia.sinks import HttpSink, PostgresSink, SqliteSink, search_date
+from emporia.spool import Spool
+from emporia.state import StateStore
 from jTookkit.jLogging import LoggingInfo, Logger, EventType
 from jTookkit.jConfig import Config
 
 
 class EmporiaCollector:
 
-    def __init__(self, config):
+    def __init__(self, config, refresh_devices: bool = False, account: Account = None, sink=None, logger=None):
+        """Collects one account, the first of load_accounts by default
+
+        sink and logger can be shared with the collectors of other accounts, a shared sink is not closed here.
+        """
         self._config = config
-        logging_info = LoggingInfo(**self._config.get("logging_info", {}))
-        self._logger = Logger(logging_info)
+        self._refresh_devices = refresh_devices
+        self._account = account or load_accounts(config)[0]
+        self._logger = logger or metrics.MeteredLogger(LoggingInfo(**self._config.get("logging_info", {})))
         self._api_url = os.getenv("API_URL")
+        self._sync_mode = self._config.get("local_api.sync_mode", "diff")
+        self._owns_sink = sink is None
+        self._sink = sink or self._create_sink()
+        self._async_concurrency = self._config.get("async_engine.concurrency", 4)
+        self._semaphore = None
+        self._chart_plan = self._create_chart_plan()
+        # (scale, unit) pairs this collector owns in the local data, rows outside them are never deleted
+        self._scopes = {(Scale.DAY.value, Unit.KWH.value)}
+        self._scopes.update((scale.value, unit.value) for scale, unit, _ in self._chart_plan)
+        self._rollup = self._create_rollup()
+        self._rollup_lock = threading.Lock()
+        if self._rollup is not None:
+            self._scopes.update((scale.value, self._rollup.unit.value) for scale in self._rollup.scales)
+        # Rolled up from the chart series, getDeviceListUsages is not called for the daily totals
+        self._rollup_days = self._rollup is not None and self._rollup.produces(Scale.DAY, Unit.KWH)
+        self._fetch_scopes = self._create_fetch_scopes()
+        self._leases = self._create_leases()
+        self._lease_batch = max(1, self._config.get("leases.batch", 8))
+        state_path = self._config.get("state.path", "")
+        self._state = StateStore(state_path, self._account.name) if state_path else None
+        self._grace = timedelta(seconds=self._config.get("state.grace_seconds", 3600))
+        if self._state is not None:
+            metrics.observe_watermark_lag(self._state, self._scopes)
+        spool_path = self._account.path(self._config.get("spool.path", ""))
+        self._spool = Spool(spool_path, self._config.get("spool.initial_retry_delay", 30),
+                            self._config.get("spool.max_retry_delay", 3600)) if spool_path else None
+        self._emporia = None
         self._transaction = None
 
+    @property
+    def account(self) -> Account:
+        return self._account
+
     def process(self):
+        transaction = self._logger.transaction_event(EventType.TRANSACTION_START)
+        payload = self.collect(transaction)
+        return_code = payload.pop('return_code')
+        self._logger.transaction_event(EventType.TRANSACTION_END, transaction=transaction,
+                                       payload=payload, return_code=return_code)
+
+    async def process_async(self):
+        """Same run as process, but the days and their independent stages overlap on an asyncio loop"""
+        transaction = self._logger.transaction_event(EventType.TRANSACTION_START)
+        payload = await self.collect_async(transaction)
+        return_code = payload.pop('return_code')
+        self._logger.transaction_event(EventType.TRANSACTION_END, transaction=transaction,
+                                       payload=payload, return_code=return_code)
+
+    def collect(self, transaction: dict) -> dict:
+        """Load yesterday and today for the account within transaction, returning the run's payload"""
         payload = {
             "return_code": 200,
             "records": 0,
+            "updated": 0,
             "deleted": 0,
             "errors": 0,
             "details": []
         }
 
-        self._transaction = self._logger.transaction_event(EventType.TRANSACTION_START)
-        # Create the Emporia object that will be used to call the external Emporia APIs
-        emporia = Emporia(os.getenv("USERNAME"), os.getenv("PASSWORD"), os.getenv("CLIENT_ID"))
+        self._transaction = transaction
+        # Create (or reuse) the Emporia object that will be used to call the external Emporia APIs
+        emporia = self._get_emporia()
 
         # Call for yesterday's data and load it to Postgres
         self._call_and_update_day(emporia, payload, days_back=1)
         # Call for today's data and load it to Postgres
         self._call_and_update_day(emporia, payload, days_back=0)
+        # Write whatever is waiting in the spool, including the days just fetched
+        if self._spool is not None:
+            self._drain_spool(payload)
+        return payload
+
+    async def collect_async(self, transaction: dict) -> dict:
+        """Async counterpart of collect"""
+        payload = {
+            "return_code": 200,
+            "records": 0,
+            "updated": 0,
+            "deleted": 0,
+            "errors": 0,
+            "details": []
+        }
+
+        self._transaction = transaction
+        self._semaphore = asyncio.Semaphore(self._async_concurrency)
+        emporia = await asyncio.to_thread(self._get_emporia)
+        # Discover the devices once, before both days need them
+        await asyncio.to_thread(emporia.get_devices)
 
-        return_code = payload['return_code']
-        payload.pop('return_code')
+        # Yesterday's and today's data are independent, so they are loaded concurrently
+        days = (1, 0)
+        results = await asyncio.gather(*[self._load_day_async(emporia, days_back=days_back) for days_back in days])
+        for days_back, result in zip(days, results):
+            self._update_day(payload, days_back, result)
+        if self._spool is not None:
+            await asyncio.to_thread(self._drain_spool, payload)
+        return payload
+
+    def backfill(self, start: date, end: date, scales: list, workers: int = 4, state_path: str = None):
+        """Load every day from start to end (inclusive) for the scales, resuming from the checkpoint state file"""
+        payload = {
+            "return_code": 200,
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "scales": [scale.value for scale in scales],
+            "chunks": 0,
+            "resumed": 0,
+            "records": 0,
+            "updated": 0,
+            "deleted": 0,
+            "errors": 0,
+        }
+        self._transaction = self._logger.transaction_event(EventType.TRANSACTION_START, payload=dict(payload))
+        started = time.monotonic()
+        emporia = self._get_emporia()
+        emporia.get_devices()
+
+        # Completed days are tracked per scale set, so a wider range over the same scales resumes as well
+        checkpoint = Checkpoint(state_path, ",".join(sorted(payload["scales"])))
+        today = datetime.now(timezone.utc).date()
+        days = [start + timedelta(days=offset) for offset in range((end - start).days + 1)]
+        pending = [day for day in days if not checkpoint.is_done(day.isoformat())]
+        payload["resumed"] = len(days) - len(pending)
+
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="backfill") as executor:
+            futures = {executor.submit(self._backfill_day, emporia, day, scales): day for day in pending}
+            for future in as_completed(futures):
+                return_code, records, updated, deleted, errors = future.result()
+                payload["return_code"] = max(payload["return_code"], return_code)
+                payload["chunks"] += 1
+                payload["records"] += records
+                payload["updated"] += updated
+                payload["deleted"] += deleted
+                payload["errors"] += errors
+                # Today is still changing, so it is never recorded as done
+                if return_code == 200 and futures[future] < today:
+                    checkpoint.mark_done(futures[future].isoformat(), {"records": records + updated + deleted})
+
+        elapsed = time.monotonic() - started
+        payload["seconds"] = round(elapsed, 3)
+        payload["records_per_second"] = round((payload["records"] + payload["updated"]) / elapsed, 1) if elapsed else 0
+        return_code = payload.pop("return_code")
         self._logger.transaction_event(EventType.TRANSACTION_END, transaction=self._transaction,
                                        payload=payload, return_code=return_code)
 
+    @property
+    def backfill_scales(self) -> set:
+        """The scales backfill can load: those of getChartUsage and those rolled up in KilowattHours"""
+        scales = set(CHART_STEPS)
+        if self._rollup is not None:
+            scales.update(scale for scale in self._rollup.scales if self._rollup.produces(scale, Unit.KWH))
+        return scales
+
+    def _backfill_day(self, emporia, day: date, scales: list) -> tuple:
+        started = time.monotonic()
+        now = datetime.now(timezone.utc)
+        days_back = (now.date() - day).days
+        instant = now - timedelta(days=days_back)
+        payload = {"day": day.isoformat()}
+        source_transaction = self._logger.transaction_event(EventType.SPAN_START, payload=payload,
+                                                            source_component="emporia: Backfill",
+                                                            transaction=self._transaction)
+        usages = []
+        return_code = 200
+        scopes = {(scale.value, Unit.KWH.value) for scale in scales}
+        if self._rollup is not None and any(self._rollup.produces(scale, Unit.KWH) for scale in scales):
+            # The rolled up scales come from the rollup source, _write_day derives them
+            scales = [scale for scale in scales if not self._rollup.produces(scale, Unit.KWH)]
+            if self._rollup.source not in scales:
+                scales.append(self._rollup.source)
+        if Scale.DAY in scales:
+            return_code, usages = self._get_emporia_data(emporia, days_back)
+        plan = [(scale, Unit.KWH, []) for scale in scales if scale != Scale.DAY]
+        if return_code == 200 and plan:
+            return_code, chart_usages, _ = self._get_chart_data(emporia, days_back, plan)
+            usages = usages + chart_usages
+        records = updated = deleted = errors = 0
+        if return_code == 200 and usages:
+            scopes.update((scale.value, Unit.KWH.value) for scale in scales)
+            return_code, records, updated, deleted, errors = self._write_day(instant, usages, scopes)
+
+        elapsed = time.monotonic() - started
+        payload.update({
+            "fetched": len(usages),
+            "records": records,
+            "updated": updated,
+            "deleted": deleted,
+            "errors": errors,
+            "seconds": round(elapsed, 3),
+            "records_per_second": round(len(usages) / elapsed, 1) if elapsed else 0,
+        })
+        self._logger.transaction_event(EventType.SPAN_END, transaction=source_transaction,
+                                       payload=payload, return_code=return_code)
+        return return_code, records, updated, deleted, errors
+
+    def close(self):
+        """Wait for in-flight local API writes and release the connection pools"""
+        if self._owns_sink:
+            self._sink.close()
+        if self._emporia is not None:
+            self._emporia.close()
+        if self._leases is not None:
+            self._leases.close()
+
+    def _get_emporia(self) -> Emporia:
+        # Kept warm between runs in daemon mode so tokens, topology and connections are reused
+        if self._emporia is None:
+            self._emporia = self._create_emporia()
+        return self._emporia
+
+    def _create_emporia(self) -> Emporia:
+        emporia = Emporia(self._account.username, self._account.password, self._account.client_id,
+                          token_cache_path=self._account.path(self._config.get("emporia.token_cache_path", "")),
+                          token_refresh_skew=self._config.get("emporia.token_refresh_skew", 300),
+                          topology_cache_path=self._account.path(self._config.get("emporia.topology_cache_path", "")),
+                          topology_ttl=self._config.get("emporia.topology_ttl", 86400),
+                          rate_limiter=self._create_rate_limiter(),
+                          chart_concurrency=self._config.get("chart_usage.concurrency", 8),
+                          api_root=self._config.get("emporia.api_root", ""),
+                          cognito_endpoint_url=self._config.get("emporia.cognito_endpoint_url", ""),
+                          failure_threshold=self._config.get("emporia.failure_threshold", 5),
+                          reset_timeout=self._config.get("emporia.reset_timeout", 30),
+                          latency_tolerance=self._config.get("emporia.latency_tolerance", 2.0),
+                          cognito_backend=self._config.get("emporia.cognito_backend", "boto3"))
+        if self._refresh_devices:
+            emporia.invalidate_devices()
+        return emporia
+
+    def _create_sink(self):
+        sink_type = self._config.get("sink.type", "http")
+        if sink_type == "postgres":
+            return PostgresSink(self._config.get("sink.postgres.dsn", "") or os.getenv("POSTGRES_DSN"),
+                                table=self._config.get("sink.postgres.table", "emporia"),
+                                create_schema=self._config.get("sink.postgres.create_schema", False))
+        if sink_type == "sqlite":
+            return SqliteSink(self._config.get("sink.sqlite.path", "~/.cache/emporia-collector/sink.db"),
+                              table=self._config.get("sink.sqlite.table", "emporia"))
+        if sink_type != "http":
+            raise ValueError(f"Unknown sink.type: {sink_type}")
+        return HttpSink(self._api_url, concurrency=self._config.get("local_api.concurrency", 8),
+                        batch_size=self._config.get("local_api.batch_size", 500))
+
+    def _create_chart_plan(self) -> list:
+        """[(scale, unit, channel names)] of chart_usage.plan, every entry needs both its scale and its unit"""
+        plan = self._config.get("chart_usage.plan", []) or []
+        if isinstance(plan, dict):
+            # Config turns a list of single-key entries into one dict, which only keeps the last of them
+            raise ValueError("chart_usage.plan entries need a scale and a unit, e.g. {scale: 1H, unit: KilowattHours}")
+        chart_plan = []
+        for entry in plan:
+            if not isinstance(entry, dict) or "scale" not in entry or "unit" not in entry:
+                raise ValueError(f"chart_usage.plan entry needs a scale and a unit: {entry}")
+            chart_plan.append((Scale(entry["scale"]), Unit(entry["unit"]), entry.get("channels") or []))
+        return chart_plan
+
+    def _create_rollup(self):
+        source = self._config.get("rollup.source", "")
+        if not source:
+            return None
+        source = Scale(source)
+        units = [unit for scale, unit, _ in self._chart_plan if scale == source]
+        if not units:
+            raise ValueError(f"rollup.source {source.value} is not a chart_usage.plan scale")
+        scales = [Scale(scale) for scale in self._config.get("rollup.scales", [])]
+        collected = [scale.value for scale in scales if (scale, units[0]) in
+                     {(plan_scale, unit) for plan_scale, unit, _ in self._chart_plan}]
+        if collected:
+            raise ValueError(f"Scales both collected in chart_usage.plan and rolled up: {', '.join(collected)}")
+        return Rollup(source, units[0], scales, missing=self._config.get("rollup.missing", "partial"),
+                      path=self._config.get("rollup.path", ""), account=self._account.name)
+
+    def _create_fetch_scopes(self) -> dict:
+        """{fetched scale: the (scale, unit) scopes written from it}, the rolled up scales go with their source"""
+        fetch_scopes = {}
+        if not self._rollup_days:
+            fetch_scopes[Scale.DAY.value] = {(Scale.DAY.value, Unit.KWH.value)}
+        for scale, unit, _ in self._chart_plan:
+            fetch_scopes.setdefault(scale.value, set()).add((scale.value, unit.value))
+        if self._rollup is not None:
+            fetch_scopes.setdefault(self._rollup.source.value, set()).update(
+                (scale.value, self._rollup.unit.value) for scale in self._rollup.scales)
+        return fetch_scopes
+
+    def _create_leases(self):
+        backend = self._config.get("leases.backend", "")
+        if not backend:
+            return None
+        owner = self._config.get("leases.owner", "") or None
+        ttl = self._config.get("leases.ttl", 300)
+        hold = self._config.get("leases.hold", 3000)
+        if backend == "sqlite":
+            return SqliteLeaseStore(self._config.get("leases.sqlite.path", "~/.cache/emporia-collector/leases.db"),
+                                    owner=owner, ttl=ttl, hold=hold)
+        if backend == "postgres":
+            return PostgresLeaseStore(self._config.get("leases.postgres.dsn", "") or os.getenv("POSTGRES_DSN"),
+                                      table=self._config.get("leases.postgres.table", "emporia_leases"),
+                                      owner=owner, ttl=ttl, hold=hold)
+        raise ValueError(f"Unknown leases.backend: {backend}")
+
+    def _create_rate_limiter(self):
+        requests_per_second = self._account.requests_per_second
+        if requests_per_second is None:
+            requests_per_second = self._config.get("emporia.requests_per_second", 0)
+        if not requests_per_second:
+            return None
+        return TokenBucket(requests_per_second, self._account.burst or self._config.get("emporia.burst", 0))
+
     def _call_and_update_day(self, emporia: Emporia, payload: dict, days_back: int) -> None:
-        return_code, instant, records, deleted, errors = self._load_day(emporia, days_back=days_back)
+        self._update_day(payload, days_back, self._load_day(emporia, days_back=days_back))
+
+    def _update_day(self, payload: dict, days_back: int, result: tuple) -> None:
+        """Add a loaded day to the payload, a day handed to the spool is reported by the drain that writes it"""
+        self._update_payload(payload, days_back, result, details=self._spool is None or result[0] != 200)
+
+    @staticmethod
+    def _update_payload(payload: dict, days_back: int, result: tuple, details: bool = True) -> None:
+        return_code, instant, records, updated, deleted, errors = result
         if return_code > payload['return_code']:
             payload['return_code'] = return_code
         payload['records'] += records
+        payload['updated'] += updated
         payload['deleted'] += deleted
         payload['errors'] += errors
-        payload['details'] = []
+        if not details:
+            return
         payload["details"].append(
             {
                 'days_back': days_back,
                 'instant': instant.isoformat(timespec="milliseconds").replace("+00:00", "Z"),
                 'records': records,
+                'updated': updated,
                 'deleted': deleted,
                 'errors': errors
             })
 
     def _load_day(self, emporia, days_back=0) -> tuple:
+        if self._leases is None:
+            return self._load_part(emporia, days_back)
+        # Batch after batch of the day's work units that no other replica holds, until there are none left
+        result = (200, datetime.now(timezone.utc) - timedelta(days=days_back), 0, 0, 0, 0)
+        attempted = set()
+        while True:
+            return_code, claimed = self._claim(emporia, days_back, attempted)
+            if not claimed:
+                return _sum_day_results(result, (return_code,) + result[1:2] + (0, 0, 0, 0))
+            attempted.update(claimed)
+            stop_heartbeat = self._start_heartbeat(claimed)
+            try:
+                part = self._load_part(emporia, days_back, claimed)
+            finally:
+                stop_heartbeat()
+            self._settle(claimed, part[0])
+            result = _sum_day_results(result, part)
+
+    def _load_part(self, emporia, days_back=0, claimed: dict = None) -> tuple:
+        """Load the day, or only the part of it in the claimed work units"""
         self._logger.message(self._transaction, message=f"staring _load_day with days_back: {days_back}", debug=True)
+        held = _held(claimed) if claimed is not None else None
         instant = datetime.now(timezone.utc) - timedelta(days=days_back)
         total_records = 0
         total_errors = 0
+        updated = 0
+        deleted = 0
+        scopes = _held_scopes(self._scopes, self._fetch_scopes, held)
+        if self._day_settled(days_back):
+            # The day's totals are final and already written, there is nothing left to pull for them
+            scopes.discard((Scale.DAY.value, Unit.KWH.value))
+            return_code, usages = 200, []
+        elif self._rollup_days or (held is not None and Scale.DAY.value not in held):
+            return_code, usages = 200, []
+        else:
+            return_code, usages = self._get_emporia_data(emporia, days_back, _held_panels(held, Scale.DAY))
+        chart_usages = []
+        since = {}
+        if return_code == 200 and self._chart_plan:
+            return_code, chart_usages, since = self._get_chart_data(emporia, days_back, None, True, held)
+        owned = self._owned(held, usages)
+        if claimed is not None and return_code == 200 and (usages or chart_usages):
+            return_code = self._check_claimed(claimed)
+            if not claimed:
+                return return_code, instant, total_records, updated, deleted, total_errors
+        if return_code == 200 and (usages or chart_usages) and self._spool is not None:
+            # Written by the drain stage, so a local API outage does not lose the fetch
+            return_code = self._spool_day(instant, usages, chart_usages, scopes, since, owned)
+        elif return_code == 200 and (usages or chart_usages):
+            return_code, total_records, updated, deleted, total_errors = self._write_day(
+                instant, usages + chart_usages, scopes, since, owned=owned)
+            if return_code == 200:
+                self._advance_watermarks(usages, chart_usages, partial=held is not None)
+        return return_code, instant, total_records, updated, deleted, total_errors
+
+    def _claim(self, emporia, days_back: int, attempted: set) -> tuple:
+        """Lease the next batch of the day's work units, (return_code, {unit: (panel gid, fetched scale)})
+
+        A unit is one panel's series of one fetched scale for the day, of this account.  The units attempted
+        earlier in the run are not claimed again, even when their lease was given back after a failure.
+        """
+        day = (datetime.now(timezone.utc) - timedelta(days=days_back)).date().isoformat()
+        settled = self._day_settled(days_back)
+        try:
+            units = {}
+            for scale in self._fetch_scopes:
+                if scale == Scale.DAY.value and settled:
+                    continue
+                for gid in emporia.panels:
+                    unit = f"{self._account.name}/{gid}/{day}/{scale}"
+                    if unit not in attempted:
+                        units[unit] = (gid, scale)
+            claimed = self._leases.acquire(list(units), self._lease_batch) if units else []
+            return 200, {unit: units[unit] for unit in claimed}
+        except Exception as ex:
+            self._logger.message(message="Exception leasing work units", exception=ex,
+                                 stack_trace=traceback.format_exc(), data={"days_back": days_back},
+                                 transaction=self._transaction)
+            return 500, {}
+
+    def _start_heartbeat(self, claimed: dict):
+        """Renew the leases of the claimed units every third of leases.ttl while they are worked on
+
+        Returns the function that stops the renewals, which blocks until the one in flight is done.
+        """
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(self._leases.ttl / 3):
+                try:
+                    self._leases.renew(list(claimed))
+                except Exception as ex:
+                    # The write is checked against the leases anyway, see _check_claimed
+                    self._logger.message(message="Exception renewing work units", exception=ex,
+                                         stack_trace=traceback.format_exc(), data={"units": len(claimed)},
+                                         transaction=self._transaction)
+
+        thread = threading.Thread(target=renew, name="lease-heartbeat", daemon=True)
+        thread.start()
+
+        def stop_heartbeat():
+            stop.set()
+            thread.join()
+
+        return stop_heartbeat
+
+    def _check_claimed(self, claimed: dict) -> int:
+        """Renew the claimed units right before they are written, dropping the part when any of them was lost
+
+        A unit is lost when its lease ran out and another replica claimed it, which writes it then.  The units
+        still held are given back and claimed is emptied, so the part is neither written nor completed.
+        """
+        try:
+            held = self._leases.renew(list(claimed))
+        except Exception as ex:
+            self._logger.message(message="Exception renewing work units", exception=ex,
+                                 stack_trace=traceback.format_exc(), data={"units": len(claimed)},
+                                 transaction=self._transaction)
+            claimed.clear()
+            return 500
+        if len(held) == len(claimed):
+            return 200
+        self._logger.message(self._transaction, message="Work units lost to another replica, part dropped",
+                             data={"lost": sorted(set(claimed) - set(held))})
+        self._settle(dict.fromkeys(held), 500)
+        claimed.clear()
+        return 200
+
+    def _settle(self, claimed: dict, return_code: int):
+        """Complete the units that were written, give the others back for a retry by any replica"""
+        if not claimed:
+            return
+        try:
+            if return_code == 200:
+                self._leases.complete(list(claimed))
+            else:
+                self._leases.release(list(claimed))
+        except Exception as ex:
+            # The leases run out on their own, the written units are at worst loaded again
+            self._logger.message(message="Exception settling work units", exception=ex,
+                                 stack_trace=traceback.format_exc(), data={"units": len(claimed)},
+                                 transaction=self._transaction)
+
+    def _spool_day(self, instant: datetime, usages: list, chart_usages: list, scopes: set, since: dict,
+                   owned: set = None) -> int:
+        try:
+            self._spool.append(instant, usages, chart_usages, scopes, since, owned)
+            return 200
+        except Exception as ex:
+            stack_trace = traceback.format_exc()
+            message = "Exception spooling Emporia data"
+            data = {
+                "instant": instant
+            }
+            self._logger.message(message=message, exception=ex, stack_trace=stack_trace, data=data,
+                                 transaction=self._transaction)
+            return 500
+
+    def _drain_spool(self, payload: dict):
+        """Replay the due spool segments to the local API, oldest first"""
+        drain_payload = {}
+        source_transaction = self._logger.transaction_event(EventType.SPAN_START, payload=drain_payload,
+                                                            source_component="emporia: Spool Drain",
+                                                            transaction=self._transaction)
+        segments = self._spool.due()
+        committed = 0
+        failed = 0
+        deferred = 0
+        # A newer segment written after an older one failed would be overwritten when the older one is replayed, so
+        # the rest of that day and rows waits for the next drain
+        blocked = set()
+        today = datetime.now(timezone.utc).date()
+        for segment in segments:
+            if segment.key in blocked:
+                deferred += 1
+                continue
+            usages, chart_usages = self._spool.load(segment.id)
+            return_code, records, updated, deleted, errors = self._write_day(
+                segment.instant, usages + chart_usages, segment.scopes, segment.since, as_of=segment.created,
+                owned=segment.owned)
+            if return_code == 200:
+                self._spool.commit(segment.id)
+                # Finality is judged at fetch time, the data is not any more final for having waited in the spool
+                self._advance_watermarks(usages, chart_usages, as_of=segment.created,
+                                         partial=segment.owned is not None)
+                committed += 1
+            else:
+                self._spool.fail(segment.id, segment.attempts, f"return_code: {return_code}, errors: {errors}")
+                blocked.add(segment.key)
+                failed += 1
+            self._update_payload(payload, (today - segment.instant.date()).days,
+                                 (return_code, segment.instant, records, updated, deleted, errors))
+        self._spool.purge(self._config.get("spool.retention_seconds", 86400))
+        drain_payload["due"] = len(segments)
+        drain_payload["committed"] = committed
+        drain_payload["failed"] = failed
+        drain_payload["deferred"] = deferred
+        drain_payload["pending"] = self._spool.pending()
+        self._logger.transaction_event(EventType.SPAN_END, transaction=source_transaction, payload=drain_payload,
+                                       return_code=500 if failed else 200)
+
+    def _write_day(self, instant: datetime, usages: list, scopes: set = None, since: dict = None,
+                   as_of: datetime = None, owned: set = None, local: tuple = None) -> tuple:
+        """Bring the local data for the day in line with the usages, limited to the (scale, unit) scopes
+
+        since maps (device_id, channel_num, scale, unit) to the first instant that was fetched for that series,
+        local rows before it were not re-fetched and are left alone.  owned limits the rows written and deleted to
+        those (device_id, scale, unit), see _owned.  With a rollup the day's rolled up records are written with it,
+        as of the time the usages were fetched (default now).  local is the (return_code, records) of a search of the
+        day's local data that was already made, to reuse instead of searching again.
+        """
+        scopes = scopes or self._scopes
+        owned = self._owned() if owned is None else owned
+        if self._rollup is None:
+            return self._write_records(instant, usages, scopes, since, owned, local)
+        rollup_result, rollups = self._write_rollups(instant, usages, as_of, owned)
+        return _sum_results(rollup_result, self._write_records(instant, usages + rollups,
+                                                               scopes - self._rollup.period_scopes, since, owned,
+                                                               local))
+
+    def _write_rollups(self, instant: datetime, usages: list, as_of: datetime = None, owned: set = None) -> tuple:
+        """Roll up the day's source series and write the WEEK/MONTH buckets it falls in, each under the day it
+        starts on.  Returns the result of those writes and the day's HOUR/DAY records, which are left to the
+        caller's write of the day."""
+        # One day at a time, a bucket is written from the daily totals of every day rolled up before it
+        with self._rollup_lock:
+            return_code, rollups, periods = self._roll_up(instant, usages, as_of)
+            results = [(return_code, 0, 0, 0, 0)]
+            for bucket, scale, records in periods:
+                results.append(self._write_records(bucket, records, {(scale, self._rollup.unit.value)}, None, owned))
+        return _sum_results(*results), rollups
+
+    def _roll_up(self, instant: datetime, usages: list, as_of: datetime = None) -> tuple:
+        return_code = 200
+        rollups = []
+        periods = []
+        payload = {"start_date": search_date(instant), "source": self._rollup.source.value,
+                   "scales": [scale.value for scale in self._rollup.scales]}
+        source_transaction = self._logger.transaction_event(EventType.SPAN_START, payload=payload,
+                                                            source_component="emporia: Rollup",
+                                                            transaction=self._transaction)
+        try:
+            rollups, periods = self._rollup.roll_up(instant, usages, as_of or datetime.now(timezone.utc))
+            payload["rollup_records"] = len(rollups) + sum(len(records) for _, _, records in periods)
+            metrics.RECORDS.add(payload["rollup_records"], metrics.ROLLED_UP)
+        except Exception as ex:
+            return_code = 500
+            payload["rollup_records"] = 0
+            stack_trace = traceback.format_exc()
+            message = "Exception rolling up Emporia data"
+            data = {
+                "instant": instant
+            }
+            self._logger.message(message=message, exception=ex, stack_trace=stack_trace, data=data,
+                                 transaction=source_transaction)
+        self._logger.transaction_event(EventType.SPAN_END, transaction=source_transaction,
+                                       payload=payload, return_code=return_code)
+        return return_code, rollups, periods
+
+    def _write_records(self, instant: datetime, usages: list, scopes: set, since: dict = None,
+                       owned: set = None, local: tuple = None) -> tuple:
+        usages = _owned_usages(usages, owned)
+        if self._sink.merges:
+            return self._merge_day(instant, usages, scopes, since, owned)
+        total_records = 0
+        total_errors = 0
+        updated = 0
         deleted = 0
-        return_code, usages = self._get_emporia_data(emporia, days_back)
-        if return_code == 200 and usages and len(usages) > 0:
+        return_code, response = local if local is not None else self._get_local_data(instant)
+        response = _in_owned(_in_window(response, since), owned)
+        if return_code == 200 and self._sync_mode == "diff":
+            # Only send the rows that actually changed since the last run
+            return_code, total_records, updated, deleted, total_errors = self._sync_local_data(response, usages,
+                                                                                               scopes)
+        elif return_code == 200:
             # First remove the local data
-            return_code, response = self._get_local_data(instant)
+            return_code, deleted, errors = self._delete_local_data(_in_scopes(response, scopes))
+            total_errors += errors
             if return_code == 200:
-                return_code, deleted, errors = self._delete_local_data(response)
+                # Load the local data
+                return_code, records_inserted, errors = self._load_emporia_data(usages)
+                total_records += records_inserted
                 total_errors += errors
-                if return_code == 200:
-                    # Load the local data
-                    return_code, records_inserted, errors = self._load_emporia_data(usages)
-                    total_records += records_inserted
-                    total_errors += errors
-        return return_code, instant, total_records, deleted, total_errors
-
-    def _get_emporia_data(self, emporia, days_back):
+        return return_code, total_records, updated, deleted, total_errors
+
+    async def _load_day_async(self, emporia, days_back=0) -> tuple:
+        if self._leases is None:
+            return await self._load_part_async(emporia, days_back)
+        result = (200, datetime.now(timezone.utc) - timedelta(days=days_back), 0, 0, 0, 0)
+        attempted = set()
+        while True:
+            return_code, claimed = await asyncio.to_thread(self._claim, emporia, days_back, attempted)
+            if not claimed:
+                return _sum_day_results(result, (return_code,) + result[1:2] + (0, 0, 0, 0))
+            attempted.update(claimed)
+            stop_heartbeat = self._start_heartbeat(claimed)
+            try:
+                part = await self._load_part_async(emporia, days_back, claimed)
+            finally:
+                # Waiting for a renewal in flight must not hold up the other days on the event loop
+                await asyncio.to_thread(stop_heartbeat)
+            await asyncio.to_thread(self._settle, claimed, part[0])
+            result = _sum_day_results(result, part)
+
+    async def _load_part_async(self, emporia, days_back=0, claimed: dict = None) -> tuple:
+        self._logger.message(self._transaction, message=f"staring _load_day_async with days_back: {days_back}",
+                             debug=True)
+        held = _held(claimed) if claimed is not None else None
+        instant = datetime.now(timezone.utc) - timedelta(days=days_back)
+        total_records = 0
+        total_errors = 0
+        updated = 0
+        deleted = 0
+        scopes = _held_scopes(self._scopes, self._fetch_scopes, held)
+        if self._day_settled(days_back):
+            scopes.discard((Scale.DAY.value, Unit.KWH.value))
+            fetch = _completed((200, []))
+        elif self._rollup_days or (held is not None and Scale.DAY.value not in held):
+            fetch = _completed((200, []))
+        else:
+            fetch = self._get_emporia_data_async(emporia, days_back, _held_panels(held, Scale.DAY))
+        # The Emporia fetches and the local search do not depend on each other.  A merging sink needs no search, and
+        # with the spool the drain stage searches when it writes the day
+        if self._sink.merges or self._spool is not None:
+            search = _completed(None)
+        else:
+            search = self._in_thread(self._get_local_data, instant)
+        (return_code, usages), (chart_code, chart_usages, since), local = await asyncio.gather(
+            fetch,
+            self._in_thread(self._get_chart_data, emporia, days_back, None, True, held),
+            search)
+        return_code = max(return_code, chart_code)
+        owned = self._owned(held, usages)
+        if claimed is not None and return_code == 200 and (usages or chart_usages):
+            return_code = await asyncio.to_thread(self._check_claimed, claimed)
+            if not claimed:
+                return return_code, instant, total_records, updated, deleted, total_errors
+        if return_code == 200 and (usages or chart_usages) and self._spool is not None:
+            return_code = await asyncio.to_thread(self._spool_day, instant, usages, chart_usages, scopes, since,
+                                                  owned)
+        elif return_code == 200 and (usages or chart_usages):
+            return_code, total_records, updated, deleted, total_errors = await self._in_thread(
+                self._write_day, instant, usages + chart_usages, scopes, since, None, owned, local)
+            if return_code == 200:
+                self._advance_watermarks(usages, chart_usages, partial=held is not None)
+        return return_code, instant, total_records, updated, deleted, total_errors
+
+    def _owned(self, held: dict = None, usages: list = None):
+        """(device_id, scale, unit) of the local rows this collector writes and deletes, None for every row
+
+        A leased part of the day ({fetched scale: panel gids}) owns the rows of its panels and their nested devices
+        in the scopes of its scales.  Otherwise an account that shares the sink with other accounts owns the rows of
+        its own devices.
+        """
+        if held is not None:
+            owned = set()
+            for scale, panels in held.items():
+                if scale == Scale.DAY.value and usages is not None:
+                    # Nested devices come with their panel's daily usage, which replica claimed a panel that turns
+                    # out to be nested cannot know before its first fetch, so only the devices returned are owned
+                    devices = {int(usage.device_gid) for usage in usages}
+                else:
+                    devices = [gid for gid in self._emporia.device_gids if self._emporia.panel_of(gid) in panels]
+                owned.update((gid, scope_scale, unit) for gid in devices
+                             for scope_scale, unit in self._fetch_scopes[scale])
+            return owned
+        if not self._account.isolated or self._emporia is None:
+            return None
+        return {(gid, scale, unit) for gid in self._emporia.device_gids for scale, unit in self._scopes}
+
+    def _day_settled(self, days_back: int) -> bool:
+        """True once a past day's totals are final and every channel's watermark has reached them"""
+        if self._state is None or days_back == 0:
+            return False
+        now = datetime.now(timezone.utc)
+        day_instant = (now - timedelta(days=days_back)).replace(hour=23, minute=59, second=59, microsecond=999)
+        if now < day_instant + self._grace:
+            return False
+        watermark = self._state.min_watermark(Scale.DAY.value, Unit.KWH.value)
+        return watermark is not None and watermark >= day_instant
+
+    def _advance_watermarks(self, usages: list, chart_usages: list, as_of: datetime = None, partial: bool = False):
+        """Record the intervals that were final when fetched (as_of, default now) and are now written
+
+        partial usages only cover some devices, the daily watermarks of the others are kept.
+        """
+        if self._state is None:
+            return
+        now = as_of or datetime.now(timezone.utc)
+        # The daily totals are stamped at the end of their day
+        day_marks = {}
+        for usage in usages:
+            if usage.instant + self._grace <= now:
+                day_marks[(usage.device_gid, str(usage.channel_num))] = usage.instant
+        if day_marks:
+            self._state.set_watermarks(Scale.DAY.value, Unit.KWH.value, day_marks, replace=not partial)
+        # Chart points are stamped at the start of their interval
+        chart_marks = {}
+        for usage in chart_usages:
+            if usage.instant + CHART_STEPS[Scale(usage.scale)] + self._grace <= now:
+                marks = chart_marks.setdefault((usage.scale, usage.unit), {})
+                key = (usage.device_gid, str(usage.channel_num))
+                if key not in marks or usage.instant > marks[key]:
+                    marks[key] = usage.instant
+        for (scale, unit), marks in chart_marks.items():
+            self._state.set_watermarks(scale, unit, marks)
+
+    async def _in_thread(self, function, *args):
+        """Run a blocking stage in a worker thread, bounded by the engine's concurrency"""
+        async with self._semaphore:
+            return await asyncio.to_thread(function, *args)
+
+    def _sync_local_data(self, local_records, usages, scopes: set = None) -> tuple:
+        """Reconcile the local records with the Emporia usages, sending only inserts, updates and deletes"""
+        inserts, updates, stale = self._plan_sync(local_records, usages, scopes)
+        insert_result = self._load_emporia_data(inserts) if inserts else (200, 0, 0)
+        update_result = self._update_local_data(updates) if updates else (200, 0, 0)
+        delete_result = self._delete_local_data(stale) if stale else (200, 0, 0)
+        return _merge_sync_results(insert_result, update_result, delete_result)
+
+    def _plan_sync(self, local_records, usages, scopes: set = None) -> tuple:
+        scopes = scopes or self._scopes
+        desired = {}
+        for usage in usages:
+            desired[usage.key()] = usage
+
+        existing = {}
+        stale = []
+        for record in local_records or []:
+            key = _record_key(record)
+            if key in existing or (key not in desired and (key[1], key[4]) in scopes):
+                # Either a duplicate of a row we are keeping or no longer reported by Emporia
+                stale.append(record)
+            elif key in desired:
+                existing[key] = record
+
+        inserts = []
+        updates = []
+        for key, usage in desired.items():
+            record = existing.get(key)
+            if record is None:
+                inserts.append(usage)
+            elif _record_differs(record, usage):
+                updates.append((record, usage))
+
+        self._logger.message(self._transaction, message="local sync plan", debug=True,
+                             data={"inserts": len(inserts), "updates": len(updates), "deletes": len(stale),
+                                   "unchanged": len(desired) - len(inserts) - len(updates)})
+        return inserts, updates, stale
+
+    def _get_emporia_data(self, emporia, days_back, gids: list = None):
         usages = []
         return_code = 200
         payload = {"days_back": days_back}
         source_transaction = self._logger.transaction_event(EventType.SPAN_START, payload=payload,
                                                         source_component="Emporia", transaction=self._transaction)
         try:
-            usages = emporia.get_usage(days_back=days_back)
+            usages = emporia.get_usage(days_back=days_back, gids=gids)
+            if usages:
+                payload["usage_records"] = len(usages)
+                metrics.RECORDS.add(len(usages), metrics.FETCHED)
+        except Exception as ex:
+            return_code = 500
+            payload["usage_records"] = 0
+            stack_trace = traceback.format_exc()
+            message = "Exception collecting Emporia data"
+            data = {
+                "days_back": days_back
+            }
+            self._logger.message(message=message, exception=ex, stack_trace=stack_trace, data=data,
+                                 transaction=source_transaction)
+        self._logger.transaction_event(EventType.SPAN_END, transaction=source_transaction,
+                                       payload=payload, return_code=return_code)
+        return return_code, usages
+
+    async def _get_emporia_data_async(self, emporia, days_back, gids: list = None):
+        usages = []
+        return_code = 200
+        payload = {"days_back": days_back}
+        source_transaction = self._logger.transaction_event(EventType.SPAN_START, payload=payload,
+                                                            source_component="Emporia", transaction=self._transaction)
+        try:
+            async with self._semaphore:
+                usages = await emporia.get_usage_async(days_back=days_back, gids=gids)
             if usages:
                 payload["usage_records"] = len(usages)
+                metrics.RECORDS.add(len(usages), metrics.FETCHED)
         except Exception as ex:
             return_code = 500
             payload["usage_records"] = 0
@@ -101,31 +880,75 @@ class EmporiaCollector:
                                        payload=payload, return_code=return_code)
         return return_code, usages
 
+    def _get_chart_data(self, emporia, days_back, plan: list = None, use_watermarks: bool = False,
+                        held: dict = None):
+        """Collect the chart_usage plan's series for the day, with held only the leased scales and panels
+
+        With use_watermarks each channel is only fetched from the interval after its watermark.  Returns the
+        since map of those per series start instants for _write_day.
+        """
+        plan = self._chart_plan if plan is None else plan
+        if held is not None:
+            plan = [entry for entry in plan if entry[0].value in held]
+        usages = []
+        since = {}
+        return_code = 200
+        if not plan:
+            return return_code, usages, since
+        now = datetime.now(timezone.utc)
+        start = (now - timedelta(days=days_back)).replace(hour=0, minute=0, second=0, microsecond=0)
+        end = min(start + timedelta(days=1), now)
+        payload = {"days_back": days_back,
+                   "series": [f"{scale.value}/{unit.value}" for scale, unit, _ in plan]}
+        source_transaction = self._logger.transaction_event(EventType.SPAN_START, payload=payload,
+                                                            source_component="Emporia Chart",
+                                                            transaction=self._transaction)
+        try:
+            for scale, unit, names in plan:
+                starts = {}
+                # The rollup source is always fetched for the whole day, its buckets need every interval
+                if use_watermarks and self._state is not None and not self._is_rollup_source(scale, unit):
+                    for (device_gid, channel_num), watermark in self._state.get_watermarks(scale.value,
+                                                                                           unit.value).items():
+                        channel_start = watermark + CHART_STEPS[scale]
+                        if channel_start > start:
+                            starts[(device_gid, channel_num)] = channel_start
+                            since[(device_gid, channel_num, scale.value, unit.value)] = channel_start
+                usages.extend(emporia.get_chart_usages(scale, unit, start, end, names, starts,
+                                                       _held_panels(held, scale)))
+            payload["usage_records"] = len(usages)
+            metrics.RECORDS.add(len(usages), metrics.FETCHED)
+        except Exception as ex:
+            return_code = 500
+            usages = []
+            payload["usage_records"] = 0
+            stack_trace = traceback.format_exc()
+            message = "Exception collecting Emporia chart data"
+            data = {
+                "days_back": days_back
+            }
+            self._logger.message(message=message, exception=ex, stack_trace=stack_trace, data=data,
+                                 transaction=source_transaction)
+        self._logger.transaction_event(EventType.SPAN_END, transaction=source_transaction,
+                                       payload=payload, return_code=return_code)
+        return return_code, usages, since
+
+    def _is_rollup_source(self, scale: Scale, unit: Unit) -> bool:
+        return self._rollup is not None and self._rollup.source == scale and self._rollup.unit == unit
+
     def _get_local_data(self, instant: datetime) -> tuple:
         return_code = 200
         payload = {}
         results = None
-        date_string = instant.isoformat(timespec="milliseconds").replace("+00:00", "Z")
-        payload["start_date"] = date_string
+        payload["start_date"] = search_date(instant)
         source_transaction = self._logger.transaction_event(EventType.SPAN_START, payload=payload,
                                                             source_component="emporia: Local Search",
                                                             transaction=self._transaction)
         try:
-            response = requests.post(self._api_url+"search", json=payload)
-            payload['status_code'] = str(response.status_code)
-            if response.status_code == 200:
-                results = response.json()
-                if results:
-                    payload['result_records'] = len(results)
-            else:
-                return_code = 500
-                payload['result_records'] = 0
-                message = "Exception collecting local data: Non-200 status code"
-                data = {
-                    "instant": instant
-                }
-                self._logger.message(message=message, data=data, transaction=source_transaction)
-        except requests.RequestException as ex:
+            results = self._sink.search(instant)
+            if results:
+                payload['result_records'] = len(results)
+        except Exception as ex:
             return_code = 500
             payload['result_records'] = 0
             stack_trace = traceback.format_exc()
@@ -133,108 +956,414 @@ class EmporiaCollector:
             data = {
                 "instant": instant
             }
+            if isinstance(ex, requests.HTTPError):
+                message = "Exception collecting local data: Non-200 status code"
+                payload['status_code'] = str(ex.response.status_code)
             self._logger.message(message=message, exception=ex, stack_trace=stack_trace, data=data,
                                  transaction=source_transaction)
         self._logger.transaction_event(EventType.SPAN_END, transaction=source_transaction,
                                        payload=payload, return_code=return_code)
         return return_code, results
 
+    def _merge_day(self, instant: datetime, usages: list, scopes: set, since: dict = None,
+                   owned: set = None) -> tuple:
+        """Write the day through a set based sink, which reconciles it in one transaction"""
+        return_code = 200
+        inserted = 0
+        updated = 0
+        deleted = 0
+        payload = {"start_date": search_date(instant), "total_records": len(usages)}
+        source_transaction = self._logger.transaction_event(EventType.SPAN_START, payload=payload,
+                                                            source_component="emporia: Local Merge",
+                                                            transaction=self._transaction)
+        try:
+            inserted, updated, deleted = self._sink.merge_day(instant, usages, scopes, since, owned)
+            payload['inserted'] = inserted
+            payload['updated'] = updated
+            payload['deleted'] = deleted
+            metrics.RECORDS.add(inserted, metrics.INSERTED)
+            metrics.RECORDS.add(updated, metrics.UPDATED)
+            metrics.RECORDS.add(deleted, metrics.DELETED)
+        except Exception as ex:
+            return_code = 500
+            stack_trace = traceback.format_exc()
+            message = "Exception merging local data"
+            data = {
+                "instant": instant
+            }
+            self._logger.message(message=message, exception=ex, stack_trace=stack_trace, data=data,
+                                 transaction=source_transaction)
+            metrics.RECORDS.add(len(usages), metrics.ERRORED)
+        self._logger.transaction_event(EventType.SPAN_END, transaction=source_transaction,
+                                       payload=payload, return_code=return_code)
+        return return_code, inserted, updated, deleted, 0 if return_code == 200 else len(usages)
+
     def _delete_local_data(self, response) -> tuple:
         payload = {}
-        return_code = 200
         total_records = len(response)
-        deleted = 0
-        errors = 0
         payload["total_records"] = total_records
         source_transaction = self._logger.transaction_event(EventType.SPAN_START, payload=payload,
                                                             source_component="emporia: Local Delete",
                                                             transaction=self._transaction)
 
-        for record in response:
-            try:
-                record_id = str(record['id'])
-                response = requests.delete(self._api_url + record_id)
-                if response.status_code == 200:
-                    deleted += 1
-                else:
-                    return_code = 500
-                    errors += 1
-                    message = "Exception deleting local data: Non-200 status code"
-                    data = {
-                        "record_id": record_id
-                    }
-                    self._logger.message(message=message, data=data, transaction=source_transaction)
-            except requests.RequestException as ex:
-                return_code = 500
-                errors = total_records - deleted
-                stack_trace = traceback.format_exc()
-                message = "Exception deleting local data"
-                self._logger.message(message=message, exception=ex, stack_trace=stack_trace,
-                                     transaction=source_transaction)
-        payload['deleted'] = deleted
-        payload['errors'] = errors
+        result = self._sink.delete(response)
+        return_code = self._log_write_failures(result, "deleting", "record_id", source_transaction)
+        payload['deleted'] = result.succeeded
+        payload['errors'] = result.errors
+        metrics.RECORDS.add(result.succeeded, metrics.DELETED)
+        metrics.RECORDS.add(result.errors, metrics.ERRORED)
         self._logger.transaction_event(EventType.SPAN_END, transaction=source_transaction,
                                        payload=payload, return_code=return_code)
 
-        return return_code, deleted, errors
+        return return_code, result.succeeded, result.errors
 
     def _load_emporia_data(self, usages):
         payload = {}
-        return_code = 200
         total_records = len(usages)
-        inserted = 0
-        errors = 0
         payload["total_records"] = total_records
         source_transaction = self._logger.transaction_event(EventType.SPAN_START, payload=payload,
                                                             source_component="emporia: Local Insert",
                                                             transaction=self._transaction)
 
-        for usage in usages:
-            # Convert 'instant' datetime to ISO 8601 string with UTC 'Z'
-            instant_iso = usage['instant'].astimezone(timezone.utc).isoformat().replace("+00:00", "Z")
-            name = usage.get("name", "")
-            payload = {
-                "instant": instant_iso,
-                "scale": usage.get("scale", ""),
-                "device_id": usage.get("deviceGid", 0),
-                "channel_num": usage.get("channelNum", ""),
-                "name": name,
-                "usage": usage.get("usage", 0),
-                "unit": usage.get("unit", ""),
-                "percentage": usage.get("percentage", 0)
-            }
-            try:
-                response = requests.post(self._api_url, json=payload)
-                if response.status_code == 200:
-                    inserted += 1
-                else:
-                    return_code = 500
-                    errors += 1
-                    message = "Exception inserting local data: Non-200 status code"
-                    data = {
-                        "name": name
-                    }
-                    self._logger.message(message=message, data=data, transaction=source_transaction)
-            except requests.RequestException as ex:
-                return_code = 500
-                errors = total_records - inserted
-                stack_trace = traceback.format_exc()
-                message = "Exception loading local data"
-                self._logger.message(message=message, exception=ex, stack_trace=stack_trace,
-                                     transaction=source_transaction)
+        result = self._sink.insert(usages)
+        for failure in result.failures:
+            # Report the failed insert by channel name rather than its position in the batch
+            failure["key"] = usages[failure["key"]].name
+        return_code = self._log_write_failures(result, "inserting", "name", source_transaction)
+        payload['inserted'] = result.succeeded
+        payload['errors'] = result.errors
+        metrics.RECORDS.add(result.succeeded, metrics.INSERTED)
+        metrics.RECORDS.add(result.errors, metrics.ERRORED)
+        self._logger.transaction_event(EventType.SPAN_END, transaction=source_transaction,
+                                       payload=payload, return_code=return_code)
+        return return_code, result.succeeded, result.errors
+
+    def _update_local_data(self, updates) -> tuple:
+        payload = {}
+        total_records = len(updates)
+        payload["total_records"] = total_records
+        source_transaction = self._logger.transaction_event(EventType.SPAN_START, payload=payload,
+                                                            source_component="emporia: Local Update",
+                                                            transaction=self._transaction)
 
-        payload['inserted'] = inserted
-        payload['errors'] = errors
+        result = self._sink.update(updates)
+        return_code = self._log_write_failures(result, "updating", "record_id", source_transaction)
+        payload['updated'] = result.succeeded
+        payload['errors'] = result.errors
+        metrics.RECORDS.add(result.succeeded, metrics.UPDATED)
+        metrics.RECORDS.add(result.errors, metrics.ERRORED)
         self._logger.transaction_event(EventType.SPAN_END, transaction=source_transaction,
                                        payload=payload, return_code=return_code)
-        return return_code, inserted, errors
+        return return_code, result.succeeded, result.errors
+
+    def _log_write_failures(self, result, action: str, key_name: str, source_transaction: dict) -> int:
+        for failure in result.failures:
+            data = {
+                key_name: failure["key"]
+            }
+            if failure["exception"] is not None:
+                message = f"Exception {action} local data"
+                self._logger.message(message=message, exception=failure["exception"], data=data,
+                                     transaction=source_transaction)
+            else:
+                message = f"Exception {action} local data: Non-200 status code"
+                data["status_code"] = failure["status_code"]
+                self._logger.message(message=message, data=data, transaction=source_transaction)
+        return 500 if result.failures else 200
+
+
+async def _completed(result):
+    return result
+
+
+def _in_window(records: list, since: dict) -> list:
+    """Drop the local records from before the fetched window of their series"""
+    if not since or not records:
+        return records
+    window = []
+    for record in records:
+        start = since.get((int(record.get("device_id", 0)), str(record.get("channel_num", "")),
+                           record.get("scale", ""), record.get("unit", "")))
+        if start is None or parse_instant(record['instant']) >= start:
+            window.append(record)
+    return window
+
+
+def _in_owned(records: list, owned: set) -> list:
+    """Only the local records of the owned (device_id, scale, unit), all of them when owned is None"""
+    if owned is None or not records:
+        return records
+    return [record for record in records
+            if (int(record.get("device_id", 0)), record.get("scale", ""), record.get("unit", "")) in owned]
+
+
+def _owned_usages(usages: list, owned: set) -> list:
+    if owned is None:
+        return usages
+    return [usage for usage in usages if (int(usage.device_gid), usage.scale, usage.unit) in owned]
+
+
+def _held(claimed: dict) -> dict:
+    """{fetched scale: panel gids} of the claimed work units"""
+    held = {}
+    for gid, scale in claimed.values():
+        held.setdefault(scale, set()).add(gid)
+    return held
+
+
+def _held_panels(held: dict, scale: Scale):
+    """The panels held for the fetched scale, None when the whole day is loaded"""
+    return None if held is None else sorted(held.get(scale.value, ()))
+
+
+def _held_scopes(scopes: set, fetch_scopes: dict, held: dict) -> set:
+    if held is None:
+        return set(scopes)
+    return {scope for scale in held for scope in fetch_scopes[scale] if scope in scopes}
+
+
+def _in_scopes(records: list, scopes: set) -> list:
+    return [record for record in records or [] if (record.get("scale", ""), record.get("unit", "")) in scopes]
+
+
+def _sum_results(*results) -> tuple:
+    """Combine the (return_code, records, updated, deleted, errors) of several writes"""
+    return (max(result[0] for result in results),) + tuple(map(sum, zip(*(result[1:] for result in results))))
+
+
+def _sum_day_results(total: tuple, result: tuple) -> tuple:
+    """Combine the (return_code, instant, records, updated, deleted, errors) of two parts of a day"""
+    return (max(total[0], result[0]), total[1]) + tuple(map(sum, zip(total[2:], result[2:])))
+
+
+def _merge_sync_results(insert_result: tuple, update_result: tuple, delete_result: tuple) -> tuple:
+    """Combine the (return_code, count, errors) of the insert, update and delete phases"""
+    return_code = max(insert_result[0], update_result[0], delete_result[0])
+    errors = insert_result[2] + update_result[2] + delete_result[2]
+    return return_code, insert_result[1], update_result[1], delete_result[1], errors
+
+
+def _record_key(record: dict) -> tuple:
+    """(instant, scale, device_id, channel_num, unit) key of a local API record"""
+    return (parse_instant(record['instant']), record.get("scale", ""), int(record.get("device_id", 0)),
+            str(record.get("channel_num", "")), record.get("unit", ""))
+
+
+def _record_differs(record: dict, usage: UsageRecord) -> bool:
+    if record.get("name", "") != usage.name:
+        return True
+    for field in ("usage", "percentage"):
+        old, new = record.get(field), getattr(usage, field)
+        if old is None or new is None:
+            if old is not new:
+                return True
+        elif not math.isclose(float(old), float(new), rel_tol=1e-9, abs_tol=1e-12):
+            return True
+    return False
+
+
+class MultiAccountCollector(object):
+    """Collects every account of load_accounts in one process, sharing the sink and the logger
+
+    Accounts run on a worker pool capped at accounts.concurrency, each with its own Emporia client, caches, state
+    and rate limit.  An account that fails is reported and does not stop the others.  The run's payload sums the
+    accounts and keeps each account's own payload under accounts.
+    """
+
+    def __init__(self, config, accounts: list, refresh_devices: bool = False):
+        self._logger = metrics.MeteredLogger(LoggingInfo(**config.get("logging_info", {})))
+        self._concurrency = max(1, config.get("accounts.concurrency", 4))
+        self._collectors = []
+        sink = None
+        for account in accounts:
+            collector = EmporiaCollector(config, refresh_devices=refresh_devices, account=account, sink=sink,
+                                         logger=self._logger)
+            # The first collector creates the sink, the others write through it
+            sink = sink or collector._sink
+            self._collectors.append(collector)
+        self._sink = sink
+
+    def process(self):
+        transaction = self._logger.transaction_event(EventType.TRANSACTION_START,
+                                                     payload={"accounts": len(self._collectors)})
+        with ThreadPoolExecutor(max_workers=self._concurrency, thread_name_prefix="account") as executor:
+            results = list(executor.map(lambda collector: self._collect(collector, transaction), self._collectors))
+        self._end(transaction, results)
+
+    async def process_async(self):
+        transaction = self._logger.transaction_event(EventType.TRANSACTION_START,
+                                                     payload={"accounts": len(self._collectors)})
+        semaphore = asyncio.Semaphore(self._concurrency)
+
+        async def collect(collector):
+            async with semaphore:
+                return await self._collect_async(collector, transaction)
+
+        results = await asyncio.gather(*[collect(collector) for collector in self._collectors])
+        self._end(transaction, results)
+
+    def close(self):
+        for collector in self._collectors:
+            collector.close()
+        if self._sink is not None:
+            self._sink.close()
+
+    def _collect(self, collector: EmporiaCollector, transaction: dict) -> dict:
+        span = self._start_account(collector, transaction)
+        try:
+            result = collector.collect(span)
+        except Exception as ex:
+            result = self._failed(collector, span, ex)
+        return self._end_account(collector, span, result)
+
+    async def _collect_async(self, collector: EmporiaCollector, transaction: dict) -> dict:
+        span = self._start_account(collector, transaction)
+        try:
+            result = await collector.collect_async(span)
+        except Exception as ex:
+            result = self._failed(collector, span, ex)
+        return self._end_account(collector, span, result)
+
+    def _start_account(self, collector: EmporiaCollector, transaction: dict) -> dict:
+        return self._logger.transaction_event(EventType.SPAN_START, payload={"account": collector.account.name},
+                                              source_component="emporia: Account", transaction=transaction)
+
+    def _end_account(self, collector: EmporiaCollector, span: dict, result: dict) -> dict:
+        payload = {key: result[key] for key in ("records", "updated", "deleted", "errors")}
+        payload["account"] = collector.account.name
+        self._logger.transaction_event(EventType.SPAN_END, transaction=span, payload=payload,
+                                       return_code=result["return_code"])
+        return result
+
+    def _failed(self, collector: EmporiaCollector, span: dict, ex: Exception) -> dict:
+        self._logger.message(message="Exception collecting account", exception=ex,
+                             stack_trace=traceback.format_exc(), data={"account": collector.account.name},
+                             transaction=span)
+        return {"return_code": 500, "records": 0, "updated": 0, "deleted": 0, "errors": 0, "details": [],
+                "error": str(ex)}
+
+    def _end(self, transaction: dict, results: list):
+        payload = {"records": 0, "updated": 0, "deleted": 0, "errors": 0, "accounts": {}}
+        return_code = 200
+        for collector, result in zip(self._collectors, results):
+            account_code = result.pop("return_code")
+            return_code = max(return_code, account_code)
+            for key in ("records", "updated", "deleted", "errors"):
+                payload[key] += result[key]
+            payload["accounts"][collector.account.name] = dict(result, return_code=account_code)
+        self._logger.transaction_event(EventType.TRANSACTION_END, transaction=transaction, payload=payload,
+                                       return_code=return_code)
+
+
+def run_daemon(collector: EmporiaCollector, config, use_async: bool = False):
+    """Run the collector on a cadence until SIGTERM/SIGINT, then drain the run in flight"""
+    logger = Logger(LoggingInfo(**config.get("logging_info", {})))
+    transaction = logger.transaction_event(EventType.TRANSACTION_START, payload={"mode": "daemon"})
+
+    def run():
+        with startup.phase("first run"):
+            if use_async:
+                asyncio.run(collector.process_async())
+            else:
+                collector.process()
+        startup.report()
+
+    def skipped():
+        logger.message(transaction, message="Skipping scheduled run, the previous run is still in progress")
+
+    scheduler = Scheduler(run, interval=config.get("daemon.interval", 3600), jitter=config.get("daemon.jitter", 0),
+                          run_immediately=config.get("daemon.run_immediately", True), on_skip=skipped)
+
+    def shutdown(signum, frame):
+        logger.message(transaction, message=f"Received signal {signum}, shutting down after the current run")
+        scheduler.stop()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    scheduler.run()
+    collector.close()
+    logger.transaction_event(EventType.TRANSACTION_END, transaction=transaction, return_code=200)
 
 
 def main():
-    load_dotenv()
-    config = Config()
-    collector = EmporiaCollector(config)
-    collector.process()
+    parser = argparse.ArgumentParser(description="Collect Emporia usage and load it to the local API")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="run the asyncio engine, loading the days concurrently")
+    parser.add_argument("--refresh-devices", action="store_true",
+                        help="ignore the cached device topology and download it again")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep running and collect on the daemon.interval cadence instead of once")
+    subparsers = parser.add_subparsers(dest="command")
+    backfill = subparsers.add_parser("backfill", help="load a historical date range, resuming where it stopped")
+    backfill.add_argument("--start", required=True, type=date.fromisoformat, help="first day (YYYY-MM-DD, UTC)")
+    backfill.add_argument("--end", type=date.fromisoformat, help="last day (YYYY-MM-DD, UTC), defaults to yesterday")
+    backfill.add_argument("--scales", default=Scale.DAY.value,
+                          help="comma separated scales, e.g. 1D,1H,15MIN (default: 1D)")
+    backfill.add_argument("--workers", type=int, help="days processed in parallel")
+    backfill.add_argument("--state-file", help="checkpoint file used to resume an interrupted backfill")
+    backfill.add_argument("--account", help="account to backfill, required when accounts.list has several")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="print the time spent on imports and initialization, per phase, after the first run")
+    args = parser.parse_args()
+
+    if args.profile_startup:
+        startup.enable(_IMPORTS_STARTED)
+    with startup.phase("config"):
+        load_dotenv()
+        config = Config()
+        accounts = load_accounts(config)
+    if args.command == "backfill":
+        if args.account:
+            accounts = [account for account in accounts if account.name == args.account]
+            if not accounts:
+                parser.error(f"unknown account: {args.account}")
+        elif len(accounts) > 1:
+            parser.error("backfill needs --account when several accounts are configured")
+        today = datetime.now(timezone.utc).date()
+        end = args.end or today - timedelta(days=1)
+        if end > today:
+            parser.error(f"--end {end} is in the future")
+        if args.start > end:
+            parser.error(f"--start {args.start} is after --end {end}")
+        try:
+            scales = [Scale(scale.strip()) for scale in args.scales.split(",") if scale.strip()]
+        except ValueError as ex:
+            parser.error(f"--scales: {ex}")
+        if not scales:
+            parser.error("--scales needs at least one scale")
+        with startup.phase("collector"):
+            collector = EmporiaCollector(config, refresh_devices=args.refresh_devices, account=accounts[0])
+        unsupported = [scale.value for scale in scales if scale not in collector.backfill_scales]
+        if unsupported:
+            collector.close()
+            parser.error(f"--scales {', '.join(unsupported)} can not be backfilled, only "
+                         f"{', '.join(sorted(scale.value for scale in collector.backfill_scales))}")
+        try:
+            collector.backfill(args.start, end, scales,
+                               workers=args.workers or config.get("backfill.workers", 4),
+                               state_path=args.state_file or accounts[0].path(config.get("backfill.state_path", "")))
+        finally:
+            collector.close()
+        startup.report()
+        return
+    with startup.phase("collector"):
+        if len(accounts) > 1:
+            collector = MultiAccountCollector(config, accounts, refresh_devices=args.refresh_devices)
+        else:
+            collector = EmporiaCollector(config, refresh_devices=args.refresh_devices, account=accounts[0])
+    if args.daemon:
+        run_daemon(collector, config, use_async=args.use_async)
+        return
+    try:
+        with startup.phase("first run"):
+            if args.use_async:
+                asyncio.run(collector.process_async())
+            else:
+                collector.process()
+    finally:
+        # Waits for the local API writes and frees the pools, the sink and the leases (Postgres advisory locks)
+        collector.close()
+    startup.report()
 
 if __name__ == "__main__":
     main()
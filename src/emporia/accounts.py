@@ -0,0 +1,59 @@
+import os
+
+DEFAULT_ACCOUNT = "default"
+
+
+class Account(object):
+    """One Emporia account collected by the process: its credentials, cache locations and rate limit
+
+    isolated accounts share the sink with other accounts, so they only reconcile the rows of their own devices.
+    """
+
+    def __init__(self, name: str, username: str, password: str, client_id: str, requests_per_second: float = None,
+                 burst: int = None, isolated: bool = False):
+        self.name = name
+        self.username = username
+        self.password = password
+        self.client_id = client_id
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.isolated = isolated
+
+    def __repr__(self):
+        return f"Account({self.name!r})"
+
+    def path(self, path: str) -> str:
+        """The account's own copy of a cache path: {account} in the path is replaced by the account name, otherwise
+        the file moves into a directory named after the account.  The default account keeps the path as is."""
+        if not path:
+            return path
+        if "{account}" in path:
+            return path.format(account=self.name)
+        if self.name == DEFAULT_ACCOUNT:
+            return path
+        return os.path.join(os.path.dirname(path), self.name, os.path.basename(path))
+
+
+def load_accounts(config) -> list:
+    """The accounts.list entries of the config, or the single default account from USERNAME, PASSWORD and
+    CLIENT_ID when there are none"""
+    entries = config.get("accounts.list", {}) or {}
+    if isinstance(entries, list):
+        # Entries with more than the name key are not normalized into a dict by Config
+        entries = {entry["name"]: entry for entry in entries}
+    if not entries:
+        return [Account(DEFAULT_ACCOUNT, os.getenv("USERNAME"), os.getenv("PASSWORD"), os.getenv("CLIENT_ID"))]
+    accounts = []
+    for name, settings in entries.items():
+        settings = settings or {}
+        prefix = name.upper().replace("-", "_")
+        accounts.append(Account(
+            name,
+            os.getenv(settings.get("username_env", f"{prefix}_USERNAME")),
+            os.getenv(settings.get("password_env", f"{prefix}_PASSWORD")),
+            os.getenv(settings.get("client_id_env", f"{prefix}_CLIENT_ID")),
+            requests_per_second=settings.get("requests_per_second"),
+            burst=settings.get("burst"),
+            isolated=True,
+        ))
+    return accounts
@@ -0,0 +1,47 @@
+import json
+import os
+import threading
+
+
+class Checkpoint(object):
+    """Completed work units of a long running job, persisted to a JSON state file so the job can resume"""
+
+    def __init__(self, path: str, job_key: str):
+        self._path = os.path.expanduser(path) if path else None
+        self._job_key = job_key
+        self._lock = threading.Lock()
+        self._completed = {}
+        self._load()
+
+    def is_done(self, unit: str) -> bool:
+        return unit in self._completed
+
+    def mark_done(self, unit: str, info: dict = None):
+        with self._lock:
+            self._completed[unit] = info or {}
+            self._save()
+
+    def _load(self):
+        if not self._path or not os.path.exists(self._path):
+            return
+        try:
+            with open(self._path, "r") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+        # A state file from a different job (range, scales...) does not apply to this one
+        if state.get("job") == self._job_key:
+            self._completed = state.get("completed", {})
+
+    def _save(self):
+        if not self._path:
+            return
+        directory = os.path.dirname(self._path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = f"{self._path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"job": self._job_key, "completed": self._completed}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self._path)
@@ -1,13 +1,105 @@
-import boto3
+import json
+import os
+import threading
 import time
+import requests
+from emporia import metrics, startup
+
+BACKENDS = ("boto3", "https")
+
+
+class CognitoError(Exception):
+    """Error answer of the Cognito API, code is its __type, e.g. NotAuthorizedException"""
+
+    def __init__(self, code, message, status_code=None):
+        super().__init__(f"{code}: {message}")
+        self.code = code
+        self.status_code = status_code
+
+
+class HttpsCognitoClient(object):
+    """Just the InitiateAuth call of boto3's cognito-idp client, as a plain HTTPS POST
+
+    USER_PASSWORD_AUTH and REFRESH_TOKEN_AUTH are public calls of the app client that need no SigV4 signature, so
+    neither boto3 nor botocore have to be imported for them.  Answers have the same shape as boto3's.
+    """
+
+    def __init__(self, region, endpoint_url=None, timeout=(6.03, 10.03)):
+        self._url = endpoint_url or f"https://cognito-idp.{region}.amazonaws.com/"
+        self._timeout = timeout
+        self._session = requests.Session()
+
+    def initiate_auth(self, AuthFlow, AuthParameters, ClientId, **kwargs):
+        body = dict(kwargs, AuthFlow=AuthFlow, AuthParameters=AuthParameters, ClientId=ClientId)
+        response = self._session.post(self._url, data=json.dumps(body), timeout=self._timeout, headers={
+            "Content-Type": "application/x-amz-json-1.1",
+            "X-Amz-Target": "AWSCognitoIdentityProviderService.InitiateAuth",
+        })
+        try:
+            data = response.json()
+        except ValueError:
+            data = {}
+        if response.status_code != 200:
+            # __type may carry a namespace, e.g. com.amazonaws...#NotAuthorizedException
+            code = data.get("__type", "").rsplit("#", 1)[-1] or f"HTTP {response.status_code}"
+            raise CognitoError(code, data.get("message") or data.get("Message") or response.text[:200],
+                               response.status_code)
+        return data
 
 
 class CognitoAuth:
-    def __init__(self, client_id, user_pool_id, region):
+    def __init__(self, client_id, user_pool_id, region, cache_path=None, refresh_skew=300, endpoint_url=None,
+                 backend="boto3"):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown Cognito backend: {backend}")
         self.client_id = client_id
         self.user_pool_id = user_pool_id
-        self.client = boto3.client("cognito-idp", region_name=region)
+        self._region = region
+        # endpoint_url points the client at a stand-in Cognito, e.g. the benchmark's
+        self._endpoint_url = endpoint_url or None
+        self._backend = backend
+        self._client = None
         self.tokens = None
+        self._cache_path = os.path.expanduser(cache_path) if cache_path else None
+        self._refresh_skew = refresh_skew
+        self._username = None
+        self._password = None
+        # Serializes refreshes so concurrent callers share a single in-flight refresh
+        self._lock = threading.RLock()
+
+    @property
+    def client(self):
+        """The cognito-idp client, created on first use: a run on cached tokens never imports boto3"""
+        if self._client is None:
+            with startup.phase("cognito client"):
+                if self._backend == "https":
+                    self._client = HttpsCognitoClient(self._region, self._endpoint_url)
+                else:
+                    import boto3
+                    self._client = boto3.client("cognito-idp", region_name=self._region,
+                                                endpoint_url=self._endpoint_url)
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+
+    def authenticate(self, username, password):
+        """Reuse cached tokens when possible, refreshing or logging in only when needed"""
+        self._username = username
+        self._password = password
+        with self._lock:
+            cached = self._load_cache(username)
+            if cached:
+                self.tokens = cached
+                if not self.needs_refresh():
+                    return self.tokens
+                try:
+                    return self.refresh_tokens()
+                except Exception:
+                    # The refresh token expired or was revoked, fall back to a full login
+                    pass
+            return self.login(username, password)
 
     def login(self, username, password):
         """Login with username/password and store tokens"""
@@ -19,7 +111,9 @@ class CognitoAuth:
             },
             ClientId=self.client_id,
         )
+        metrics.TOKEN_REFRESHES.add(1, {"flow": "login"})
 
+        self._username = username
         self.tokens = {
             "id_token": response["AuthenticationResult"]["IdToken"],
             "access_token": response["AuthenticationResult"]["AccessToken"],
@@ -27,29 +121,9 @@ class CognitoAuth:
             "expires_in": response["AuthenticationResult"]["ExpiresIn"],  # seconds
             "issued_at": int(time.time())
         }
+        self._save_cache()
         return self.tokens
 
-        client = boto3.client("cognito-idp", region_name="us-east-2")
-
-        # Start authentication
-        response = client.initiate_auth(
-            AuthFlow="USER_PASSWORD_AUTH",
-            AuthParameters={
-                "USERNAME": username,
-                "PASSWORD": password
-            },
-            ClientId=CLIENT_ID,
-        )
-
-        tokens = {
-            "id_token": response["AuthenticationResult"]["IdToken"],
-            "access_token": response["AuthenticationResult"]["AccessToken"],
-            "refresh_token": response["AuthenticationResult"]["RefreshToken"],
-        }
-
-
-
-
     def is_access_token_valid(self):
         """Check if the access token is still valid"""
         if not self.tokens:
@@ -57,40 +131,105 @@ class CognitoAuth:
         exp_time = self.tokens["issued_at"] + self.tokens["expires_in"]
         return int(time.time()) < exp_time
 
+    def needs_refresh(self):
+        """Check if the access token expires within the refresh skew window"""
+        if not self.tokens:
+            return True
+        exp_time = self.tokens["issued_at"] + self.tokens["expires_in"]
+        return int(time.time()) >= exp_time - self._refresh_skew
+
     def refresh_tokens(self):
         """Use the refresh token to get new tokens"""
-        if not self.tokens or "refresh_token" not in self.tokens:
-            raise Exception("No refresh token available")
-
-        response = self.client.initiate_auth(
-            AuthFlow="REFRESH_TOKEN_AUTH",
-            AuthParameters={
-                "REFRESH_TOKEN": self.tokens["refresh_token"]
-            },
-            ClientId=self.client_id,
-        )
-
-        # Cognito does not always return a new refresh_token
-        self.tokens.update({
-            "id_token": response["AuthenticationResult"]["IdToken"],
-            "access_token": response["AuthenticationResult"]["AccessToken"],
-            "expires_in": response["AuthenticationResult"]["ExpiresIn"],
-            "issued_at": int(time.time())
-        })
-        return self.tokens
+        with self._lock:
+            if not self.tokens or "refresh_token" not in self.tokens:
+                raise Exception("No refresh token available")
+
+            response = self.client.initiate_auth(
+                AuthFlow="REFRESH_TOKEN_AUTH",
+                AuthParameters={
+                    "REFRESH_TOKEN": self.tokens["refresh_token"]
+                },
+                ClientId=self.client_id,
+            )
+            metrics.TOKEN_REFRESHES.add(1, {"flow": "refresh"})
+
+            # Cognito does not always return a new refresh_token
+            self.tokens.update({
+                "id_token": response["AuthenticationResult"]["IdToken"],
+                "access_token": response["AuthenticationResult"]["AccessToken"],
+                "expires_in": response["AuthenticationResult"]["ExpiresIn"],
+                "issued_at": int(time.time())
+            })
+            if "RefreshToken" in response["AuthenticationResult"]:
+                self.tokens["refresh_token"] = response["AuthenticationResult"]["RefreshToken"]
+            self._save_cache()
+            return self.tokens
+
+    def refresh_rejected(self, id_token):
+        """Refresh after the API rejected id_token, unless another caller has already replaced it
+
+        Concurrent requests that all got a 401 for the same token share one refresh.
+        """
+        with self._lock:
+            if self.tokens and id_token and self.tokens.get("id_token") != id_token:
+                return self.tokens
+            try:
+                return self.refresh_tokens()
+            except Exception:
+                if not self._password:
+                    raise
+                return self.login(self._username, self._password)
 
     def get_access_token(self):
         """Return a valid access token, refreshing if needed"""
-        if not self.is_access_token_valid():
-            print("🔄 Access token expired — refreshing...")
-            self.refresh_tokens()
+        self._ensure_fresh()
         return self.tokens["access_token"]
 
-
     def get_id_token(self):
-        """Return a valid access token, refreshing if needed"""
-        if not self.is_access_token_valid():
-            print("🔄 Access token expired — refreshing...")
-            self.refresh_tokens()
+        """Return a valid id token, refreshing if needed"""
+        self._ensure_fresh()
         return self.tokens["id_token"]
 
+    def _ensure_fresh(self):
+        if not self.needs_refresh():
+            return
+        with self._lock:
+            # Another caller may have refreshed while we waited for the lock
+            if not self.needs_refresh():
+                return
+            print("🔄 Access token expiring — refreshing...")
+            try:
+                self.refresh_tokens()
+            except Exception:
+                if not self._password:
+                    raise
+                self.login(self._username, self._password)
+
+    def _load_cache(self, username):
+        if not self._cache_path or not os.path.exists(self._cache_path):
+            return None
+        try:
+            with open(self._cache_path, "r") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cached.get("username") != username or cached.get("client_id") != self.client_id:
+            return None
+        return cached.get("tokens")
+
+    def _save_cache(self):
+        if not self._cache_path:
+            return
+        try:
+            directory = os.path.dirname(self._cache_path)
+            if directory:
+                os.makedirs(directory, mode=0o700, exist_ok=True)
+            # Write to a private temporary file and rename it so readers never see a partial cache
+            temp_path = f"{self._cache_path}.{os.getpid()}.tmp"
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump({"username": self._username, "client_id": self.client_id, "tokens": self.tokens}, f)
+            os.replace(temp_path, self._cache_path)
+        except OSError as ex:
+            # The cache is only an optimization, the tokens in memory are still good
+            print(f"Unable to write token cache {self._cache_path}: {ex}")
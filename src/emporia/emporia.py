@@ -1,8 +1,18 @@
+import asyncio
+import ijson
+import json
+import os
 import requests
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
+from itertools import chain
+from requests.adapters import HTTPAdapter
 from emporia.cognito_auth import CognitoAuth
+from emporia import metrics, startup
 from emporia.enums import Scale, Unit
+from emporia.records import UsageRecord
+from emporia.resilience import AdaptiveLimit, circuit_breaker, full_jitter, retry_after
 
 
 USER_POOL_ID = 'us-east-2_ghlOXVLi1'
@@ -12,9 +22,22 @@ API_CUSTOMER_DEVICES = "customers/devices"
 API_DEVICES_USAGE = "AppAPI?apiMethod=getDeviceListUsages&deviceGids={deviceGids}&instant={instant}&scale={scale}&energyUnit={unit}"
 API_CHART_USAGE = "AppAPI?apiMethod=getChartUsage&deviceGid={deviceGid}&channel={channel}&start={start}&end={end}&scale={scale}&energyUnit={unit}"
 
+# Interval between the points of a getChartUsage series, for the scales with a fixed length
+CHART_STEPS = {
+    Scale.SECOND: timedelta(seconds=1),
+    Scale.MINUTE: timedelta(minutes=1),
+    Scale.MINUTES_15: timedelta(minutes=15),
+    Scale.HOUR: timedelta(hours=1),
+    Scale.DAY: timedelta(days=1),
+}
+
 class Emporia(object):
-    def __init__(self, username, password, client_id):
+    def __init__(self, username, password, client_id, token_cache_path=None, token_refresh_skew=300,
+                 topology_cache_path=None, topology_ttl=86400, rate_limiter=None, chart_concurrency=8,
+                 api_root=API_ROOT, cognito_endpoint_url=None, failure_threshold=5, reset_timeout=30.0,
+                 latency_tolerance=2.0, cognito_backend="boto3"):
         self._username = username
+        self._api_root = (api_root or API_ROOT).rstrip("/")
         self._password = password
         self._pool_wellknown_jwks = None
         self._max_retry_attempts = 5
@@ -25,11 +48,53 @@ class Emporia(object):
         self._connect_timeout = 6.03
         self._read_timeout = 10.03
         self._channels = {}
+        self._channels_by_name = {}
         self._gids = {}
-        self._cognito = CognitoAuth(client_id, USER_POOL_ID, REGION)
-        self._cognito.login(username, password)
+        # Devices nested under another device of _gids, which their usage comes with
+        self._parents = {}
+        self._topology_cache_path = os.path.expanduser(topology_cache_path) if topology_cache_path else None
+        self._topology_ttl = topology_ttl
+        self._rate_limiter = rate_limiter
+        self._chart_executor = ThreadPoolExecutor(max_workers=max(1, chart_concurrency), thread_name_prefix="chart")
+        # Keep-alive connections to the API host, one per chart worker plus the day and topology calls
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, chart_concurrency) + 2)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._breaker = circuit_breaker(self._api_root, failure_threshold, reset_timeout)
+        self._limit = AdaptiveLimit(max(1, chart_concurrency) + 2, tolerance=latency_tolerance)
+        self._cognito = CognitoAuth(client_id, USER_POOL_ID, REGION, cache_path=token_cache_path,
+                                    refresh_skew=token_refresh_skew, endpoint_url=cognito_endpoint_url,
+                                    backend=cognito_backend)
+        with startup.phase("cognito auth"):
+            self._cognito.authenticate(username, password)
+
+    @property
+    def device_gids(self) -> set:
+        """Every device of the account, the panels and the devices nested under them"""
+        if len(self._channels) == 0:
+            self.get_devices()
+        return set(self._gids) | set(self._parents) | {channel['deviceGid'] for channel in self._channels.values()}
+
+    @property
+    def panels(self) -> list:
+        """The devices whose usage getDeviceListUsages is asked for, nested devices come with their parent's"""
+        if len(self._gids) == 0:
+            self.get_devices()
+        return [gid for gid in self._gids if gid not in self._parents]
+
+    def panel_of(self, device_gid: int) -> int:
+        """The panel device_gid is nested under, or device_gid itself"""
+        return self._parents.get(device_gid, device_gid)
+
+    def get_devices(self, force_refresh: bool = False):
+        """Load the device and channel topology, from the on-disk cache while it is within its TTL"""
+        with startup.phase("topology"):
+            return self._get_devices(force_refresh)
 
-    def get_devices(self):
+    def _get_devices(self, force_refresh: bool):
+        if not force_refresh and self._load_topology_cache():
+            return []
         response = self._request(API_CUSTOMER_DEVICES)
         response.raise_for_status()
         devices = []
@@ -38,6 +103,9 @@ class Emporia(object):
         data = response.json()
         if "devices" not in data:
             return devices
+        self._gids = {}
+        self._channels = {}
+        self._parents = {}
         for dev in data["devices"]:
             if 'locationProperties' in dev and 'displayName' in dev['locationProperties']:
                 name = dev['locationProperties']['displayName']
@@ -53,52 +121,142 @@ class Emporia(object):
                 for channel in channels:
                     channel_id = f"{channel['deviceGid']}_{channel['channelNum']}"
                     self._channels[channel_id] = channel
+                    if channel['deviceGid'] != dev['deviceGid']:
+                        self._parents[channel['deviceGid']] = dev['deviceGid']
+        self._index_channels()
+        self._save_topology_cache()
         return devices
 
-    def get_usage(self, scale:Scale = Scale.DAY, unit:Unit = Unit.KWH, days_back:int = 0):
+    def invalidate_devices(self):
+        """Forget the cached topology so the next call downloads it again"""
+        self._gids = {}
+        self._channels = {}
+        self._channels_by_name = {}
+        self._parents = {}
+        if self._topology_cache_path and os.path.exists(self._topology_cache_path):
+            os.remove(self._topology_cache_path)
+
+    def _index_channels(self):
+        self._channels_by_name = {}
+        for channel in self._channels.values():
+            self._channels_by_name.setdefault(channel.get('name'), []).append(channel)
+
+    def _load_topology_cache(self) -> bool:
+        if not self._topology_cache_path or not os.path.exists(self._topology_cache_path):
+            return False
+        try:
+            with open(self._topology_cache_path, "r") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if cached.get("username") != self._username or time.time() - cached.get("fetched_at", 0) > self._topology_ttl:
+            return False
+        self._gids = {int(gid): name for gid, name in cached["gids"]}
+        self._channels = {f"{channel['deviceGid']}_{channel['channelNum']}": channel for channel in cached["channels"]}
+        self._parents = {int(gid): int(parent) for gid, parent in cached.get("parents", [])}
+        self._index_channels()
+        return True
+
+    def _save_topology_cache(self):
+        if not self._topology_cache_path:
+            return
+        cached = {
+            "username": self._username,
+            "fetched_at": time.time(),
+            "gids": list(self._gids.items()),
+            "channels": list(self._channels.values()),
+            "parents": list(self._parents.items()),
+        }
+        try:
+            directory = os.path.dirname(self._topology_cache_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            temp_path = f"{self._topology_cache_path}.{os.getpid()}.tmp"
+            with open(temp_path, "w") as f:
+                json.dump(cached, f)
+            os.replace(temp_path, self._topology_cache_path)
+        except OSError as ex:
+            print(f"Unable to write topology cache {self._topology_cache_path}: {ex}")
+
+    def get_usage(self, scale:Scale = Scale.DAY, unit:Unit = Unit.KWH, days_back:int = 0, gids: list = None):
+        return list(self.iter_usage(scale, unit, days_back, gids))
+
+    def iter_usage(self, scale:Scale = Scale.DAY, unit:Unit = Unit.KWH, days_back:int = 0, gids: list = None):
+        """Yield the usage of every channel (of the gids devices only) as the getDeviceListUsages response is
+        decoded"""
         if len(self._gids) == 0:
             self.get_devices()
-        gids = "+".join(map(str, self._gids))
+        instant, path = self._usage_path(scale, unit, days_back, gids)
+        response = self._request(path, stream=True)
+        with response:
+            response.raise_for_status()
+            yield from self._iter_response_usage(response, instant, scale.value, unit.value)
+
+    async def get_usage_async(self, scale:Scale = Scale.DAY, unit:Unit = Unit.KWH, days_back:int = 0,
+                              gids: list = None):
+        """Async counterpart of get_usage"""
+        if len(self._gids) == 0:
+            await asyncio.to_thread(self.get_devices)
+        instant, path = self._usage_path(scale, unit, days_back, gids)
+        response = await self._request_async(path, stream=True)
+        with response:
+            response.raise_for_status()
+            usages = await asyncio.to_thread(
+                list, self._iter_response_usage(response, instant, scale.value, unit.value))
+        return usages
+
+    def _usage_path(self, scale: Scale, unit: Unit, days_back: int, gids: list = None) -> tuple:
+        gids = "+".join(map(str, self._gids if gids is None else gids))
         instant = ((datetime.now(timezone.utc) - timedelta(days=days_back))
                    .replace(hour=23, minute=59, second=59, microsecond=999))
         path = API_DEVICES_USAGE.format(
             deviceGids=gids, instant=_format_time(instant), scale=scale.value, unit=unit.value
         )
-        response = self._request(path)
-        response.raise_for_status()
-        usages = self._load_usage(instant, scale.value, unit.value, response.json())
-        return usages
+        return instant, path
 
-    def _load_usage(self, instant, scale, unit, usage):
-        usages = []
-        if 'deviceListUsages' in usage and 'devices' in usage['deviceListUsages']:
-            for device in usage['deviceListUsages']['devices']:
-                if 'channelUsages' in device:
-                    for usage in device['channelUsages']:
-                        if usage['name'] == 'Main':
-                            usage['name'] = self._gids[usage['deviceGid']]
-                        usages.append(usage)
-                        if 'nestedDevices' in usage:
-                            for nested_device in usage['nestedDevices']:
-                                if 'channelUsages' in nested_device:
-                                    for nested_usage in nested_device['channelUsages']:
-                                        if nested_usage['name'] == 'Main':
-                                            nested_usage['name'] = self._gids[nested_usage['deviceGid']]
-                                        usages.append(nested_usage)
-                else:
-                    print('no channelUsages')
-
-        for usage in usages:
-            usage['instant'] = instant
-            usage['scale'] = scale
-            usage['unit'] = unit
-            if 'nestedDevices' in usage:
-                usage.pop('nestedDevices')
-        return usages
+    def _iter_response_usage(self, response: requests.Response, instant: datetime, scale: str, unit: str):
+        # Decode the channels one at a time straight off the socket instead of loading the whole document
+        response.raw.decode_content = True
+        channel_usages = ijson.items(response.raw, 'deviceListUsages.devices.item.channelUsages.item',
+                                     use_float=True)
+        return self._iter_usage(channel_usages, instant, scale, unit)
+
+    def _iter_usage(self, channel_usages, instant: datetime, scale: str, unit: str):
+        """Yield a UsageRecord per channel, walking the nestedDevices of the channels to any depth"""
+        refreshed = False
+        stack = [iter(channel_usages)]
+        panel = None
+        while stack:
+            # Depth first, a channel is followed by the channels of the devices nested under it
+            for channel_usage in stack[-1]:
+                if len(stack) == 1:
+                    panel = channel_usage.get('deviceGid')
+                    if not refreshed and panel not in self._gids:
+                        # A usage for a device we have never seen means the cached topology is stale
+                        self.invalidate_devices()
+                        self.get_devices(force_refresh=True)
+                        refreshed = True
+                yield self._usage_record(channel_usage, instant, scale, unit)
+                nested_devices = channel_usage.get('nestedDevices')
+                if nested_devices:
+                    for nested_device in nested_devices:
+                        if nested_device.get('deviceGid') is not None:
+                            self._parents[nested_device['deviceGid']] = panel
+                    stack.append(chain.from_iterable(nested_device.get('channelUsages') or []
+                                                     for nested_device in nested_devices))
+                    break
+            else:
+                stack.pop()
+
+    def _usage_record(self, channel_usage: dict, instant: datetime, scale: str, unit: str) -> UsageRecord:
+        name = channel_usage.get('name')
+        if name == 'Main':
+            name = self._gids.get(channel_usage['deviceGid'], name)
+        return UsageRecord(instant, scale, unit, channel_usage.get('deviceGid', 0), channel_usage.get('channelNum', ""),
+                           name or "", channel_usage.get('usage', 0), channel_usage.get('percentage', 0))
 
-    def get_chart_usage(self, name:str = 'Pond', start: datetime = None, end: datetime = None):
-        scale = Scale.DAY.value
-        unit = Unit.USD.value
+    def get_chart_usage(self, name:str = 'Pond', start: datetime = None, end: datetime = None,
+                        scale: Scale = Scale.DAY, unit: Unit = Unit.USD):
         if not start:
             start = datetime.now(timezone.utc) - timedelta(days=30)
         if not end:
@@ -106,39 +264,140 @@ class Emporia(object):
         if len(self._channels) == 0:
             self.get_devices()
 
-        for key, channel in self._channels.items():
-            if channel['name'] == name:
-                path = API_CHART_USAGE.format(
-                    deviceGid=channel['deviceGid'],
-                    channel=channel['channelNum'],
-                    start=_format_time(start),
-                    end=_format_time(end),
-                    scale=scale,
-                    unit=unit,
-                )
-                response = self._request(path)
-                response.raise_for_status()
-                return response.json()
+        channels = self._channels_by_name.get(name)
+        if channels:
+            return self._chart_request(channels[0], scale, unit, start, end)
         return None
 
+    def get_chart_usages(self, scale: Scale, unit: Unit, start: datetime, end: datetime, names: list = None,
+                         starts: dict = None, panels: set = None) -> list:
+        """getChartUsage for every channel (or only the named ones) in parallel, flattened into usage records
+
+        starts optionally overrides the start per (deviceGid, channelNum); channels whose start is not before end
+        are not requested at all.  panels limits the channels to those of the panels and the devices nested under
+        them.
+        """
+        if scale not in CHART_STEPS:
+            raise ValueError(f"getChartUsage collection does not support scale {scale.value}")
+        if len(self._channels) == 0:
+            self.get_devices()
+        starts = starts or {}
+        selected = []
+        for channel in self._channels.values():
+            if names and channel.get('name') not in names:
+                continue
+            if panels is not None and self.panel_of(channel['deviceGid']) not in panels:
+                continue
+            channel_start = starts.get((channel['deviceGid'], str(channel['channelNum'])), start)
+            if channel_start < end:
+                selected.append((channel, channel_start))
+        results = self._chart_executor.map(
+            lambda item: self.get_channel_usage(item[0], scale, unit, item[1], end), selected)
+        usages = []
+        for channel_usages in results:
+            usages.extend(channel_usages)
+        return usages
+
+    def get_channel_usage(self, channel: dict, scale: Scale, unit: Unit, start: datetime, end: datetime) -> list:
+        data = self._chart_request(channel, scale, unit, start, end)
+        return self._load_chart_usage(channel, scale, unit, data)
+
+    def _chart_request(self, channel: dict, scale: Scale, unit: Unit, start: datetime, end: datetime) -> dict:
+        path = API_CHART_USAGE.format(
+            deviceGid=channel['deviceGid'],
+            channel=channel['channelNum'],
+            start=_format_time(start),
+            end=_format_time(end),
+            scale=scale.value,
+            unit=unit.value,
+        )
+        response = self._request(path)
+        response.raise_for_status()
+        return response.json()
+
+    def _load_chart_usage(self, channel: dict, scale: Scale, unit: Unit, data: dict) -> list:
+        usages = []
+        if not data or not data.get('firstUsageInstant') or not data.get('usageList'):
+            return usages
+        first = datetime.fromisoformat(data['firstUsageInstant'].replace("Z", "+00:00"))
+        step = CHART_STEPS[scale]
+        name = channel.get('name')
+        if not name or name == 'Main':
+            name = self._gids.get(channel['deviceGid'], 'Main')
+        device_gid = channel['deviceGid']
+        channel_num = channel['channelNum']
+        for index, value in enumerate(data['usageList']):
+            # Intervals Emporia has no data for (yet) come back as null and are not recorded
+            if value is None:
+                continue
+            usages.append(UsageRecord(first + step * index, scale.value, unit.value, device_gid, channel_num, name,
+                                      value))
+        return usages
+
+    def close(self):
+        self._chart_executor.shutdown(wait=True)
+        self._session.close()
+
     def _request(self, path: str, method: str = 'get', **kwargs) -> requests.Response:
-        response = None
+        """Call the API, retrying 401s after a token refresh, 429s after their Retry-After, and 5xx responses and
+        network errors after a full jitter backoff.  The last attempt's response is returned as is."""
         attempts = 0
-        while attempts < self._max_retry_attempts:
+        while True:
             attempts += 1
-            response = self._make_request(path, method, **kwargs)
-            if response.status_code == 401:
-                # if unauthorized, try refreshing the tokens
-                self._cognito.refresh_tokens()
+            try:
                 response = self._make_request(path, method, **kwargs)
-            if response.status_code >= 500:
-                # if server error, retry with exponential backoff
-                delay = min(self._initial_retry_delay * (2 ** (attempts - 1)), self._max_retry_delay)
-                time.sleep(delay)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempts >= self._max_retry_attempts:
+                    raise
+                time.sleep(self._retry_delay(attempts, None, metrics.RETRY_NETWORK_ERROR))
                 continue
-            if response.status_code < 500:
+            if attempts >= self._max_retry_attempts:
+                return response
+            if response.status_code == 401:
+                response.close()
+                metrics.RETRIES.add(1, metrics.RETRY_UNAUTHORIZED)
+                self._cognito.refresh_rejected(_auth_token(response))
+            elif response.status_code == 429 or response.status_code >= 500:
+                response.close()
+                time.sleep(self._retry_delay(attempts, response))
+            else:
+                return response
+
+    async def _request_async(self, path: str, method: str = 'get', **kwargs) -> requests.Response:
+        """Async counterpart of _request, the blocking HTTP call runs in a worker thread"""
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                response = await asyncio.to_thread(self._make_request, path, method, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempts >= self._max_retry_attempts:
+                    raise
+                await asyncio.sleep(self._retry_delay(attempts, None, metrics.RETRY_NETWORK_ERROR))
+                continue
+            if attempts >= self._max_retry_attempts:
+                return response
+            if response.status_code == 401:
+                response.close()
+                metrics.RETRIES.add(1, metrics.RETRY_UNAUTHORIZED)
+                await asyncio.to_thread(self._cognito.refresh_rejected, _auth_token(response))
+            elif response.status_code == 429 or response.status_code >= 500:
+                response.close()
+                await asyncio.sleep(self._retry_delay(attempts, response))
+            else:
                 return response
-        return response
+
+    def _retry_delay(self, attempts: int, response, reason: dict = None) -> float:
+        """Seconds to wait before the next attempt, what a 429 asks for or else a full jitter backoff"""
+        delay = retry_after(response) if response is not None and response.status_code == 429 else None
+        if delay is None:
+            delay = full_jitter(attempts, self._initial_retry_delay, self._max_retry_delay)
+        delay = min(delay, self._max_retry_delay)
+        if reason is None:
+            reason = metrics.RETRY_RATE_LIMITED if response.status_code == 429 else metrics.RETRY_SERVER_ERROR
+        metrics.RETRIES.add(1, reason)
+        metrics.BACKOFF.add(delay)
+        return delay
 
     def _make_request(self, path: str, method: str, **kwargs) -> requests.Response:
         headers = kwargs.get("headers")
@@ -147,14 +406,47 @@ class Emporia(object):
         else:
             headers = dict(headers)
         headers["authtoken"] = self._cognito.get_id_token()
-        url = f"{API_ROOT}/{path}"
-        return requests.request(
-            method,
-            url,
-            **kwargs,
-            headers=headers,
-            timeout=(self._connect_timeout, self._read_timeout),
-        )
+        # Fail fast while the host's circuit is open, before spending a rate limit token on it
+        self._breaker.before_call()
+        if self._rate_limiter is not None:
+            self._rate_limiter.acquire()
+        url = f"{self._api_root}/{path}"
+        # customers/devices, or the AppAPI method without its per-call parameters
+        route = path.split("&", 1)[0]
+        self._limit.acquire()
+        started = time.perf_counter()
+        try:
+            response = self._session.request(
+                method,
+                url,
+                **kwargs,
+                headers=headers,
+                timeout=(self._connect_timeout, self._read_timeout),
+            )
+        except Exception as ex:
+            self._breaker.record_failure()
+            self._limit.release(overloaded=isinstance(ex, (requests.ConnectionError, requests.Timeout)))
+            metrics.REQUEST_DURATION.record(time.perf_counter() - started,
+                                            {"target": "emporia", "route": route, "status_code": 0})
+            raise
+        elapsed = time.perf_counter() - started
+        if response.status_code >= 500:
+            self._breaker.record_failure()
+        else:
+            self._breaker.record_success()
+        self._limit.release(elapsed, overloaded=response.status_code == 429 or response.status_code >= 500)
+        metrics.REQUEST_DURATION.record(elapsed,
+                                        {"target": "emporia", "route": route, "status_code": response.status_code})
+        size = response.headers.get("Content-Length")
+        if size:
+            metrics.PAYLOAD_BYTES.add(int(size), {"target": "emporia", "direction": "received"})
+        return response
+
+
+def _auth_token(response: requests.Response):
+    """The authtoken a response was requested with"""
+    request = getattr(response, "request", None)
+    return request.headers.get("authtoken") if request is not None else None
 
 
 def _format_time(input_time: datetime) -> str:
@@ -0,0 +1,243 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from emporia import metrics
+from emporia.sql import table_name
+
+
+class LeaseStore(object):
+    """Time-bounded leases on work units, shared by the replicas of the collector
+
+    A unit is claimed by one replica at a time and stays claimed for ttl seconds, renewed while it is worked on.  A
+    completed unit stays claimed for hold seconds more, so the other replicas skip it for the rest of the cycle; a
+    unit that is neither renewed, completed nor released in time (its replica died or hung) is reassigned to whoever
+    claims it next.
+    """
+
+    def __init__(self, owner: str = None, ttl: float = 300.0, hold: float = 3000.0):
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self.ttl = ttl
+        self._hold = hold
+
+    def acquire(self, units: list, limit: int) -> list:
+        """Claim up to limit of the units that no replica holds, in the order given, returning the claimed ones"""
+        claimed = self._acquire(units, limit)
+        metrics.LEASES.add(len(claimed), metrics.LEASE_CLAIMED)
+        return claimed
+
+    def renew(self, units: list) -> list:
+        """Extend the leases of the units for another ttl seconds, returning the ones this replica still holds"""
+        held = self._renew(units)
+        metrics.LEASES.add(len(units) - len(held), metrics.LEASE_LOST)
+        return held
+
+    def complete(self, units: list):
+        """Keep the written units from being claimed again until hold seconds from now"""
+        self._complete(units)
+        metrics.LEASES.add(len(units), metrics.LEASE_COMPLETED)
+
+    def release(self, units: list):
+        """Give the units back at once, for a retry by any replica"""
+        self._release(units)
+        metrics.LEASES.add(len(units), metrics.LEASE_RELEASED)
+
+    def close(self):
+        pass
+
+    def _acquire(self, units: list, limit: int) -> list:
+        raise NotImplementedError
+
+    def _renew(self, units: list) -> list:
+        raise NotImplementedError
+
+    def _complete(self, units: list):
+        raise NotImplementedError
+
+    def _release(self, units: list):
+        raise NotImplementedError
+
+
+class SqliteLeaseStore(LeaseStore):
+    """Leases in a SQLite file, for replicas on one host and for tests
+
+    Claims take SQLite's write lock on the file (BEGIN IMMEDIATE), so two replicas never claim the same unit.
+    """
+
+    def __init__(self, path: str, owner: str = None, ttl: float = 300.0, hold: float = 3000.0):
+        super().__init__(owner, ttl, hold)
+        self._path = os.path.expanduser(path)
+        directory = os.path.dirname(self._path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with closing(self._connect()) as connection, connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS leases ("
+                " unit TEXT PRIMARY KEY,"
+                " owner TEXT NOT NULL,"
+                " expires REAL NOT NULL)")
+
+    def _acquire(self, units: list, limit: int) -> list:
+        now = time.time()
+        with closing(self._connect()) as connection, connection:
+            connection.execute("BEGIN IMMEDIATE")
+            taken = {row[0] for row in connection.execute(
+                "SELECT unit FROM leases WHERE expires > ? AND unit IN (SELECT value FROM json_each(?))",
+                (now, json.dumps(units)))}
+            claimed = [unit for unit in units if unit not in taken][:limit]
+            connection.executemany(
+                "INSERT INTO leases (unit, owner, expires) VALUES (?, ?, ?)"
+                " ON CONFLICT (unit) DO UPDATE SET owner = excluded.owner, expires = excluded.expires",
+                [(unit, self.owner, now + self.ttl) for unit in claimed])
+            # Expired leases are claimable anyway, the rows of past days are dropped once they are well past
+            connection.execute("DELETE FROM leases WHERE expires < ?", (now - 86400,))
+        return claimed
+
+    def _renew(self, units: list) -> list:
+        with closing(self._connect()) as connection, connection:
+            # A lease that ran out but was not claimed by anyone else yet is still this replica's
+            connection.execute(
+                "UPDATE leases SET expires = ? WHERE owner = ? AND unit IN (SELECT value FROM json_each(?))",
+                (time.time() + self.ttl, self.owner, json.dumps(units)))
+            held = {row[0] for row in connection.execute(
+                "SELECT unit FROM leases WHERE owner = ? AND unit IN (SELECT value FROM json_each(?))",
+                (self.owner, json.dumps(units)))}
+        return [unit for unit in units if unit in held]
+
+    def _complete(self, units: list):
+        with closing(self._connect()) as connection, connection:
+            connection.execute(
+                "UPDATE leases SET expires = ? WHERE owner = ? AND unit IN (SELECT value FROM json_each(?))",
+                (time.time() + self._hold, self.owner, json.dumps(units)))
+
+    def _release(self, units: list):
+        with closing(self._connect()) as connection, connection:
+            connection.execute("DELETE FROM leases WHERE owner = ? AND unit IN (SELECT value FROM json_each(?))",
+                               (self.owner, json.dumps(units)))
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self._path, timeout=30)
+
+
+class PostgresLeaseStore(LeaseStore):
+    """Leases as PostgreSQL session advisory locks, for replicas on several hosts
+
+    A claimed unit is an advisory lock held by this replica's session: when the replica dies its connection goes
+    and the server frees the locks at once, and idle_session_timeout (ttl) frees them when a hung replica stops
+    renewing them, which keeps the session busy while the units are worked on.  Completed units are recorded with
+    their hold time in a small table, the one thing an advisory lock cannot outlive its session for.  psycopg is only
+    imported when this backend is configured.
+    """
+
+    # Namespaces the lock keys, other applications on the database take advisory locks too
+    KEY_PREFIX = "emporia-collector:"
+
+    def __init__(self, dsn: str, table: str = "emporia_leases", owner: str = None, ttl: float = 300.0,
+                 hold: float = 3000.0):
+        super().__init__(owner, ttl, hold)
+        try:
+            import psycopg
+        except ImportError as ex:
+            raise ImportError("leases.backend postgres needs psycopg: pip install 'psycopg[binary]'") from ex
+        self._psycopg = psycopg
+        self._dsn = dsn
+        self._table = table_name(table, "lease")
+        self._connection = None
+        self._held = set()
+        # One session holds the locks, the days of an --async run take turns on it
+        self._lock = threading.Lock()
+        with self._lock:
+            self._execute(
+                f"CREATE TABLE IF NOT EXISTS {self._table} ("
+                " unit TEXT PRIMARY KEY,"
+                " owner TEXT NOT NULL,"
+                " done_until TIMESTAMPTZ NOT NULL)")
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+                self._held.clear()
+
+    def _acquire(self, units: list, limit: int) -> list:
+        with self._lock:
+            # The locks are re-entrant within the session, the units already held here are not locked twice
+            candidates = [unit for unit in units if unit not in self._held]
+            # OFFSET 0 keeps the done check below the lock calls, which stop at the limit
+            rows = self._execute(
+                f"SELECT unit FROM (SELECT u.unit, u.n FROM unnest(%s::text[]) WITH ORDINALITY AS u (unit, n)"
+                f" WHERE NOT EXISTS (SELECT 1 FROM {self._table} d WHERE d.unit = u.unit AND d.done_until > now())"
+                f" ORDER BY u.n OFFSET 0) c"
+                f" WHERE pg_try_advisory_lock(hashtextextended(%s || c.unit, 0)) LIMIT %s",
+                (candidates, self.KEY_PREFIX, limit))
+            claimed = [row[0] for row in rows]
+            self._held.update(claimed)
+        return claimed
+
+    def _renew(self, units: list) -> list:
+        with self._lock:
+            connection = self._connection
+            if connection is None or connection.closed or connection.broken:
+                self._held.clear()
+            else:
+                try:
+                    # Not through _execute, a new session would not have the locks of the lost one
+                    connection.execute("SELECT 1")
+                except self._psycopg.OperationalError:
+                    connection.close()
+                    self._held.clear()
+            return [unit for unit in units if unit in self._held]
+
+    def _complete(self, units: list):
+        with self._lock:
+            # The units of a lost session may be another replica's by now
+            units = [unit for unit in units if unit in self._held]
+            if not units:
+                return
+            self._execute(
+                f"INSERT INTO {self._table} (unit, owner, done_until)"
+                f" SELECT unnest(%s::text[]), %s, now() + make_interval(secs => %s)"
+                f" ON CONFLICT (unit) DO UPDATE SET owner = excluded.owner, done_until = excluded.done_until",
+                (units, self.owner, self._hold))
+            self._execute(f"DELETE FROM {self._table} WHERE done_until < now() - interval '1 day'")
+            self._unlock(units)
+
+    def _release(self, units: list):
+        with self._lock:
+            self._unlock(units)
+
+    def _unlock(self, units: list):
+        held = [unit for unit in units if unit in self._held]
+        if held:
+            self._execute("SELECT pg_advisory_unlock(hashtextextended(%s || unit, 0)) FROM unnest(%s::text[]) unit",
+                          (self.KEY_PREFIX, held))
+        self._held.difference_update(held)
+
+    def _execute(self, query: str, parameters: tuple = None) -> list:
+        for attempt in range(2):
+            connection = self._connect()
+            try:
+                cursor = connection.execute(query, parameters)
+                return cursor.fetchall() if cursor.description else []
+            except self._psycopg.OperationalError:
+                # idle_session_timeout ends the session between runs, a fresh one is tried once
+                connection.close()
+                if attempt:
+                    raise
+
+    def _connect(self):
+        if self._connection is None or self._connection.closed or self._connection.broken:
+            # The locks of a lost session are gone with it
+            self._held.clear()
+            self._connection = self._psycopg.connect(self._dsn, autocommit=True)
+            try:
+                self._connection.execute(f"SET idle_session_timeout = {int(self.ttl * 1000)}")
+            except self._psycopg.Error:
+                # Before PostgreSQL 14 a hung replica keeps its locks until its connection drops
+                pass
+        return self._connection
@@ -0,0 +1,162 @@
+import requests
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from requests.adapters import HTTPAdapter
+from emporia import metrics
+from emporia.records import encode_payloads
+
+
+class WriteResult(object):
+    """Outcome of writing a group of records to the local API"""
+
+    def __init__(self):
+        self.succeeded = 0
+        self.failures = []
+
+    @property
+    def errors(self) -> int:
+        return len(self.failures)
+
+    def add_failure(self, key, status_code: int = None, exception: Exception = None):
+        self.failures.append({"key": key, "status_code": status_code, "exception": exception})
+
+
+_SENT = {"target": "local_api", "direction": "sent"}
+_RECEIVED = {"target": "local_api", "direction": "received"}
+
+# Bulk routes relative to the API URL: operation -> (method, path)
+BULK_ROUTES = {
+    "insert": ("post", "bulk"),
+    "update": ("put", "bulk"),
+    "delete": ("post", "bulk/delete"),
+}
+
+
+class LocalApiWriter(object):
+    """Pooled, concurrent client for the local CRUD API
+
+    Records are sent in batches to the bulk routes when batch_size > 1.  A route answering 404/405 is
+    remembered as unsupported and the writer falls back to one call per record.  A batch the API rejects
+    (any other 4xx) is split in half and retried so a single bad row only fails itself, while a network
+    error or 5xx fails the whole batch at once and the retry is left to the spool.  The records may be any
+    iterable, they are consumed a batch at a time with at most concurrency batches in flight.
+    """
+
+    def __init__(self, api_url: str, concurrency: int = 8, batch_size: int = 500, connect_timeout: float = 6.03,
+                 read_timeout: float = 30.03):
+        self._api_url = api_url
+        self._concurrency = max(1, int(concurrency))
+        self._batch_size = max(1, int(batch_size))
+        self._bulk_supported = {operation: self._batch_size > 1 for operation in BULK_ROUTES}
+        self._timeout = (connect_timeout, read_timeout)
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._concurrency)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._executor = ThreadPoolExecutor(max_workers=self._concurrency, thread_name_prefix="local-api")
+
+    def search(self, payload: dict) -> requests.Response:
+        started = time.perf_counter()
+        response = self._session.post(self._api_url + "search", json=payload, timeout=self._timeout)
+        _record_request(started, "search", response.status_code)
+        metrics.PAYLOAD_BYTES.add(len(response.content), _RECEIVED)
+        return response
+
+    def insert(self, payloads: list) -> WriteResult:
+        """Insert each payload, keyed in the result by its position"""
+        return self._write("insert", enumerate(payloads))
+
+    def update(self, updates: list) -> WriteResult:
+        """Update each (record_id, payload) pair"""
+        return self._write("update", ((str(record_id), payload) for record_id, payload in updates))
+
+    def delete(self, record_ids: list) -> WriteResult:
+        return self._write("delete", ((str(record_id), None) for record_id in record_ids))
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._session.close()
+
+    def _write(self, operation: str, items) -> WriteResult:
+        result = WriteResult()
+        items = iter(items)
+        in_flight = deque()
+        while True:
+            # One record per call once the bulk route turned out to be unsupported
+            batch = list(islice(items, self._batch_size if self._bulk_supported[operation] else 1))
+            if not batch:
+                break
+            in_flight.append(self._executor.submit(self._send_batch, operation, batch))
+            if len(in_flight) >= self._concurrency:
+                _collect(result, in_flight.popleft().result())
+        while in_flight:
+            _collect(result, in_flight.popleft().result())
+        return result
+
+    def _send_batch(self, operation: str, items: list) -> list:
+        if len(items) == 1 or not self._bulk_supported[operation]:
+            return [self._send_record(operation, item) for item in items]
+        method, path = BULK_ROUTES[operation]
+        if operation == "insert":
+            body = [payload for _, payload in items]
+        elif operation == "update":
+            body = [dict(payload, id=record_id) for record_id, payload in items]
+        else:
+            body = {"ids": [record_id for record_id, _ in items]}
+        # The whole batch is encoded once, compactly, instead of through requests' json= handling
+        data = encode_payloads(body)
+        metrics.PAYLOAD_BYTES.add(len(data), _SENT)
+        started = time.perf_counter()
+        try:
+            response = self._session.request(method, self._api_url + path, data=data,
+                                             headers={"Content-Type": "application/json"}, timeout=self._timeout)
+            status_code, exception = response.status_code, None
+        except requests.RequestException as ex:
+            status_code, exception = None, ex
+        _record_request(started, f"bulk {operation}", status_code)
+        if status_code == 200:
+            return [(key, 200, None) for key, _ in items]
+        if status_code in (404, 405):
+            self._bulk_supported[operation] = False
+            return [self._send_record(operation, item) for item in items]
+        if status_code is None or status_code >= 500:
+            # Not the rows' fault, splitting would only repeat the failure once per row
+            return [(key, status_code, exception) for key, _ in items]
+        middle = len(items) // 2
+        return self._send_batch(operation, items[:middle]) + self._send_batch(operation, items[middle:])
+
+    def _send_record(self, operation: str, item: tuple) -> tuple:
+        key, payload = item
+        if operation == "insert":
+            method, url = "post", self._api_url
+        elif operation == "update":
+            method, url = "put", self._api_url + key
+        else:
+            method, url = "delete", self._api_url + key
+        data = encode_payloads(payload) if payload is not None else None
+        if data:
+            metrics.PAYLOAD_BYTES.add(len(data), _SENT)
+        headers = {"Content-Type": "application/json"} if data else None
+        started = time.perf_counter()
+        try:
+            response = self._session.request(method, url, data=data, headers=headers, timeout=self._timeout)
+            status_code, exception = response.status_code, None
+        except requests.RequestException as ex:
+            status_code, exception = None, ex
+        _record_request(started, operation, status_code)
+        return key, status_code, exception
+
+
+def _collect(result: WriteResult, outcome: list):
+    for key, status_code, exception in outcome:
+        if status_code == 200:
+            result.succeeded += 1
+        else:
+            result.add_failure(key, status_code, exception)
+
+
+def _record_request(started: float, route: str, status_code: int):
+    metrics.REQUEST_DURATION.record(time.perf_counter() - started,
+                                    {"target": "local_api", "route": route, "status_code": status_code or 0})
@@ -0,0 +1,80 @@
+from datetime import datetime, timezone
+from opentelemetry import metrics
+from opentelemetry.metrics import CallbackOptions, Observation
+from jTookkit.jLogging import EventType, Logger
+
+
+# The instruments come from the global MeterProvider that opentelemetry-instrument sets up (--metrics_exporter),
+# without one they are no-ops.  Counts are added once per batch, never once per record.
+_meter = metrics.get_meter("emporia-collector")
+
+PHASE_DURATION = _meter.create_histogram(
+    "emporia.phase.duration", unit="s", description="Duration of the collector's runs and spans")
+REQUEST_DURATION = _meter.create_histogram(
+    "emporia.request.duration", unit="s", description="Duration of the HTTP requests to Emporia and the local API")
+RECORDS = _meter.create_counter(
+    "emporia.records", unit="{record}",
+    description="Usage records fetched from Emporia, rolled up and written locally")
+RETRIES = _meter.create_counter(
+    "emporia.request.retries", unit="{retry}",
+    description="Emporia requests retried after a 401, a 429, a 5xx or a network error")
+BACKOFF = _meter.create_counter(
+    "emporia.request.backoff", unit="s", description="Seconds slept backing off before a retry")
+TOKEN_REFRESHES = _meter.create_counter(
+    "emporia.token.refreshes", unit="{refresh}", description="Cognito token refreshes and full logins")
+PAYLOAD_BYTES = _meter.create_counter(
+    "emporia.payload.size", unit="By", description="Bytes received from Emporia and sent to the local API")
+CIRCUIT_OPENED = _meter.create_counter(
+    "emporia.circuit.opened", unit="{open}", description="Times a host's circuit breaker opened")
+LEASES = _meter.create_counter(
+    "emporia.leases", unit="{unit}", description="Work units claimed, completed, released and lost by this replica")
+
+# Attribute sets are built once, the hot paths only pass references to them
+FETCHED = {"action": "fetched"}
+INSERTED = {"action": "inserted"}
+UPDATED = {"action": "updated"}
+DELETED = {"action": "deleted"}
+ERRORED = {"action": "errored"}
+ROLLED_UP = {"action": "rolled_up"}
+RETRY_UNAUTHORIZED = {"reason": "unauthorized"}
+RETRY_SERVER_ERROR = {"reason": "server_error"}
+RETRY_RATE_LIMITED = {"reason": "rate_limited"}
+RETRY_NETWORK_ERROR = {"reason": "network_error"}
+LEASE_CLAIMED = {"outcome": "claimed"}
+LEASE_COMPLETED = {"outcome": "completed"}
+LEASE_RELEASED = {"outcome": "released"}
+LEASE_LOST = {"outcome": "lost"}
+
+
+class MeteredLogger(Logger):
+    """Logger that also records the duration of every span and run in PHASE_DURATION"""
+
+    def transaction_event(self, event_type: EventType, payload: dict = None, transaction: dict = None,
+                          source_component: str = None, return_code: int = None) -> dict:
+        event = super().transaction_event(event_type, payload=payload, transaction=transaction,
+                                          source_component=source_component, return_code=return_code)
+        if event_type in (EventType.SPAN_END, EventType.TRANSACTION_END) and "duration" in event:
+            PHASE_DURATION.record(event["duration"], {"phase": event.get("source_component", "run"),
+                                                      "return_code": event.get("return_code", 0)})
+        return event
+
+
+def observe_watermark_lag(state, scopes):
+    """Report how far the oldest watermark of each (scale, unit) in scopes is behind now, read at export time"""
+    _lag_sources.append((state, scopes))
+
+
+def _watermark_lag(options: CallbackOptions):
+    now = datetime.now(timezone.utc)
+    for state, scopes in list(_lag_sources):
+        for scale, unit in sorted(scopes):
+            watermark = state.min_watermark(scale, unit)
+            if watermark is not None:
+                yield Observation((now - watermark).total_seconds(),
+                                  {"account": state.account, "scale": scale, "unit": unit})
+
+
+_lag_sources = []
+_meter.create_observable_gauge(
+    "emporia.watermark.lag", callbacks=[_watermark_lag], unit="s",
+    description="Age of the oldest per-channel watermark of each scale and unit")
@@ -0,0 +1,28 @@
+import threading
+import time
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket, acquire() blocks until a token is available"""
+
+    def __init__(self, rate: float, burst: int = None):
+        self._rate = float(rate)
+        self._capacity = float(burst if burst else max(1.0, self._rate))
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1.0) -> float:
+        """Take tokens from the bucket, returning the seconds spent waiting for them"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                delay = (tokens - self._tokens) / self._rate
+            time.sleep(delay)
+            waited += delay
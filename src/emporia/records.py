@@ -0,0 +1,70 @@
+import json
+from datetime import datetime, timezone
+from functools import lru_cache
+
+
+class UsageRecord(object):
+    """One usage value for a channel at an instant, scale and unit"""
+
+    __slots__ = ("instant", "scale", "unit", "device_gid", "channel_num", "name", "usage", "percentage")
+
+    def __init__(self, instant: datetime, scale: str, unit: str, device_gid: int, channel_num: str, name: str,
+                 usage: float = 0, percentage: float = 0):
+        self.instant = instant
+        self.scale = scale
+        self.unit = unit
+        self.device_gid = device_gid
+        self.channel_num = channel_num
+        self.name = name
+        self.usage = usage
+        self.percentage = percentage
+
+    def __repr__(self):
+        return (f"UsageRecord({self.instant.isoformat()}, {self.scale}, {self.unit}, {self.device_gid}, "
+                f"{self.channel_num!r}, {self.name!r}, {self.usage})")
+
+    def key(self) -> tuple:
+        """(instant, scale, device_id, channel_num, unit), the identity of the row in the local data"""
+        return self.instant, self.scale, int(self.device_gid), str(self.channel_num), self.unit
+
+    def to_payload(self) -> dict:
+        """The local API record"""
+        return {
+            "instant": format_instant(self.instant),
+            "scale": self.scale,
+            "device_id": self.device_gid,
+            "channel_num": self.channel_num,
+            "name": self.name,
+            "usage": self.usage,
+            "unit": self.unit,
+            "percentage": self.percentage,
+        }
+
+    def to_row(self) -> list:
+        """Compact positional form used by the spool"""
+        return [format_instant(self.instant), self.scale, self.unit, self.device_gid, self.channel_num, self.name,
+                self.usage, self.percentage]
+
+    @classmethod
+    def from_row(cls, row: list):
+        instant, scale, unit, device_gid, channel_num, name, usage, percentage = row
+        return cls(parse_instant(instant), scale, unit, device_gid, channel_num, name, usage, percentage)
+
+
+@lru_cache(maxsize=8192)
+def format_instant(instant: datetime) -> str:
+    """ISO 8601 with a UTC 'Z', cached because every record of a fetch shares a handful of instants"""
+    return instant.astimezone(timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+@lru_cache(maxsize=8192)
+def parse_instant(value) -> datetime:
+    """UTC datetime from an ISO 8601 string (or datetime), cached like format_instant"""
+    instant = datetime.fromisoformat(value.replace("Z", "+00:00")) if isinstance(value, str) else value
+    if instant.tzinfo is None:
+        instant = instant.replace(tzinfo=timezone.utc)
+    return instant.astimezone(timezone.utc)
+
+
+def encode_payloads(payloads) -> bytes:
+    return json.dumps(payloads, separators=(",", ":")).encode("utf-8")
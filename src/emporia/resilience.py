@@ -0,0 +1,128 @@
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+import requests
+from emporia import metrics
+
+
+class CircuitOpenError(requests.RequestException):
+    """Raised instead of calling a host whose circuit is open"""
+
+
+class CircuitBreaker(object):
+    """Thread-safe per-host circuit breaker
+
+    failure_threshold consecutive failures (5xx or network errors) open the circuit, calls then fail fast for
+    reset_timeout seconds.  After that a single trial call is let through (half open): success closes the circuit,
+    failure opens it again.
+    """
+
+    def __init__(self, host: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.host = host
+        self._failure_threshold = max(1, failure_threshold)
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may go through now"""
+        with self._lock:
+            if self._opened_at is None:
+                return
+            remaining = self._opened_at + self._reset_timeout - time.monotonic()
+            if remaining > 0 or self._trial:
+                raise CircuitOpenError(f"Circuit open for {self.host}, retrying in {max(remaining, 0):.1f}s")
+            self._trial = True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial or (self._opened_at is None and self._failures >= self._failure_threshold):
+                self._opened_at = time.monotonic()
+                self._trial = False
+                metrics.CIRCUIT_OPENED.add(1, {"host": self.host})
+
+
+class AdaptiveLimit(object):
+    """Limit on the calls in flight that adapts to upstream latency (additive increase, multiplicative decrease)
+
+    The limit grows by about one per round of successful calls and shrinks when a call is throttled or fails, or
+    when its latency rises above tolerance times the baseline, a slow moving average of the latency.
+    """
+
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = None, tolerance: float = 2.0,
+                 smoothing: float = 0.05):
+        self._minimum = max(1, minimum)
+        self._maximum = max(self._minimum, maximum or initial)
+        self._limit = float(min(self._maximum, max(self._minimum, initial)))
+        self._tolerance = tolerance
+        self._smoothing = smoothing
+        self._baseline = None
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self._in_flight >= int(self._limit):
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self, latency: float = None, overloaded: bool = False):
+        """Return the slot, adapting the limit to the call's latency or to the upstream being overloaded"""
+        with self._condition:
+            self._in_flight -= 1
+            if overloaded:
+                self._limit = max(self._minimum, self._limit / 2)
+            elif latency is not None:
+                if self._baseline is None:
+                    self._baseline = latency
+                if latency > self._baseline * self._tolerance:
+                    self._limit = max(self._minimum, self._limit * 0.9)
+                else:
+                    self._limit = min(self._maximum, self._limit + 1 / self._limit)
+                self._baseline += (latency - self._baseline) * self._smoothing
+            self._condition.notify_all()
+
+
+def circuit_breaker(url: str, failure_threshold: int = 5, reset_timeout: float = 30.0) -> CircuitBreaker:
+    """The CircuitBreaker shared by every client of the url's host"""
+    host = urlsplit(url).netloc or url
+    with _breakers_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = _breakers[host] = CircuitBreaker(host, failure_threshold, reset_timeout)
+        return breaker
+
+
+def full_jitter(attempt: int, initial: float, maximum: float) -> float:
+    """Backoff before retry number attempt: uniform between 0 and the capped exponential delay"""
+    return random.uniform(0, min(maximum, initial * (2 ** (attempt - 1))))
+
+
+def retry_after(response: requests.Response):
+    """Seconds the Retry-After header asks to wait (delay-seconds or an HTTP date), None without one"""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
@@ -0,0 +1,271 @@
+import json
+import os
+import sqlite3
+from contextlib import closing
+from datetime import date, datetime, time, timedelta, timezone
+from emporia.enums import Scale, Unit
+from emporia.records import UsageRecord
+
+SOURCE_SCALES = {
+    Scale.MINUTE: timedelta(minutes=1),
+    Scale.MINUTES_15: timedelta(minutes=15),
+}
+DAY_SCALES = (Scale.HOUR, Scale.DAY)
+PERIOD_SCALES = (Scale.WEEK, Scale.MONTH)
+# partial: sum the intervals that have data, skip: drop a bucket with any elapsed interval missing,
+# fill: scale the sum up to every elapsed interval of the bucket (the mean of the intervals that have data)
+MISSING_POLICIES = ("partial", "skip", "fill")
+# Units that are averaged over a bucket rather than summed
+MEAN_UNITS = {Unit.VOLTS}
+MAIN_CHANNEL = "1,2,3"
+# Daily totals are kept long enough to rebuild the month of yesterday
+RETENTION_DAYS = 62
+
+
+class Rollup(object):
+    """Derives the HOUR/DAY/WEEK/MONTH aggregates of a 1MIN or 15MIN chart series locally
+
+    A day of the source series is resampled as one channels x intervals matrix, so every channel is aggregated in
+    the same numpy operations.  Buckets are UTC, like the instants _format_time sends to Emporia: hours and days
+    start at UTC midnight, weeks on Monday and months on the 1st.  HOUR, WEEK and MONTH records are stamped at the
+    start of their bucket like chart points, DAY records at 23:59:59.000999 like getDeviceListUsages, so they
+    replace the daily totals it used to return.
+
+    An interval is missing when it has started but Emporia returned no data for it, intervals still in the future
+    are not counted.  WEEK and MONTH are built from the daily totals kept in a small SQLite file at path, so a
+    day that was never collected counts as a day of missing intervals.
+
+    numpy is only imported when a rollup is configured.
+    """
+
+    def __init__(self, source: Scale, unit: Unit, scales: list, missing: str = "partial", path: str = "",
+                 account: str = "default"):
+        try:
+            import numpy
+        except ImportError as ex:
+            raise ImportError("rollup needs numpy: pip install numpy") from ex
+        self._numpy = numpy
+        if source not in SOURCE_SCALES:
+            raise ValueError(f"rollup.source must be one of {', '.join(scale.value for scale in SOURCE_SCALES)}")
+        unsupported = [scale.value for scale in scales if scale not in DAY_SCALES + PERIOD_SCALES]
+        if unsupported:
+            raise ValueError(f"Unsupported rollup scales: {', '.join(unsupported)}")
+        if missing not in MISSING_POLICIES:
+            raise ValueError(f"rollup.missing must be one of {', '.join(MISSING_POLICIES)}")
+        self.source = source
+        self.unit = unit
+        self.scales = list(scales)
+        self._missing = missing
+        self._step = SOURCE_SCALES[source]
+        self._intervals = timedelta(days=1) // self._step
+        self._mean = unit in MEAN_UNITS
+        self._store = None
+        if any(scale in PERIOD_SCALES for scale in self.scales):
+            if not path:
+                raise ValueError("rollup.path is needed to roll up 1W and 1MON")
+            self._store = RollupStore(path, account)
+
+    @property
+    def period_scopes(self) -> set:
+        """(scale, unit) of the WEEK/MONTH buckets, which are written under the day they start on"""
+        return {(scale.value, self.unit.value) for scale in self.scales if scale in PERIOD_SCALES}
+
+    def produces(self, scale: Scale, unit: Unit) -> bool:
+        return unit == self.unit and scale in self.scales
+
+    def roll_up(self, instant: datetime, usages: list, now: datetime) -> tuple:
+        """Aggregate the source records of the UTC day of instant
+
+        Returns the HOUR/DAY records of the day and a (bucket instant, scale, records) for each WEEK/MONTH bucket
+        the day falls in.  usages may hold records of any scale, only the source series of the day is used.
+        """
+        np = self._numpy
+        day_start = datetime.combine(instant.astimezone(timezone.utc).date(), time(), tzinfo=timezone.utc)
+        day_end = day_start + timedelta(days=1)
+        source = self.source.value
+        unit = self.unit.value
+        series = {}
+        rows = []
+        columns = []
+        values = []
+        offsets = {}
+        # Chart records arrive a channel at a time, so the row is only looked up when the channel changes
+        last_gid = last_num = row = None
+        for usage in usages:
+            if usage.scale != source or usage.unit != unit or usage.usage is None:
+                continue
+            offset = offsets.get(usage.instant)
+            if offset is None:
+                offset = offsets[usage.instant] = (usage.instant - day_start) // self._step \
+                    if day_start <= usage.instant < day_end else -1
+            if offset < 0:
+                continue
+            if usage.device_gid != last_gid or usage.channel_num != last_num:
+                last_gid, last_num = usage.device_gid, usage.channel_num
+                key = (int(last_gid), str(last_num))
+                entry = series.get(key)
+                if entry is None:
+                    entry = series[key] = [len(series), usage.name]
+                else:
+                    entry[1] = usage.name
+                row = entry[0]
+            rows.append(row)
+            columns.append(offset)
+            values.append(usage.usage)
+        if not series:
+            return [], []
+
+        # Intervals that have started by now; the rest of the day is not missing yet
+        elapsed = self._elapsed(day_start, now)
+        matrix = np.full((len(series), self._intervals), np.nan)
+        matrix[np.array(rows), np.array(columns)] = np.array(values, dtype=float)
+        present = ~np.isnan(matrix)
+        keys = list(series)
+        names = [entry[1] for entry in series.values()]
+        mains = _main_rows(np, keys)
+
+        records = []
+        if Scale.HOUR in self.scales:
+            per_hour = self._intervals // 24
+            hours = matrix.reshape(len(keys), 24, per_hour)
+            expected = np.clip(elapsed - np.arange(24) * per_hour, 0, per_hour)
+            self._emit(records, keys, names, mains, Scale.HOUR,
+                       [day_start + timedelta(hours=hour) for hour in range(24)],
+                       np.nansum(hours, axis=2), present.reshape(hours.shape).sum(axis=2),
+                       np.broadcast_to(expected, (len(keys), 24)))
+        totals = np.nansum(matrix, axis=1)
+        counts = present.sum(axis=1)
+        if Scale.DAY in self.scales:
+            # Stamped like the daily totals of getDeviceListUsages (Emporia._usage_path)
+            self._emit(records, keys, names, mains, Scale.DAY,
+                       [day_start.replace(hour=23, minute=59, second=59, microsecond=999)],
+                       totals[:, None], counts[:, None], np.full((len(keys), 1), elapsed))
+
+        periods = []
+        if self._store is not None:
+            self._store.put_day(day_start.date(), unit, [
+                (device_gid, channel_num, name, total, count)
+                for (device_gid, channel_num), name, total, count in zip(keys, names, totals.tolist(),
+                                                                         counts.tolist())])
+            for scale in self.scales:
+                if scale in PERIOD_SCALES:
+                    periods.append(self._period(scale, day_start.date(), now))
+        return records, periods
+
+    def _period(self, scale: Scale, day: date, now: datetime) -> tuple:
+        np = self._numpy
+        if scale == Scale.WEEK:
+            start = day - timedelta(days=day.weekday())
+            end = start + timedelta(days=7)
+        else:
+            start = day.replace(day=1)
+            end = (start + timedelta(days=32)).replace(day=1)
+        bucket = datetime.combine(start, time(), tzinfo=timezone.utc)
+        records = []
+        rows = self._store.totals(self.unit.value, start, end)
+        if not rows:
+            return bucket, scale.value, records
+        device_gids, channel_nums, names, totals, counts, _ = zip(*rows)
+        # Every interval that has started in the bucket is expected, a day that was never collected is missing
+        today = datetime.combine(now.date(), time(), tzinfo=timezone.utc)
+        expected = self._intervals * max(0, (min(end, now.date()) - start).days)
+        if start <= now.date() < end:
+            expected += self._elapsed(today, now)
+        keys = list(zip(device_gids, channel_nums))
+        self._emit(records, keys, list(names), _main_rows(np, keys), scale, [bucket],
+                   np.array(totals, dtype=float)[:, None], np.array(counts)[:, None],
+                   np.full((len(keys), 1), expected))
+        return bucket, scale.value, records
+
+    def _emit(self, records: list, keys: list, names: list, mains, scale: Scale, instants: list, totals, present,
+              expected):
+        """Append a UsageRecord for every (channel, bucket) that has data and passes the missing policy"""
+        np = self._numpy
+        expected = np.maximum(expected, present)
+        has_data = present > 0
+        if self._mean:
+            values = np.divide(totals, present, out=np.zeros_like(totals), where=has_data)
+        elif self._missing == "fill":
+            values = np.divide(totals * expected, present, out=np.zeros_like(totals), where=has_data)
+        else:
+            values = totals
+        emit = has_data & (present == expected) if self._missing == "skip" else has_data
+        percentages = np.zeros_like(values) if self._mean else _percentages(np, values, mains)
+        scale = scale.value
+        unit = self.unit.value
+        channel_rows, buckets = np.nonzero(emit)
+        for row, bucket, value, percentage in zip(channel_rows.tolist(), buckets.tolist(), values[emit].tolist(),
+                                                  percentages[emit].tolist()):
+            device_gid, channel_num = keys[row]
+            records.append(UsageRecord(instants[bucket], scale, unit, device_gid, channel_num, names[row], value,
+                                       percentage))
+
+    def _elapsed(self, day_start: datetime, now: datetime) -> int:
+        """Intervals of the day that have started by now"""
+        started = now - day_start
+        return max(0, min(self._intervals, -(-started // self._step)))
+
+
+class RollupStore(object):
+    """SQLite store of the per-channel daily totals of the source series, the input of the WEEK and MONTH buckets"""
+
+    def __init__(self, path: str, account: str = "default"):
+        self._path = os.path.expanduser(path)
+        self._account = account
+        directory = os.path.dirname(self._path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with closing(self._connect()) as connection, connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS daily_totals ("
+                " account TEXT NOT NULL,"
+                " unit TEXT NOT NULL,"
+                " device_gid INTEGER NOT NULL,"
+                " channel_num TEXT NOT NULL,"
+                " day TEXT NOT NULL,"
+                " name TEXT NOT NULL,"
+                " total REAL NOT NULL,"
+                " present INTEGER NOT NULL,"
+                " PRIMARY KEY (account, unit, device_gid, channel_num, day))")
+
+    def put_day(self, day: date, unit: str, totals: list):
+        """Replace the day's (device_gid, channel_num, name, total, present) rows of the devices in totals, present
+        counting the intervals that had data.  Other devices keep theirs, a leased part of the day only has some."""
+        devices = json.dumps(sorted({int(device_gid) for device_gid, *_ in totals}))
+        with closing(self._connect()) as connection, connection:
+            connection.execute(
+                "DELETE FROM daily_totals WHERE account = ? AND unit = ?"
+                " AND ((day = ? AND device_gid IN (SELECT value FROM json_each(?))) OR day < ?)",
+                (self._account, unit, day.isoformat(), devices, (day - timedelta(days=RETENTION_DAYS)).isoformat()))
+            connection.executemany(
+                "INSERT INTO daily_totals (account, unit, device_gid, channel_num, day, name, total, present)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(self._account, unit, device_gid, channel_num, day.isoformat(), name or "", total, present)
+                 for device_gid, channel_num, name, total, present in totals])
+
+    def totals(self, unit: str, start: date, end: date) -> list:
+        """(device_gid, channel_num, name, total, present, latest day) per channel over the days from start up to
+        end"""
+        with closing(self._connect()) as connection:
+            # SQLite takes the bare name column from the row of MAX(day), the channel's latest name
+            return connection.execute(
+                "SELECT device_gid, channel_num, name, SUM(total), SUM(present), MAX(day) FROM daily_totals"
+                " WHERE account = ? AND unit = ? AND day >= ? AND day < ?"
+                " GROUP BY device_gid, channel_num ORDER BY device_gid, channel_num",
+                (self._account, unit, start.isoformat(), end.isoformat())).fetchall()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self._path, timeout=30)
+
+
+def _main_rows(np, keys: list):
+    """Row of each channel's device Main (channel 1,2,3), -1 when the device's Main is not in the series"""
+    mains = {device_gid: row for row, (device_gid, channel_num) in enumerate(keys) if channel_num == MAIN_CHANNEL}
+    return np.array([mains.get(device_gid, -1) for device_gid, _ in keys], dtype=int)
+
+
+def _percentages(np, values, mains):
+    """Share of each channel in its device's Main for the same bucket, the percentage getDeviceListUsages reports"""
+    main_values = np.where((mains >= 0)[:, None], values[mains], 0.0)
+    return np.divide(values * 100.0, main_values, out=np.zeros_like(values), where=main_values > 0)
@@ -0,0 +1,50 @@
+import random
+import threading
+import time
+import traceback
+
+
+class Scheduler(object):
+    """Runs a job on a fixed cadence with jitter, skipping any tick that would overlap a job still running"""
+
+    def __init__(self, job, interval: float, jitter: float = 0.0, run_immediately: bool = True, on_skip=None):
+        self._job = job
+        self._interval = interval
+        self._jitter = jitter
+        self._run_immediately = run_immediately
+        self._on_skip = on_skip
+        self._stop_event = threading.Event()
+        self._worker = None
+
+    def run(self):
+        """Block until stop() is called, then wait for the job in flight to finish"""
+        next_tick = time.monotonic() if self._run_immediately else time.monotonic() + self._interval
+        while not self._stop_event.is_set():
+            delay = next_tick + random.uniform(0, self._jitter) - time.monotonic()
+            if delay > 0 and self._stop_event.wait(delay):
+                break
+            if self._worker is not None and self._worker.is_alive():
+                if self._on_skip:
+                    self._on_skip()
+            else:
+                self._worker = threading.Thread(target=self._run_job, name="collector-run")
+                self._worker.start()
+            # Keep the cadence anchored to the schedule, skipping ticks we fell behind on
+            next_tick += self._interval
+            while next_tick < time.monotonic():
+                next_tick += self._interval
+        self.drain()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def drain(self):
+        if self._worker is not None:
+            self._worker.join()
+
+    def _run_job(self):
+        try:
+            self._job()
+        except Exception:
+            # A failed run must not take the daemon down, the next tick tries again
+            traceback.print_exc()
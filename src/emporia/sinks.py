@@ -0,0 +1,301 @@
+import os
+import sqlite3
+import threading
+from contextlib import closing, contextmanager
+from datetime import datetime, timedelta, timezone
+from emporia.local_api import LocalApiWriter, WriteResult
+from emporia.sql import format_sortable, table_name
+
+
+# Columns of a usage row and the natural key the set based sinks merge on
+COLUMNS = ("instant", "scale", "device_id", "channel_num", "name", "usage", "unit", "percentage")
+KEY = ("instant", "scale", "device_id", "channel_num", "unit")
+VALUES = ("name", "usage", "percentage")
+
+
+class Sink(object):
+    """Destination of the usage records
+
+    Row sinks (merges is False) expose search, insert, update and delete, and the collector plans the diff between
+    the day's local rows and the fetched usages.  Set based sinks (merges is True) take the whole day in merge_day
+    and reconcile it themselves in one transaction.
+    """
+
+    merges = False
+
+    def search(self, instant: datetime) -> list:
+        """The local rows of the instant's (UTC) day, as dicts with an id and the COLUMNS"""
+        raise NotImplementedError
+
+    def insert(self, usages: list) -> WriteResult:
+        """Insert the UsageRecords, failures are keyed by their position in usages"""
+        raise NotImplementedError
+
+    def update(self, updates: list) -> WriteResult:
+        """Overwrite each (local row, UsageRecord) pair's row with the usage"""
+        raise NotImplementedError
+
+    def delete(self, records: list) -> WriteResult:
+        raise NotImplementedError
+
+    def merge_day(self, instant: datetime, usages: list, scopes: set, since: dict = None,
+                  owned: set = None) -> tuple:
+        """Make the instant's day match usages within the (scale, unit) scopes, returning (inserted, updated, deleted)
+
+        since maps (device_id, channel_num, scale, unit) to the first instant that was fetched for that series, rows
+        of the series before it are left alone.  owned limits the deletes to the rows of those (device_id, scale,
+        unit), for collectors that share the sink with other accounts or replicas.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class HttpSink(Sink):
+    """The local CRUD API at API_URL, written through the pooled LocalApiWriter"""
+
+    def __init__(self, api_url: str, concurrency: int = 8, batch_size: int = 500):
+        self._writer = LocalApiWriter(api_url, concurrency=concurrency, batch_size=batch_size)
+
+    def search(self, instant: datetime) -> list:
+        response = self._writer.search({"start_date": search_date(instant)})
+        response.raise_for_status()
+        return response.json() or []
+
+    def insert(self, usages: list) -> WriteResult:
+        # The payloads are encoded as the writer consumes them rather than all up front
+        return self._writer.insert(usage.to_payload() for usage in usages)
+
+    def update(self, updates: list) -> WriteResult:
+        return self._writer.update((record['id'], usage.to_payload()) for record, usage in updates)
+
+    def delete(self, records: list) -> WriteResult:
+        return self._writer.delete(record['id'] for record in records)
+
+    def close(self):
+        self._writer.close()
+
+
+class SqlSink(Sink):
+    """Set based sink: a day is staged in a temporary table and merged into the usage table in one transaction
+
+    The usage table needs a unique index on KEY.  Subclasses provide the connection, the staging load and the
+    dialect differences.
+    """
+
+    merges = True
+    placeholder = "?"
+    distinct = "IS NOT"
+
+    def __init__(self, table: str):
+        self._table = table_name(table, "sink")
+
+    def merge_day(self, instant: datetime, usages: list, scopes: set, since: dict = None,
+                  owned: set = None) -> tuple:
+        # One row per key, the last usage wins as in the collector's diff sync
+        rows = {usage.key(): usage for usage in usages}
+        with self._transaction() as cursor:
+            self._stage(cursor, rows.values(), since or {}, owned or set())
+            cursor.execute(self._count_changed_sql())
+            updated = cursor.fetchone()[0]
+            cursor.execute(self._upsert_sql())
+            # The upsert's row count covers both the inserted rows and the changed rows it updated
+            inserted = cursor.rowcount - updated
+            deleted = 0
+            if scopes:
+                day_start = datetime.combine(instant.astimezone(timezone.utc).date(), datetime.min.time(),
+                                             timezone.utc)
+                parameters = [self._instant(day_start), self._instant(day_start + timedelta(days=1))]
+                for scale, unit in sorted(scopes):
+                    parameters.extend((scale, unit))
+                cursor.execute(self._delete_stale_sql(len(scopes), owned is not None), parameters)
+                deleted = cursor.rowcount
+        return inserted, updated, deleted
+
+    def _transaction(self):
+        raise NotImplementedError
+
+    def _stage(self, cursor, usages, since: dict, owned: set):
+        """Fill the emporia_staging, emporia_since and emporia_owned temporary tables"""
+        raise NotImplementedError
+
+    def _instant(self, instant: datetime):
+        return instant
+
+    def _row(self, usage) -> tuple:
+        return (self._instant(usage.instant), usage.scale, int(usage.device_gid), str(usage.channel_num),
+                usage.name, usage.usage, usage.unit, usage.percentage)
+
+    def _changed(self, left: str, right: str) -> str:
+        return " OR ".join(f"{left}.{column} {self.distinct} {right}.{column}" for column in VALUES)
+
+    def _matches(self, left: str, right: str) -> str:
+        return " AND ".join(f"{left}.{column} = {right}.{column}" for column in KEY)
+
+    def _count_changed_sql(self) -> str:
+        return (f"SELECT COUNT(*) FROM emporia_staging s JOIN {self._table} t ON {self._matches('t', 's')}"
+                f" WHERE {self._changed('t', 's')}")
+
+    def _upsert_sql(self) -> str:
+        # Only the new and changed rows reach the upsert, unchanged rows are dropped by the join
+        return (f"INSERT INTO {self._table} AS t ({', '.join(COLUMNS)})"
+                f" SELECT {', '.join(f's.{column}' for column in COLUMNS)} FROM emporia_staging s"
+                f" LEFT JOIN {self._table} o ON {self._matches('o', 's')}"
+                f" WHERE o.instant IS NULL OR {self._changed('o', 's')}"
+                f" ON CONFLICT ({', '.join(KEY)}) DO UPDATE SET"
+                f" {', '.join(f'{column} = excluded.{column}' for column in VALUES)}"
+                f" WHERE {self._changed('t', 'excluded')}")
+
+    def _delete_stale_sql(self, scope_count: int, owned: bool = False) -> str:
+        p = self.placeholder
+        scopes = " OR ".join([f"(scale = {p} AND unit = {p})"] * scope_count)
+        rows = (" AND EXISTS (SELECT 1 FROM emporia_owned o WHERE o.device_id = t.device_id AND o.scale = t.scale"
+                " AND o.unit = t.unit)") if owned else ""
+        return (f"DELETE FROM {self._table} AS t WHERE instant >= {p} AND instant < {p} AND ({scopes}){rows}"
+                f" AND NOT EXISTS (SELECT 1 FROM emporia_staging s WHERE {self._matches('t', 's')})"
+                f" AND NOT EXISTS (SELECT 1 FROM emporia_since w WHERE w.device_id = t.device_id"
+                f" AND w.channel_num = t.channel_num AND w.scale = t.scale AND w.unit = t.unit"
+                f" AND t.instant < w.start)")
+
+
+class PostgresSink(SqlSink):
+    """Writes straight to PostgreSQL: COPY into a staging table, then INSERT ... ON CONFLICT, in one transaction
+
+    psycopg is only imported when this sink is configured.
+    """
+
+    placeholder = "%s"
+    distinct = "IS DISTINCT FROM"
+
+    def __init__(self, dsn: str, table: str = "emporia", create_schema: bool = False):
+        super().__init__(table)
+        try:
+            import psycopg
+        except ImportError as ex:
+            raise ImportError("sink.type postgres needs psycopg: pip install 'psycopg[binary]'") from ex
+        self._psycopg = psycopg
+        self._dsn = dsn
+        self._connection = None
+        # A connection runs one transaction at a time, the days of an --async run take turns
+        self._lock = threading.Lock()
+        if create_schema:
+            with self._transaction() as cursor:
+                cursor.execute(
+                    f"CREATE TABLE IF NOT EXISTS {self._table} ("
+                    " id BIGSERIAL PRIMARY KEY,"
+                    " instant TIMESTAMPTZ NOT NULL,"
+                    " scale TEXT NOT NULL,"
+                    " device_id BIGINT NOT NULL,"
+                    " channel_num TEXT NOT NULL,"
+                    " name TEXT,"
+                    " usage DOUBLE PRECISION,"
+                    " unit TEXT NOT NULL,"
+                    " percentage DOUBLE PRECISION)")
+                cursor.execute(
+                    f"CREATE UNIQUE INDEX IF NOT EXISTS {self._table.replace('.', '_')}_key"
+                    f" ON {self._table} ({', '.join(KEY)})")
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def _connect(self):
+        # Kept open between runs in daemon mode, reopened once it is closed or broken
+        if self._connection is None or self._connection.closed or self._connection.broken:
+            self._connection = self._psycopg.connect(self._dsn, autocommit=True)
+        return self._connection
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            connection = self._connect()
+            with connection.transaction(), connection.cursor() as cursor:
+                yield cursor
+
+    def _stage(self, cursor, usages, since: dict, owned: set):
+        cursor.execute(
+            "CREATE TEMPORARY TABLE emporia_staging ("
+            " instant TIMESTAMPTZ, scale TEXT, device_id BIGINT, channel_num TEXT, name TEXT,"
+            " usage DOUBLE PRECISION, unit TEXT, percentage DOUBLE PRECISION) ON COMMIT DROP")
+        cursor.execute(
+            "CREATE TEMPORARY TABLE emporia_since ("
+            " device_id BIGINT, channel_num TEXT, scale TEXT, unit TEXT, start TIMESTAMPTZ) ON COMMIT DROP")
+        cursor.execute(
+            "CREATE TEMPORARY TABLE emporia_owned (device_id BIGINT, scale TEXT, unit TEXT) ON COMMIT DROP")
+        with cursor.copy(f"COPY emporia_staging ({', '.join(COLUMNS)}) FROM STDIN") as copy:
+            for usage in usages:
+                copy.write_row(self._row(usage))
+        if since:
+            cursor.executemany("INSERT INTO emporia_since VALUES (%s, %s, %s, %s, %s)",
+                               [(int(device_id), str(channel_num), scale, unit, start)
+                                for (device_id, channel_num, scale, unit), start in since.items()])
+        if owned:
+            cursor.executemany("INSERT INTO emporia_owned VALUES (%s, %s, %s)",
+                               [(int(device_id), scale, unit) for device_id, scale, unit in owned])
+            cursor.execute("ANALYZE emporia_owned")
+        # Indexed and analyzed so the stale row check is an index lookup rather than a scan per row
+        cursor.execute(f"CREATE INDEX ON emporia_staging ({', '.join(KEY)})")
+        cursor.execute("ANALYZE emporia_staging")
+
+
+class SqliteSink(SqlSink):
+    """SQLite stand-in for PostgresSink, with the same merge, for tests and local runs without a database"""
+
+    def __init__(self, path: str, table: str = "emporia"):
+        super().__init__(table)
+        self._path = os.path.expanduser(path)
+        directory = os.path.dirname(self._path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with closing(self._connect()) as connection, connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self._table} ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " instant TEXT NOT NULL,"
+                " scale TEXT NOT NULL,"
+                " device_id INTEGER NOT NULL,"
+                " channel_num TEXT NOT NULL,"
+                " name TEXT,"
+                " usage REAL,"
+                " unit TEXT NOT NULL,"
+                " percentage REAL)")
+            connection.execute(
+                f"CREATE UNIQUE INDEX IF NOT EXISTS {self._table}_key ON {self._table} ({', '.join(KEY)})")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self._path, timeout=30)
+
+    @contextmanager
+    def _transaction(self):
+        with closing(self._connect()) as connection, connection:
+            cursor = connection.cursor()
+            # Take the write lock up front: a read transaction that later writes fails at once, without waiting out
+            # the busy timeout, when another connection wrote in between (several accounts share the file)
+            cursor.execute("BEGIN IMMEDIATE")
+            yield cursor
+
+    def _instant(self, instant: datetime) -> str:
+        return format_sortable(instant)
+
+    def _stage(self, cursor, usages, since: dict, owned: set):
+        cursor.execute(f"CREATE TEMPORARY TABLE emporia_staging ({', '.join(COLUMNS)})")
+        cursor.execute("CREATE TEMPORARY TABLE emporia_since (device_id, channel_num, scale, unit, start)")
+        cursor.execute("CREATE TEMPORARY TABLE emporia_owned (device_id, scale, unit)")
+        cursor.executemany(f"INSERT INTO emporia_staging VALUES ({', '.join('?' * len(COLUMNS))})",
+                           (self._row(usage) for usage in usages))
+        cursor.executemany("INSERT INTO emporia_since VALUES (?, ?, ?, ?, ?)",
+                           [(int(device_id), str(channel_num), scale, unit, self._instant(start))
+                            for (device_id, channel_num, scale, unit), start in since.items()])
+        cursor.executemany("INSERT INTO emporia_owned VALUES (?, ?, ?)",
+                           [(int(device_id), scale, unit) for device_id, scale, unit in owned])
+        cursor.execute(f"CREATE INDEX temp.emporia_staging_key ON emporia_staging ({', '.join(KEY)})")
+        cursor.execute("CREATE INDEX temp.emporia_owned_key ON emporia_owned (device_id, scale, unit)")
+
+
+def search_date(instant: datetime) -> str:
+    """The start_date the local API's search takes for the instant's day"""
+    return instant.isoformat(timespec="milliseconds").replace("+00:00", "Z")
@@ -0,0 +1,170 @@
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+from datetime import datetime, timezone
+from itertools import chain
+from emporia.records import UsageRecord
+
+
+class Segment(object):
+    """A spooled day of usages waiting to be written to the local API"""
+
+    def __init__(self, segment_id: int, created: datetime, instant: datetime, scopes: set, since: dict,
+                 attempts: int, owned: set = None):
+        self.id = segment_id
+        self.created = created
+        self.instant = instant
+        self.scopes = scopes
+        self.since = since
+        self.attempts = attempts
+        # (device_id, scale, unit) of the rows the fetch covered, None for every row of the scopes
+        self.owned = owned
+
+    @property
+    def key(self) -> tuple:
+        """(day, scopes, owned), the segments with the same key write the same rows"""
+        return (self.instant.date(), frozenset(self.scopes),
+                frozenset(self.owned) if self.owned is not None else None)
+
+
+class Spool(object):
+    """Durable, append-only SQLite outbox between fetching from Emporia and writing to the local API
+
+    Each fetch of a day is appended as one segment in a single transaction (one fsync per batch).  The drain stage
+    reads the due segments one at a time, so memory stays bounded however long the local API is down, and marks
+    each one committed once it is written.  A newer full snapshot of the same day and rows supersedes the older
+    pending segments when it is spooled, and any newer segment supersedes them once it is committed, so they are never
+    replayed over it.
+    """
+
+    def __init__(self, path: str, initial_retry_delay: float = 30.0, max_retry_delay: float = 3600.0):
+        self._path = os.path.expanduser(path)
+        self._initial_retry_delay = initial_retry_delay
+        self._max_retry_delay = max_retry_delay
+        directory = os.path.dirname(self._path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with closing(self._connect()) as connection, connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS segments ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " created REAL NOT NULL,"
+                " day TEXT NOT NULL,"
+                " instant TEXT NOT NULL,"
+                " scopes TEXT NOT NULL,"
+                " since TEXT NOT NULL,"
+                " status TEXT NOT NULL,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " next_attempt REAL NOT NULL DEFAULT 0,"
+                " last_error TEXT)")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS records ("
+                " segment_id INTEGER NOT NULL REFERENCES segments (id) ON DELETE CASCADE,"
+                " kind TEXT NOT NULL,"
+                " data TEXT NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS records_segment ON records (segment_id)")
+            if "owned" not in {row[1] for row in connection.execute("PRAGMA table_info(segments)")}:
+                # Spools from before the leases, their segments own every row of their scopes
+                connection.execute("ALTER TABLE segments ADD COLUMN owned TEXT")
+            connection.execute("CREATE INDEX IF NOT EXISTS segments_status ON segments (status, next_attempt)")
+
+    def append(self, instant: datetime, usages: list, chart_usages: list, scopes: set, since: dict,
+               owned: set = None) -> int:
+        """Spool a fetched day, returning the segment id"""
+        owned = json.dumps(sorted(owned)) if owned is not None else None
+        with closing(self._connect()) as connection, connection:
+            cursor = connection.execute(
+                "INSERT INTO segments (created, day, instant, scopes, since, owned, status)"
+                " VALUES (?, ?, ?, ?, ?, ?, 'pending')",
+                (time.time(), instant.date().isoformat(), instant.isoformat(), json.dumps(sorted(scopes)),
+                 json.dumps([list(key) + [start.isoformat()] for key, start in (since or {}).items()]), owned))
+            segment_id = cursor.lastrowid
+            connection.executemany(
+                "INSERT INTO records (segment_id, kind, data) VALUES (?, ?, ?)",
+                chain(((segment_id, "day", _dumps(usage)) for usage in usages),
+                      ((segment_id, "chart", _dumps(usage)) for usage in chart_usages)))
+            if not since:
+                # A full snapshot of the same scopes and rows makes the older pending segments of the day redundant
+                _supersede(connection, segment_id)
+        return segment_id
+
+    def due(self) -> list:
+        """Pending segments whose retry delay has passed, oldest first"""
+        with closing(self._connect()) as connection:
+            rows = connection.execute(
+                "SELECT id, created, instant, scopes, since, attempts, owned FROM segments"
+                " WHERE status = 'pending' AND next_attempt <= ? ORDER BY id", (time.time(),)).fetchall()
+        segments = []
+        for segment_id, created, instant, scopes, since, attempts, owned in rows:
+            since = {(device_id, channel_num, scale, unit): datetime.fromisoformat(start)
+                     for device_id, channel_num, scale, unit, start in json.loads(since)}
+            segments.append(Segment(segment_id, datetime.fromtimestamp(created, timezone.utc),
+                                    datetime.fromisoformat(instant), {tuple(scope) for scope in json.loads(scopes)},
+                                    since, attempts,
+                                    {tuple(row) for row in json.loads(owned)} if owned is not None else None))
+        return segments
+
+    def pending(self) -> int:
+        with closing(self._connect()) as connection:
+            return connection.execute("SELECT COUNT(*) FROM segments WHERE status = 'pending'").fetchone()[0]
+
+    def load(self, segment_id: int) -> tuple:
+        """(usages, chart_usages) of a segment"""
+        usages = []
+        chart_usages = []
+        with closing(self._connect()) as connection:
+            rows = connection.execute("SELECT kind, data FROM records WHERE segment_id = ?", (segment_id,))
+            for kind, data in rows:
+                (usages if kind == "day" else chart_usages).append(_loads(data))
+        return usages, chart_usages
+
+    def commit(self, segment_id: int):
+        """Mark the segment written, the older pending segments of its day and rows are now stale"""
+        with closing(self._connect()) as connection, connection:
+            connection.execute("UPDATE segments SET status = 'committed', last_error = NULL WHERE id = ?",
+                               (segment_id,))
+            connection.execute("DELETE FROM records WHERE segment_id = ?", (segment_id,))
+            # Even with a since, the newer segment covers the rows of the older ones: the watermarks it started
+            # from only move when a segment commits
+            _supersede(connection, segment_id)
+
+    def fail(self, segment_id: int, attempts: int, error: str):
+        """Leave the segment pending and back off exponentially before it is due again"""
+        delay = min(self._initial_retry_delay * (2 ** attempts), self._max_retry_delay)
+        with closing(self._connect()) as connection, connection:
+            connection.execute("UPDATE segments SET attempts = ?, next_attempt = ?, last_error = ? WHERE id = ?",
+                               (attempts + 1, time.time() + delay, error, segment_id))
+
+    def purge(self, retention_seconds: float):
+        """Drop committed and superseded segments older than the retention"""
+        with closing(self._connect()) as connection, connection:
+            cutoff = time.time() - retention_seconds
+            connection.execute(
+                "DELETE FROM records WHERE segment_id IN"
+                " (SELECT id FROM segments WHERE status != 'pending' AND created < ?)", (cutoff,))
+            connection.execute("DELETE FROM segments WHERE status != 'pending' AND created < ?", (cutoff,))
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self._path, timeout=30)
+        connection.execute("PRAGMA synchronous=FULL")
+        return connection
+
+
+def _supersede(connection: sqlite3.Connection, segment_id: int):
+    """Supersede the pending segments older than segment_id with the same day, scopes and owned rows"""
+    older = ("SELECT older.id FROM segments AS older JOIN segments AS newer ON newer.id = ?"
+             " WHERE older.status = 'pending' AND older.id < newer.id AND older.day = newer.day"
+             " AND older.scopes = newer.scopes AND older.owned IS newer.owned")
+    connection.execute(f"DELETE FROM records WHERE segment_id IN ({older})", (segment_id,))
+    connection.execute(f"UPDATE segments SET status = 'superseded' WHERE id IN ({older})", (segment_id,))
+
+
+def _dumps(usage: UsageRecord) -> str:
+    return json.dumps(usage.to_row(), separators=(",", ":"))
+
+
+def _loads(data: str) -> UsageRecord:
+    return UsageRecord.from_row(json.loads(data))
@@ -0,0 +1,22 @@
+import re
+from datetime import datetime, timezone
+
+# A table name, optionally schema qualified, that is safe to put in SQL text
+_TABLE_NAME = re.compile(r"[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)?")
+_SORTABLE_INSTANT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+
+def table_name(table: str, kind: str) -> str:
+    """The configured table name, checked before it is put in SQL text; kind names it in the error"""
+    if not _TABLE_NAME.fullmatch(table):
+        raise ValueError(f"Invalid {kind} table name: {table}")
+    return table
+
+
+def format_sortable(instant: datetime) -> str:
+    """Fixed width UTC text, so SQLite compares (and MAX()es) the instants correctly as strings"""
+    return instant.astimezone(timezone.utc).strftime(_SORTABLE_INSTANT)
+
+
+def parse_sortable(instant: str) -> datetime:
+    return datetime.strptime(instant, _SORTABLE_INSTANT).replace(tzinfo=timezone.utc)
@@ -0,0 +1,62 @@
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Modules that are only imported when a feature needs them, reported so a regression shows up
+LAZY_MODULES = ("boto3", "botocore", "numpy", "psycopg")
+
+_phases = []
+_enabled = False
+_started = None
+_depth = threading.local()
+
+
+def enable(imports_started: float):
+    """Start recording phases, with the imports timed from imports_started (a time.perf_counter value)"""
+    global _enabled, _started
+    _enabled = True
+    _started = imports_started
+    _phases.append(["imports", 0, time.perf_counter() - imports_started])
+
+
+@contextmanager
+def phase(name: str):
+    """Time the block as a startup phase, a no-op unless --profile-startup is on"""
+    if not _enabled:
+        yield
+        return
+    depth = getattr(_depth, "value", 0)
+    # Listed when it starts, so nested phases follow their parent
+    entry = [name, depth, None]
+    _phases.append(entry)
+    _depth.value = depth + 1
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _depth.value = depth
+        entry[2] = time.perf_counter() - started
+
+
+def report(file=None) -> dict:
+    """Print the phases recorded so far to stderr and stop recording, later calls do nothing"""
+    global _enabled
+    if not _enabled:
+        return {}
+    _enabled = False
+    file = file or sys.stderr
+    total = time.perf_counter() - _started
+    print("startup profile (ms):", file=file)
+    for name, depth, seconds in _phases:
+        if seconds is not None:
+            print(f"  {'  ' * depth}{name:<{24 - 2 * depth}} {seconds * 1000:9.1f}", file=file)
+    print(f"  {'total':<24} {total * 1000:9.1f}", file=file)
+    loaded = [module for module in LAZY_MODULES if module in sys.modules]
+    print(f"  lazy modules loaded: {', '.join(loaded) or 'none'}", file=file)
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    print(f"  peak RSS: {peak:.1f} MB", file=file)
+    return {"phases": [(name, round(seconds, 6)) for name, _, seconds in _phases if seconds is not None],
+            "total_seconds": round(total, 6), "lazy_modules": loaded, "peak_rss_mb": round(peak, 2)}
@@ -0,0 +1,63 @@
+import os
+import sqlite3
+from contextlib import closing
+from emporia.sql import format_sortable, parse_sortable
+
+
+class StateStore(object):
+    """Small SQLite store for the per-channel high-water marks shared by the one-shot and daemon runs
+
+    A watermark is the instant of the last interval for a (deviceGid, channelNum, scale, unit) that is final and
+    already written to the local API.
+    """
+
+    def __init__(self, path: str, account: str = "default"):
+        self._path = os.path.expanduser(path)
+        self._account = account
+        directory = os.path.dirname(self._path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with closing(self._connect()) as connection, connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS watermarks ("
+                " account TEXT NOT NULL,"
+                " device_gid INTEGER NOT NULL,"
+                " channel_num TEXT NOT NULL,"
+                " scale TEXT NOT NULL,"
+                " unit TEXT NOT NULL,"
+                " instant TEXT NOT NULL,"
+                " PRIMARY KEY (account, device_gid, channel_num, scale, unit))")
+
+    @property
+    def account(self) -> str:
+        return self._account
+
+    def get_watermarks(self, scale: str, unit: str) -> dict:
+        """{(device_gid, channel_num): instant} for the scale and unit"""
+        with closing(self._connect()) as connection:
+            rows = connection.execute(
+                "SELECT device_gid, channel_num, instant FROM watermarks WHERE account = ? AND scale = ? AND unit = ?",
+                (self._account, scale, unit)).fetchall()
+        return {(device_gid, channel_num): parse_sortable(instant) for device_gid, channel_num, instant in rows}
+
+    def min_watermark(self, scale: str, unit: str):
+        watermarks = self.get_watermarks(scale, unit)
+        return min(watermarks.values()) if watermarks else None
+
+    def set_watermarks(self, scale: str, unit: str, watermarks: dict, replace: bool = False):
+        """Advance the watermarks, replace drops the channels of the scale and unit that are not in watermarks"""
+        with closing(self._connect()) as connection, connection:
+            if replace:
+                connection.execute("DELETE FROM watermarks WHERE account = ? AND scale = ? AND unit = ?",
+                                   (self._account, scale, unit))
+            connection.executemany(
+                "INSERT INTO watermarks (account, device_gid, channel_num, scale, unit, instant)"
+                " VALUES (?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (account, device_gid, channel_num, scale, unit)"
+                " DO UPDATE SET instant = MAX(instant, excluded.instant)",
+                [(self._account, int(device_gid), str(channel_num), scale, unit, format_sortable(instant))
+                 for (device_gid, channel_num), instant in watermarks.items()])
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self._path, timeout=30)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The collector's modules are imported from src, as the script itself does
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
@@ -0,0 +1,71 @@
+import pytest
+from emporia import leases
+from emporia.leases import SqliteLeaseStore
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(leases.time, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def stores(tmp_path, clock):
+    path = str(tmp_path / "leases.db")
+    return (SqliteLeaseStore(path, owner="a", ttl=300, hold=3000),
+            SqliteLeaseStore(path, owner="b", ttl=300, hold=3000))
+
+
+def test_acquire_skips_held_units_and_stops_at_the_limit(stores):
+    a, b = stores
+    assert a.acquire(["u1", "u2", "u3"], 2) == ["u1", "u2"]
+    assert b.acquire(["u1", "u2", "u3", "u4"], 8) == ["u3", "u4"]
+    assert a.acquire(["u1", "u2", "u3", "u4"], 8) == []
+
+
+def test_completed_units_are_held_until_hold_runs_out(stores, clock):
+    a, b = stores
+    a.acquire(["u1"], 8)
+    a.complete(["u1"])
+    clock.now += 2999
+    assert b.acquire(["u1"], 8) == []
+    clock.now += 2
+    assert b.acquire(["u1"], 8) == ["u1"]
+
+
+def test_released_units_can_be_claimed_at_once(stores):
+    a, b = stores
+    a.acquire(["u1", "u2"], 8)
+    a.release(["u1"])
+    assert b.acquire(["u1", "u2"], 8) == ["u1"]
+
+
+def test_expired_leases_are_reassigned(stores, clock):
+    a, b = stores
+    a.acquire(["u1"], 8)
+    clock.now += 301
+    assert b.acquire(["u1"], 8) == ["u1"]
+    # The unit is lost to b: a can neither renew nor complete nor release it
+    assert a.renew(["u1"]) == []
+    a.complete(["u1"])
+    a.release(["u1"])
+    clock.now += 299
+    assert a.acquire(["u1"], 8) == []
+
+
+def test_renewed_leases_are_not_reassigned(stores, clock):
+    a, b = stores
+    a.acquire(["u1", "u2"], 8)
+    for _ in range(3):
+        clock.now += 200
+        assert a.renew(["u1", "u2"]) == ["u1", "u2"]
+    assert b.acquire(["u1", "u2"], 8) == []
@@ -0,0 +1,122 @@
+from datetime import datetime, timedelta, timezone
+import pytest
+from emporia.enums import Scale, Unit
+from emporia.records import UsageRecord
+from emporia.rollup import Rollup
+
+# A Monday
+DAY = datetime(2025, 3, 10, tzinfo=timezone.utc)
+STEP = timedelta(minutes=15)
+DAY_STAMP = DAY.replace(hour=23, minute=59, second=59, microsecond=999)
+
+
+def series(day: datetime, values: list, channel_num: str = "1,2,3", unit: str = "KilowattHours",
+           device_gid: int = 1) -> list:
+    """15MIN records of a channel from the start of day, a None value leaves the interval out"""
+    return [UsageRecord(day + STEP * interval, "15MIN", unit, device_gid, channel_num, "Main", value)
+            for interval, value in enumerate(values) if value is not None]
+
+
+def by_scale(records: list, scale: str) -> dict:
+    return {(record.channel_num, record.instant): record for record in records if record.scale == scale}
+
+
+def usage(records: dict, instant: datetime, channel_num: str = "1,2,3"):
+    record = records.get((channel_num, instant))
+    return None if record is None else record.usage
+
+
+def test_full_day():
+    rollup = Rollup(Scale.MINUTES_15, Unit.KWH, [Scale.HOUR, Scale.DAY])
+    usages = series(DAY, [1.0] * 96) + series(DAY, [0.25] * 96, channel_num="1")
+    records, periods = rollup.roll_up(DAY, usages, DAY + timedelta(days=1))
+    assert periods == []
+    hours = by_scale(records, "1H")
+    assert len(hours) == 48
+    for hour in range(24):
+        main = hours["1,2,3", DAY + timedelta(hours=hour)]
+        channel = hours["1", DAY + timedelta(hours=hour)]
+        assert (main.usage, main.percentage) == (4.0, 100.0)
+        assert (channel.usage, channel.percentage) == (1.0, 25.0)
+    days = by_scale(records, "1D")
+    assert days["1,2,3", DAY_STAMP].usage == 96.0
+    assert (days["1", DAY_STAMP].usage, days["1", DAY_STAMP].percentage) == (24.0, 25.0)
+
+
+@pytest.mark.parametrize("missing, first_hour, day", [
+    ("partial", 3.0, 95.0),
+    ("skip", None, None),
+    # The mean of the intervals that have data times every interval of the bucket
+    ("fill", 4.0, 96.0),
+])
+def test_day_with_a_gap(missing, first_hour, day):
+    rollup = Rollup(Scale.MINUTES_15, Unit.KWH, [Scale.HOUR, Scale.DAY], missing=missing)
+    values = [1.0] * 96
+    values[2] = None
+    records, _ = rollup.roll_up(DAY, series(DAY, values), DAY + timedelta(days=1))
+    hours = by_scale(records, "1H")
+    assert usage(hours, DAY) == first_hour
+    # The other hours are complete under every policy
+    assert len(hours) == (23 if first_hour is None else 24)
+    assert all(hours["1,2,3", DAY + timedelta(hours=hour)].usage == 4.0 for hour in range(1, 24))
+    days = by_scale(records, "1D")
+    assert usage(days, DAY_STAMP) == day
+
+
+@pytest.mark.parametrize("missing", ["partial", "skip", "fill"])
+def test_intervals_still_to_come_are_not_missing(missing):
+    rollup = Rollup(Scale.MINUTES_15, Unit.KWH, [Scale.HOUR, Scale.DAY], missing=missing)
+    now = DAY + timedelta(hours=6)
+    records, _ = rollup.roll_up(DAY, series(DAY, [1.0] * 24), now)
+    assert len(by_scale(records, "1H")) == 6
+    assert by_scale(records, "1D")["1,2,3", DAY_STAMP].usage == 24.0
+
+
+@pytest.mark.parametrize("missing, week, month", [
+    # Monday in full, Tuesday never collected and Wednesday up to noon: 96 + 48 intervals of 1.0 have data
+    ("partial", 144.0, 144.0),
+    ("skip", None, None),
+    # 2 days and a half of intervals have started in the week, 10 days and a half since the 1st of the month
+    ("fill", 240.0, 1104.0),
+])
+def test_partial_week_and_month(tmp_path, missing, week, month):
+    rollup = Rollup(Scale.MINUTES_15, Unit.KWH, [Scale.WEEK, Scale.MONTH], missing=missing,
+                    path=str(tmp_path / "rollup.db"))
+    assert rollup.period_scopes == {("1W", "KilowattHours"), ("1MON", "KilowattHours")}
+    rollup.roll_up(DAY, series(DAY, [1.0] * 96), DAY + timedelta(days=1))
+    wednesday = DAY + timedelta(days=2)
+    records, periods = rollup.roll_up(wednesday, series(wednesday, [1.0] * 48), wednesday + timedelta(hours=12))
+    assert records == []
+    (week_bucket, week_scale, week_records), (month_bucket, month_scale, month_records) = periods
+    assert (week_bucket, week_scale) == (DAY, "1W")
+    assert (month_bucket, month_scale) == (DAY.replace(day=1), "1MON")
+    assert [record.usage for record in week_records] == ([] if week is None else [week])
+    assert [record.usage for record in month_records] == ([] if month is None else [month])
+    assert all(record.instant == week_bucket for record in week_records)
+
+
+@pytest.mark.parametrize("missing", ["partial", "fill"])
+def test_mean_and_sum_units(missing):
+    # 120V in the morning and 122V in the afternoon, one morning interval missing
+    values = [120.0] * 48 + [122.0] * 48
+    values[0] = None
+    volts = Rollup(Scale.MINUTES_15, Unit.VOLTS, [Scale.HOUR, Scale.DAY], missing=missing)
+    records, _ = volts.roll_up(DAY, series(DAY, values, unit="Voltage"), DAY + timedelta(days=1))
+    hours = by_scale(records, "1H")
+    assert hours["1,2,3", DAY].usage == 120.0
+    assert hours["1,2,3", DAY + timedelta(hours=12)].usage == 122.0
+    day = by_scale(records, "1D")["1,2,3", DAY_STAMP]
+    # Averaged over the intervals that have data whatever the policy, and not a share of Main
+    assert day.usage == pytest.approx((120.0 * 47 + 122.0 * 48) / 95)
+    assert day.percentage == 0.0
+
+    kwh = Rollup(Scale.MINUTES_15, Unit.KWH, [Scale.HOUR, Scale.DAY], missing=missing)
+    values = [0.5] * 48 + [1.5] * 48
+    values[0] = None
+    records, _ = kwh.roll_up(DAY, series(DAY, values), DAY + timedelta(days=1))
+    hours = by_scale(records, "1H")
+    assert hours["1,2,3", DAY].usage == (1.5 if missing == "partial" else 2.0)
+    assert hours["1,2,3", DAY + timedelta(hours=12)].usage == 6.0
+    total = 0.5 * 47 + 1.5 * 48
+    day = by_scale(records, "1D")["1,2,3", DAY_STAMP].usage
+    assert day == pytest.approx(total if missing == "partial" else total * 96 / 95)
@@ -0,0 +1,68 @@
+import sqlite3
+from datetime import datetime, timedelta, timezone
+import pytest
+from emporia.records import UsageRecord
+from emporia.sinks import SqliteSink
+
+DAY = datetime(2025, 3, 10, tzinfo=timezone.utc)
+HOUR = ("1H", "KilowattHours")
+
+
+def hourly(device_gid: int, hours: int = 3, usage: float = 1.0, channel_num: str = "1,2,3") -> list:
+    return [UsageRecord(DAY + timedelta(hours=hour), "1H", "KilowattHours", device_gid, channel_num, "Main",
+                        usage + hour) for hour in range(hours)]
+
+
+@pytest.fixture
+def sink(tmp_path):
+    return SqliteSink(str(tmp_path / "sink.db"))
+
+
+def rows(sink) -> list:
+    connection = sqlite3.connect(sink._path)
+    try:
+        return connection.execute("SELECT instant, scale, device_id, channel_num, unit, usage FROM emporia"
+                                  " ORDER BY device_id, channel_num, instant").fetchall()
+    finally:
+        connection.close()
+
+
+def test_merge_day_counts(sink):
+    usages = hourly(1) + hourly(2)
+    assert sink.merge_day(DAY, usages, {HOUR}) == (6, 0, 0)
+    # The same day again changes nothing
+    assert sink.merge_day(DAY, usages, {HOUR}) == (0, 0, 0)
+    usages[0].usage = 42.0
+    assert sink.merge_day(DAY, usages, {HOUR}) == (0, 1, 0)
+    assert sink.merge_day(DAY, usages[1:], {HOUR}) == (0, 0, 1)
+    assert len(rows(sink)) == 5
+    assert all(row[5] != 42.0 for row in rows(sink))
+
+
+def test_merge_day_keeps_rows_outside_the_scopes_and_the_day(sink):
+    daily = [UsageRecord(DAY, "1D", "KilowattHours", 1, "1,2,3", "Main", 10.0)]
+    next_day = [UsageRecord(DAY + timedelta(days=1), "1H", "KilowattHours", 1, "1,2,3", "Main", 1.0)]
+    sink.merge_day(DAY, hourly(1) + daily, {HOUR, ("1D", "KilowattHours")})
+    sink.merge_day(DAY + timedelta(days=1), next_day, {HOUR})
+    # Only the hourly rows of the day are reconciled
+    assert sink.merge_day(DAY, [], {HOUR}) == (0, 0, 3)
+    assert sorted(row[1] for row in rows(sink)) == ["1D", "1H"]
+
+
+def test_merge_day_only_deletes_owned_rows(sink):
+    sink.merge_day(DAY, hourly(1) + hourly(2), {HOUR})
+    # Device 2 belongs to another account or replica, its rows are not this collector's to delete
+    owned = {(1, "1H", "KilowattHours")}
+    assert sink.merge_day(DAY, hourly(1, hours=2), {HOUR}, owned=owned) == (0, 0, 1)
+    assert [row[2] for row in rows(sink)] == [1, 1, 2, 2, 2]
+    assert sink.merge_day(DAY, [], {HOUR}, owned=set()) == (0, 0, 0)
+
+
+def test_merge_day_leaves_rows_before_since(sink):
+    sink.merge_day(DAY, hourly(1), {HOUR})
+    # Only the last hour was fetched again, the earlier rows were not re-fetched and stay
+    since = {(1, "1,2,3", "1H", "KilowattHours"): DAY + timedelta(hours=2)}
+    assert sink.merge_day(DAY, hourly(1)[2:], {HOUR}, since) == (0, 0, 0)
+    assert len(rows(sink)) == 3
+    assert sink.merge_day(DAY, [], {HOUR}, since) == (0, 0, 1)
+    assert len(rows(sink)) == 2
@@ -0,0 +1,97 @@
+import importlib.util
+import os
+import sqlite3
+from datetime import datetime, timedelta, timezone
+import pytest
+import yaml
+from emporia import spool
+from emporia.records import UsageRecord
+from emporia.spool import Spool
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+DAY = datetime(2025, 3, 10, tzinfo=timezone.utc)
+SCOPES = {("1H", "KilowattHours")}
+# Both fetches started from the same watermark, so neither is a full snapshot that supersedes when spooled
+SINCE = {(1, "1,2,3", "1H", "KilowattHours"): DAY}
+
+
+def hourly(usage: float) -> list:
+    return [UsageRecord(DAY + timedelta(hours=hour), "1H", "KilowattHours", 1, "1,2,3", "Main", usage)
+            for hour in range(3)]
+
+
+@pytest.fixture
+def collector(tmp_path):
+    spec = importlib.util.spec_from_file_location("emporia_collector", os.path.join(SRC_DIR, "emporia-collector.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    with open(os.path.join(SRC_DIR, "configuration", "config.yaml"), "r") as f:
+        config = yaml.safe_load(f)
+    config["sink"]["type"] = "sqlite"
+    config["sink"]["sqlite"]["path"] = str(tmp_path / "sink.db")
+    config["spool"]["path"] = str(tmp_path / "spool.db")
+    config["state"]["path"] = ""
+    path = tmp_path / "config.yaml"
+    with open(path, "w") as f:
+        yaml.safe_dump(config, f)
+    collector = module.EmporiaCollector(module.Config(str(path)))
+    collector._transaction = collector._logger.transaction_event(module.EventType.TRANSACTION_START, payload={})
+    yield collector
+    collector.close()
+
+
+def drain(collector) -> dict:
+    payload = {"return_code": 200, "records": 0, "updated": 0, "deleted": 0, "errors": 0, "details": []}
+    collector._drain_spool(payload)
+    return payload
+
+
+def usages(collector) -> list:
+    connection = sqlite3.connect(collector._sink._path)
+    try:
+        return [row[0] for row in connection.execute("SELECT usage FROM emporia ORDER BY instant")]
+    finally:
+        connection.close()
+
+
+def test_commit_supersedes_older_segments_of_the_day(tmp_path):
+    store = Spool(str(tmp_path / "spool.db"))
+    first = store.append(DAY, hourly(1.0), [], SCOPES, SINCE)
+    other_rows = store.append(DAY, hourly(1.0), [], SCOPES, SINCE, owned={(2, "1H", "KilowattHours")})
+    second = store.append(DAY, hourly(2.0), [], SCOPES, SINCE)
+    assert [segment.id for segment in store.due()] == [first, other_rows, second]
+    store.commit(second)
+    # Only the segment of the same day, scopes and rows is stale
+    assert [segment.id for segment in store.due()] == [other_rows]
+    assert store.load(first) == ([], [])
+
+
+def test_older_segment_is_not_replayed_over_a_newer_one(collector, monkeypatch):
+    collector._spool.append(DAY, hourly(1.0), [], SCOPES, SINCE)
+    collector._spool.append(DAY, hourly(2.0), [], SCOPES, SINCE)
+    merge_day = collector._sink.merge_day
+
+    def unavailable(*args, **kwargs):
+        raise sqlite3.OperationalError("database is locked")
+
+    # The first segment fails, the newer one of the same day waits for it
+    monkeypatch.setattr(collector._sink, "merge_day", unavailable)
+    payload = drain(collector)
+    assert payload["return_code"] == 500
+    assert len(payload["details"]) == 1
+    assert usages(collector) == []
+    # Not attempted, so it is due again straight away
+    assert [segment.attempts for segment in collector._spool.due()] == [0]
+
+    # The first segment is still backing off when the newer one is written
+    monkeypatch.setattr(collector._sink, "merge_day", merge_day)
+    now = spool.time.time()
+    monkeypatch.setattr(spool.time, "time", lambda: now + 1)
+    drain(collector)
+    assert usages(collector) == [2.0, 2.0, 2.0]
+
+    # Once its retry is due, the first segment is not replayed over the newer rows
+    monkeypatch.setattr(spool.time, "time", lambda: now + 3600)
+    assert drain(collector)["details"] == []
+    assert usages(collector) == [2.0, 2.0, 2.0]
+    assert collector._spool.pending() == 0